@@ -56,6 +56,10 @@ AZURE_CUSTOM_DOMAIN = f'{AZURE_ACCOUNT_NAME}.blob.core.windows.net'
 STATIC_URL = f'https://{AZURE_CUSTOM_DOMAIN}/{STATIC_LOCATION}/'
 MEDIA_URL = f'https://{AZURE_CUSTOM_DOMAIN}/{MEDIA_LOCATION}/'
 
+# The archived game posts are kept in a private container, see backend.custom_azure.AzureArchiveStorage
+SUBMISSION_ARCHIVE_STORAGE = 'backend.custom_azure.AzureArchiveStorage'
+SUBMISSION_ARCHIVE_STORAGE_OPTIONS = {}
+
 
 # Recaptchu
 GOOGLE_RECAPTCHA_SITE_KEY = os.environ['GOOGLE_RECAPTCHA_SITE_KEY']
@@ -144,6 +144,11 @@ STATICFILES_FINDERS = [
 STATICFILES_DIRS = (str(BASE_DIR.joinpath('static')),)
 STATIC_URL = 'static/'
 
+# Storage of the archived game posts, see drone_recon.submission_archive. They are participants' data, so they
+# are kept apart from the media files, which are served publicly, and out of git (see .gitignore).
+SUBMISSION_ARCHIVE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+SUBMISSION_ARCHIVE_STORAGE_OPTIONS = {'location': str(BASE_DIR.joinpath('.submission_archive'))}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
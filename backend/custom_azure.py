@@ -11,4 +11,12 @@ class AzureStaticStorage(AzureStorage):
     account_name = 'dronereconstorage' # Must be replaced by your storage_account_name
     account_key = os.environ['STORAGE_KEY']
     azure_container = 'static'
-    expiration_secs = None
\ No newline at end of file
+    expiration_secs = None
+
+class AzureArchiveStorage(AzureStorage):
+    # The container must have no public access: blobs are read with the account key, and their URLs are SAS
+    # URLs that expire after expiration_secs.
+    account_name = 'dronereconstorage' # Must be replaced by your storage_account_name
+    account_key = os.environ['STORAGE_KEY']
+    azure_container = 'archive'
+    expiration_secs = 3600
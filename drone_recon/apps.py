@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DroneReconConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'drone_recon'
+
+    def ready(self):
+        # Connect the cache invalidation signal handlers
+        from drone_recon import signals
@@ -5,14 +5,21 @@ By Warren Woodrich Pettine, M.D.
 Last updated 2021-08-02
 '''
 
-import random
+import functools
+import hashlib
+import json
+import logging
+import threading
 
 from django import forms
 from django.forms import ModelForm, modelformset_factory, BaseModelFormSet, BaseFormSet
+from django.template.loader import get_template, render_to_string
 from django.utils.html import format_html
 
 from drone_recon.global_variables import *
 from drone_recon.models import Subject, Session, QuestionnaireQ
+from drone_recon.shared_store import getSharedStore
+from drone_recon.singleflight import getSingleFlight
 
 
 class RegistrationForm(forms.Form):
@@ -236,42 +243,122 @@ class BaseQuestionnaireFormSet(BaseModelFormSet):
         self.queryset = QuestionnaireQ.objects.none()
 
 
-def makeQuestionnaireFormSet(questionnaires):
-    """Creates a formset for the questionnaires using the global variable QUESTIONNAIRES.
+def questionnaireSchema(questionnaires):
+    """Flattens questionnaires into the list of questions the formsets are built from.
 
     Args:
         questionnaires (dict): dictionary of questionnaire names and questions.
 
     Returns:
-        formset: A formset of questions combining all the questionnaires.
+        list: a dictionary for each question, with the questionnaire_name, question, possible_answers,
+            questionnaire_question_number and subscale
     """
-    initial = []
+    schema = []
     for questionnaire_name, questionnaire in zip(questionnaires.keys(), questionnaires.values()):
         for question in list(questionnaire.keys()):
-            initial_form = {
+            schema.append({
                 'questionnaire_name': questionnaire_name,
-                'answer': forms.IntegerField(label=question, widget=forms.RadioSelect(choices=[(v,k) for k,v in questionnaire[question]['answers'].items()])),
                 'possible_answers': questionnaire[question]['answers'],
                 'question': question,
                 'questionnaire_question_number': questionnaire[question]['question_number'],
                 'subscale': questionnaire[question]['subscale']
-            }
-            initial.append(initial_form)
-
-    QuestionnaireFormSet = modelformset_factory(QuestionnaireQ,
-                      exclude=('session',),
-                      widgets={'questionnaire_name'
-                               '': forms.HiddenInput(),
-                                   'possible_answers': forms.HiddenInput(),
-                                   'subscale': forms.HiddenInput(),
-                                   'question': forms.HiddenInput(),
-                                   'questionnaire_question_number': forms.HiddenInput()
-                                   },
-                      formset=BaseQuestionnaireFormSet,
-                      extra=len(initial))
-
-    formset = QuestionnaireFormSet(prefix=f'questionnaireformeset_id_{random.randint(100000, 999999)}')
-    # formset = QuestionnaireFormSet()
+            })
+    return schema
+
+
+def getQuestionnaireSchema(questionnaires):
+    """Gets the schema of the questionnaires from the store shared by the workers, building and publishing it
+    if no worker has yet. See shared_store.py. Concurrent requests share a single build, see singleflight.py.
+
+    Args:
+        questionnaires (dict): dictionary of questionnaire names and questions.
+
+    Returns:
+        list: see questionnaireSchema
+    """
+    store = getSharedStore()
+    key = 'questionnaire_schema:' + ','.join(questionnaires.keys())
+
+    def build():
+        schema = questionnaireSchema(questionnaires)
+        try:
+            store.publishJSON(key, schema)
+        except OSError:
+            logging.exception('Could not publish the questionnaire schema to the shared store')
+        return schema
+
+    return getSingleFlight('questionnaire_schema').get(key, lambda: store.getJSON(key), build)
+
+
+def questionnaireConfigHash(*configs):
+    """Hashes questionnaire configurations, e.g. to key what is built from them.
+
+    Args:
+        configs: JSON-serializable configurations, e.g. QUESTIONNAIRES
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+    return hashlib.sha256(json.dumps(configs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def questionnairePrefix(questionnaires):
+    """Gets the formset prefix of a set of questionnaires. It is stable, so the rendered formset can be cached,
+    and it differs between sets, so several formsets can be posted together.
+
+    Args:
+        questionnaires (dict): dictionary of questionnaire names and questions.
+
+    Returns:
+        str: the prefix
+    """
+    return f'questionnaireformeset_id_{questionnaireConfigHash(questionnaires)[:12]}'
+
+
+# Questionnaire prefix -> formset class, so each class is made once per process
+_QUESTIONNAIRE_FORMSETS = {}
+_QUESTIONNAIRE_FORMSETS_LOCK = threading.Lock()
+
+
+def questionnaireFormSetClass(prefix, n_questions):
+    """Gets the formset class of a set of questionnaires, making it on first use.
+
+    Args:
+        prefix (str): see questionnairePrefix
+        n_questions (int): number of questions
+
+    Returns:
+        class: a modelformset_factory formset of QuestionnaireQ
+    """
+    with _QUESTIONNAIRE_FORMSETS_LOCK:
+        if prefix not in _QUESTIONNAIRE_FORMSETS:
+            _QUESTIONNAIRE_FORMSETS[prefix] = modelformset_factory(QuestionnaireQ,
+                exclude=('session',),
+                widgets={'questionnaire_name': forms.HiddenInput(),
+                         'possible_answers': forms.HiddenInput(),
+                         'subscale': forms.HiddenInput(),
+                         'question': forms.HiddenInput(),
+                         'questionnaire_question_number': forms.HiddenInput()
+                         },
+                formset=BaseQuestionnaireFormSet,
+                extra=n_questions)
+        return _QUESTIONNAIRE_FORMSETS[prefix]
+
+
+def makeQuestionnaireFormSet(questionnaires):
+    """Creates a formset for the questionnaires using the global variable QUESTIONNAIRES.
+
+    Args:
+        questionnaires (dict): dictionary of questionnaire names and questions.
+
+    Returns:
+        formset: A formset of questions combining all the questionnaires.
+    """
+    initial = getQuestionnaireSchema(questionnaires)
+    prefix = questionnairePrefix(questionnaires)
+    QuestionnaireFormSet = questionnaireFormSetClass(prefix, len(initial))
+
+    formset = QuestionnaireFormSet(prefix=prefix)
 
     for f in range(len(formset.forms)):
         formset.forms[f].fields['question'].initial = initial[f]['question']
@@ -356,6 +443,22 @@ def processMentalHealthHistoryForm(session,form_mh_history,mh_history=None):
     Returns:
         int: 0
     """
+    subject = Subject.objects.filter(sessions=session)[0]
+    subject.psych_history = mentalHealthHistoryList(form_mh_history, mh_history=mh_history)
+    subject.save()
+    return 0
+
+
+def mentalHealthHistoryList(form_mh_history,mh_history=None):
+    """Reads the mental health history form into the list kept in Subject.psych_history.
+
+    Args:
+        form_mh_history (Django form): Form from the user containing mental health history responses.
+        mh_history (dict, optional): mental health conditions to look for. Defaults to None.
+
+    Returns:
+        list: '<condition>-<age at diagnosis>' for each condition diagnosed
+    """
     if mh_history is None:
         mh_history = MH_HISTORY
     mh_history_list = []
@@ -363,10 +466,7 @@ def processMentalHealthHistoryForm(session,form_mh_history,mh_history=None):
         if eval(form_mh_history.data[mh[0]]):
             age_diagnosis = form_mh_history.data[f'{mh[0]}-age']
             mh_history_list.append(f'{mh[0]}-{age_diagnosis}')
-    subject = Subject.objects.filter(sessions=session)[0]
-    subject.psych_history = mh_history_list
-    subject.save()
-    return 0
+    return mh_history_list
 
 
 def makeMentalHealthConditionalDict(mh_history):
@@ -471,11 +571,177 @@ class CombinedFormSet(BaseFormSet):
         return forms
 
 
-def checkAttention(formset,form_att_check,max_n_failures=2):
+# Start of the names of the answers the questionnaire page posts in compact mode
+COMPACT_ANSWER_PREFIX = 'qa'
+
+
+def compactAnswerName(questionnaire_name, question_number):
+    """Gets the name a question's answer is posted under in compact mode, e.g. 'qa-bfi10-3'.
+
+    Args:
+        questionnaire_name (str): name of the questionnaire, a key of QUESTIONNAIRES
+        question_number (int): questionnaire_question_number of the question
+
+    Returns:
+        str: the name
+    """
+    return f'{COMPACT_ANSWER_PREFIX}-{questionnaire_name}-{question_number}'
+
+
+@functools.lru_cache(maxsize=None)
+def getQuestionnaireCatalog():
+    """Compiles the questions of QUESTIONNAIRES and QUESTIONNAIRES_CONDITIONAL into the catalog the compact
+    answers are checked against. Computed once per process.
+
+    Raises:
+        ValueError: two questions of a questionnaire have the same number
+
+    Returns:
+        dict: compact answer name -> (question fields of QuestionnaireQ, without the answer; set of valid answers)
+    """
+    catalog = {}
+    for questionnaires in [QUESTIONNAIRES_CONDITIONAL, QUESTIONNAIRES]:
+        for question in getQuestionnaireSchema(questionnaires):
+            name = compactAnswerName(question['questionnaire_name'], question['questionnaire_question_number'])
+            if name in catalog:
+                raise ValueError(f'Question {name} is in the questionnaires twice')
+            catalog[name] = (question, frozenset(question['possible_answers'].values()))
+    return catalog
+
+
+def makeCompactQuestionnaireForm(formsets):
+    """Makes the form the questionnaire page posts in compact mode: the answer fields of the questionnaire
+    formsets, as they were set up (labels, choices and conditional attributes), named by compactAnswerName.
+
+    Args:
+        formsets (list): formsets made by makeQuestionnaireFormSet or makeConditionalFormSet
+
+    Returns:
+        forms.Form: the form, for rendering only. The answers are read with readCompactAnswers.
+    """
+    form = forms.Form()
+    for formset in formsets:
+        for question_form in formset.forms:
+            name = compactAnswerName(question_form.fields['questionnaire_name'].initial,
+                                     question_form.fields['questionnaire_question_number'].initial)
+            form.fields[name] = question_form.fields['answer']
+    return form
+
+
+def readCompactAnswers(data):
+    """Reads the answers posted in compact mode and checks them against the questionnaire catalog. The text
+    and answer options of each question come from the catalog, not from the post.
+
+    Args:
+        data (QueryDict): the post
+
+    Raises:
+        ValueError: an answer is not one of its question's options, or names a question that isn't in the catalog
+
+    Returns:
+        list: a dict for each question, with the fields of its QuestionnaireQ, for QuestionnaireAnswer.fromQuestions.
+            A question without an answer (e.g. a disabled conditional question) gets 0.
+    """
+    catalog = getQuestionnaireCatalog()
+    unknown = [key for key in data.keys() if key.startswith(COMPACT_ANSWER_PREFIX + '-') and key not in catalog]
+    if len(unknown) > 0:
+        raise ValueError(f'Answers to unknown questions: {unknown[:10]}')
+    answers, invalid = [], []
+    for name, (question, valid_answers) in catalog.items():
+        value = data.get(name, '')
+        if value == '':
+            answer = 0
+        else:
+            try:
+                answer = int(value)
+            except ValueError:
+                answer = None
+            if answer not in valid_answers:
+                invalid.append(name)
+                continue
+        answers.append(dict(question, answer=answer))
+    if len(invalid) > 0:
+        raise ValueError(f'Invalid answers to questions: {invalid[:10]}')
+    return answers
+
+
+def buildQuestionnaireFragment():
+    """Builds the questionnaire forms and renders them, without the CSRF token, so the result is the same for
+    every participant.
+
+    Returns:
+        dict: 'html', the rendered forms, and 'conditional_questions', the dictionary conditionalforms.js uses
+    """
+    # Make the conditional formsets
+    formset_conditional_list, conditional_questions_formset_dict = [], {}
+    for questionnaire in QUESTIONNAIRES_CONDITIONAL.keys():
+        formset_conditional_tmp, conditional_questions_tmp = makeConditionalFormSet(
+            {questionnaire: QUESTIONNAIRES_CONDITIONAL[questionnaire]},\
+            conditional_questions=CONDITIONAL_QUESTIONS[questionnaire])
+        formset_conditional_list.append(formset_conditional_tmp)
+        for key in conditional_questions_tmp:
+            conditional_questions_formset_dict[key] = conditional_questions_tmp[key]
+    # Make the conditional dict for the mental health form and merge it with the other dictionary
+    conditional_questions_dict = makeMentalHealthConditionalDict(MH_HISTORY)
+    if len(conditional_questions_formset_dict) > 0:
+        conditional_questions_dict = {**conditional_questions_dict, **conditional_questions_formset_dict}
+    # Make the regular formsets and combine with the conditional
+    formset_regular = makeQuestionnaireFormSet(QUESTIONNAIRES)
+    formsets_combined = CombinedFormSet(formsets=formset_conditional_list + [formset_regular])
+    # MAKE THE STANDARD FORMS
+    form_mh = makeMentalHealthHistoryRadioAgeForm(mh_history=MH_HISTORY)
+    form_att_check = attentionCheckList()
+    html = render_to_string('drone_recon/questionnaire_forms.html', {
+        'formsets_combined': formsets_combined,
+        'form_compact': makeCompactQuestionnaireForm(formsets_combined.formsets) if QUESTIONNAIRE_COMPACT else None,
+        'form_mh': form_mh,
+        'form_att_check': form_att_check,
+    })
+    return {'html': html, 'conditional_questions': conditional_questions_dict}
+
+
+@functools.lru_cache(maxsize=None)
+def questionnaireFragmentKey():
+    """Gets the store key of the rendered questionnaire forms, a hash of the questionnaire configuration and of
+    the template, which the code stamp of the store doesn't cover. Computed once per process.
+
+    Returns:
+        str: the key
+    """
+    template_source = get_template('drone_recon/questionnaire_forms.html').template.source
+    return 'questionnaire_fragment:' + questionnaireConfigHash(QUESTIONNAIRES, QUESTIONNAIRES_CONDITIONAL,
+                                                               CONDITIONAL_QUESTIONS, MH_HISTORY,
+                                                               ATTENTION_CHECK_HISTORY, QUESTIONNAIRE_COMPACT,
+                                                               template_source)
+
+
+def getQuestionnaireFragment():
+    """Gets the rendered questionnaire forms from the store shared by the workers, building and publishing them
+    if no worker has yet for this configuration. See shared_store.py and singleflight.py.
+
+    Returns:
+        dict: see buildQuestionnaireFragment
+    """
+    store = getSharedStore()
+    key = questionnaireFragmentKey()
+
+    def build():
+        fragment = buildQuestionnaireFragment()
+        try:
+            store.publishJSON(key, fragment)
+        except OSError:
+            logging.exception('Could not publish the questionnaire forms to the shared store')
+        return fragment
+
+    return getSingleFlight('questionnaire_fragment').get(key, lambda: store.getJSON(key), build)
+
+
+def checkAttention(answers,form_att_check,max_n_failures=2):
     """Processes attention check questions and returns if they passed.
 
     Args:
-        formset (formset): Django formset object.
+        answers (list): a dict of questionnaire_name, questionnaire_question_number, subscale and answer for each
+            question, e.g. the cleaned_data of a questionnaire formset, or from readCompactAnswers.
         form_att_check (form): Separate form with attention check questions.
         max_n_failures (int, optional): Number of questions they can get wrong before failing. Defaults to 2.
 
@@ -492,7 +758,7 @@ def checkAttention(formset,form_att_check,max_n_failures=2):
     fail_att_questionnaire = 0
     fail_bapq_question = 0
     att_check_first_question_response, att_check_second_question_response = np.nan, np.nan
-    for question in formset.cleaned_data:
+    for question in answers:
         if (question['questionnaire_name'] == 'att_check') and (question['questionnaire_question_number'] == 1):
             fail_att_questionnaire += (question['answer'] != 5)
             att_check_first_question_response = question['answer']
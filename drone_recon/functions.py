@@ -4,71 +4,112 @@ Contains helper functions for setting up the DB and running the task.
 '''
 
 
-from django.core.files import File
+from django.core.files.base import ContentFile
 from azure.storage.blob import BlobServiceClient
 from secrets import token_urlsafe
 from glob import glob
 import os
 from urllib.request import urlretrieve
 import copy
-from drone_recon.models import Stimulus
+import threading
+import logging
+import json
+import hashlib
+from drone_recon.models import Stimulus, StimulusVariant
+from drone_recon.ingestion import listStimulusFiles, ingestStimuli, describeImage, bulkStimulusChanges
+from drone_recon.image_variants import storeVariants
+from drone_recon.task_versions import FrozenTrial, getTrialSet
+from drone_recon.stimulus_features import stimulusFeatureFields
+from drone_recon.stimulus_bundle import getStimulusBundle
+from drone_recon.shared_store import getSharedStore
+from drone_recon.singleflight import getSingleFlight
 from drone_recon.global_variables import *
 
 
 def buildStimulusDB(file_dir='../drone_pngs',account_url='https://dronereconstorage.blob.core.windows.net',container_name='media-public',
-                    source='local',file_base='',use=''):
+                    source='local',file_base='',use='',ingestion='serial',max_workers=8,progress_file=None,variants=True):
     """ 
     Helper function that adds stimuli to the database. Supply the path to the folder containing the stimuli. It can load images
     either from a local directory, or from Azure's blob storage.
     Args:
         file_dir (str, optional): Where the files are stored locally. Only used when building locally. Defaults to '../drone_pngs'.
-        account_url (str, optional): Where the files are stored in the cloud. Used when building on the cloud. Defaults to 'https://dronereconstorage.blob.core.windows.net'.
+        account_url (str, optional): Where the files are stored in the cloud. Used when building on the cloud. For 'filesystem_blob',
+            the local folder that holds the container folders. Defaults to 'https://dronereconstorage.blob.core.windows.net'.
         container_name (str, optional): Container in blob storage where the images are located. Defaults to 'media-public'.
-        source (str, optional): Whether to build 'local' or from 'blog_storage'. Defaults to 'blob_storage'.
+        source (str, optional): Whether to build 'local', from 'blob_storage', or from 'filesystem_blob', a local folder
+            standing in for blob storage (concurrent ingestion only). Defaults to 'local'.
         file_base (str, optional): The start of the file name. Defaults to ''.
         use (str, optional): Whether the stimuli are used for the 'task', 'tutorial', 'schematic', 'feedback' or something else. 
             This is used for filtering when searching the table after DB creation. Defaults to ''.
+        ingestion (str, optional): 'serial' adds the stimuli one at a time. 'concurrent' uploads through a thread pool,
+            inserts with bulk_create and can resume an interrupted build, see drone_recon.ingestion. Defaults to 'serial'.
+        max_workers (int, optional): Number of upload threads for concurrent ingestion. Defaults to 8.
+        progress_file (str, optional): Where concurrent ingestion records its progress. If None, it uses a file in .logs/
+            named after the use and file base. Defaults to None.
+        variants (bool, optional): Also make the image variants, with either ingestion, see drone_recon.image_variants.
+            Defaults to True.
     
     The uses are "task" and "tutorial", 'schematic', and 'feedback'
     """
-    if source not in ['blob_storage','local']:
-        raise ValueError('Invalid source. Must be "url" or "local"')
-    if source == 'blob_storage':
-        blob_service_client = BlobServiceClient(account_url=account_url)
-        container_client = blob_service_client.get_container_client(container=container_name)
-        blob_list = container_client.list_blobs()
-        blob_names = [blob.name for blob in blob_list]
-        for blob_name in blob_names:
-            if blob_name[:len(file_base)] == file_base:
-                name = blob_name.split('.')[0]
+    if source not in ['blob_storage','local','filesystem_blob']:
+        raise ValueError('Invalid source. Must be "blob_storage", "filesystem_blob" or "local"')
+    if ingestion not in ['serial','concurrent']:
+        raise ValueError('Invalid ingestion. Must be "serial" or "concurrent"')
+    if ingestion == 'concurrent':
+        if progress_file is None:
+            progress_file = os.path.join('.logs', f'stimulus_ingest_{use}_{file_base}.jsonl')
+        files = listStimulusFiles(source, file_dir=file_dir, account_url=account_url, container_name=container_name,
+                                  file_base=file_base)
+        ingestStimuli(files, use=use, max_workers=max_workers, progress_file=progress_file, variants=variants)
+        return 0
+    if source == 'filesystem_blob':
+        raise ValueError('The "filesystem_blob" source is only supported by concurrent ingestion')
+
+    def addStimulus(name, file_name, data):
+        stimulus = Stimulus(name=name,use=use,**describeImage(data),**stimulusFeatureFields(name))
+        stimulus.image.save(file_name, ContentFile(data))
+        if variants:
+            StimulusVariant.objects.bulk_create([StimulusVariant(stimulus=stimulus, **variant)
+                                                 for variant in storeVariants(file_name, data)])
+
+    # The caches are cleared once the images are added, rather than on each save
+    with bulkStimulusChanges():
+        if source == 'blob_storage':
+            blob_service_client = BlobServiceClient(account_url=account_url)
+            container_client = blob_service_client.get_container_client(container=container_name)
+            blob_list = container_client.list_blobs()
+            blob_names = [blob.name for blob in blob_list]
+            for blob_name in blob_names:
+                if blob_name[:len(file_base)] == file_base:
+                    name = blob_name.split('.')[0]
+                    #Check if it exists
+                    if Stimulus.objects.filter(name=name).exists():
+                        print('Existing stimulus found')
+                    else: # Create new entry
+                        print('No existing stimulus found. Creating new entry')
+                        file_url = f'{account_url}/{container_name}/{blob_name}'
+                        url_content, _ = urlretrieve(file_url)
+                        data = open(url_content, 'rb').read()
+                        addStimulus(name, os.path.basename(file_url), data)
+        elif source == 'local':
+            #Loop through each image file
+            f_names = glob(os.path.join(file_dir,file_base) + '*' + '.png')
+            for f in range(len(f_names)):
+                print(f'Processing stimulis {f} of {len(f_names)-1}')
+                name = os.path.basename(f_names[f]).split('.')[0]
                 #Check if it exists
                 if Stimulus.objects.filter(name=name).exists():
                     print('Existing stimulus found')
                 else: # Create new entry
                     print('No existing stimulus found. Creating new entry')
-                    stimulus = Stimulus(name=name,use=use)
-                    file_url = f'{account_url}/{container_name}/{blob_name}'
-                    url_content, _ = urlretrieve(file_url)
-                    stimulus.image.save(os.path.basename(file_url), File(open(url_content, 'rb')))
-    elif source == 'local':
-        #Loop through each image file
-        f_names = glob(os.path.join(file_dir,file_base) + '*' + '.png')
-        for f in range(len(f_names)):
-            print(f'Processing stimulis {f} of {len(f_names)-1}')
-            name = os.path.basename(f_names[f]).split('.')[0]
-            #Check if it exists
-            if Stimulus.objects.filter(name=name).exists():
-                print('Existing stimulus found')
-            else: # Create new entry
-                print('No existing stimulus found. Creating new entry')
-                stimulus = Stimulus(name=name,use=use)
-                stimulus.image.save(os.path.basename(f_names[f]), File(open(f_names[f], 'rb')))
+                    data = open(f_names[f], 'rb').read()
+                    addStimulus(name, os.path.basename(f_names[f]), data)
     return 0
             
 
 def createFullStimulusDB(file_dir='/Users/wwp9/Dropbox/_PettineLab/code/tasks/drone_recon_category_metacog/local_jspsych/img/',
                     account_url='https://dronereconstorage.blob.core.windows.net',container_name='media-public',
-                    source='local'):
+                    source='local',ingestion='serial',max_workers=8,variants=True):
     """
     Automatically creates the full stimulus database for the task, tutorial, schematics and feedback. This is a wrapper for buildStimulusDB.
     Args:
@@ -76,119 +117,70 @@ def createFullStimulusDB(file_dir='/Users/wwp9/Dropbox/_PettineLab/code/tasks/dr
         account_url (str, optional): _description_. Defaults to 'https://dronereconstorage.blob.core.windows.net'.
         container_name (str, optional): _description_. Defaults to 'media-public'.
         source (str, optional): _description_. Defaults to 'local'.
+        ingestion (str, optional): 'serial' or 'concurrent', see buildStimulusDB. Defaults to 'serial'.
+        max_workers (int, optional): Number of upload threads for concurrent ingestion. Defaults to 8.
+        variants (bool, optional): Also make the image variants, see buildStimulusDB. Defaults to True.
     """
-    print('Build the main stimuli')
-    use = 'task'
-    file_base = '0-'
-    buildStimulusDB(file_dir=file_dir,account_url=account_url,container_name=container_name,source=source,file_base=file_base,use=use)
-    print('Build the tutorial stimuli')
-    use = 'tutorial'
-    file_base = 'training_'
-    buildStimulusDB(file_dir=file_dir,account_url=account_url,container_name=container_name,source=source,file_base=file_base,use=use)
-    print('Build schematic stimuli')
-    use = 'schematic'
-    file_base = 'schematic_'
-    buildStimulusDB(file_dir=file_dir,account_url=account_url,container_name=container_name,source=source,file_base=file_base,use=use)
-    print('Build feedback stimuli')
-    use = 'feedback'
-    file_base = 'feedback_'
-    buildStimulusDB(file_dir=file_dir,account_url=account_url,container_name=container_name,source=source,file_base=file_base,use=use)
+    with bulkStimulusChanges():
+        for use, file_base, message in [('task', '0-', 'Build the main stimuli'), ('tutorial', 'training_', 'Build the tutorial stimuli'),
+                                        ('schematic', 'schematic_', 'Build schematic stimuli'), ('feedback', 'feedback_', 'Build feedback stimuli')]:
+            print(message)
+            buildStimulusDB(file_dir=file_dir,account_url=account_url,container_name=container_name,source=source,file_base=file_base,
+                            use=use,ingestion=ingestion,max_workers=max_workers,variants=variants)
     
     
-def getStimulusURLs(use='task'):
+def getStimulusURLs(use='task',image_formats=()):
     """
     Gets the stimulus URL locations from the database.
 
     Args:
         use (str, optional): _description_. Defaults to 'task'.
+        image_formats (tuple, optional): variant formats the browser supports. The smallest variant in one of them
+            is used, with the original image as the fallback, see drone_recon.image_variants. Defaults to ().
 
     Returns:
         _type_: _description_
     """
-    stimuli = Stimulus.objects.filter(use=use)
-    stimulus_urls = []
-    for s in stimuli:
-        stimulus_urls.append(s.image.url)
+    stimulus_urls = Stimulus.objects.urlsForUse(use,image_formats=image_formats)
     return stimulus_urls
 
+
+def resolveTrialStimuli(trials, use='task', image_formats=()):
+    """
+    Swaps the stimulus names in a list of trials for their image URLs. All names are resolved together,
+    so this costs at most one query no matter how many trials there are.
+
+    Args:
+        trials (list): trial dictionaries whose 'stimulus' entry is a stimulus name
+        use (str, optional): use of the stimuli. Defaults to 'task'.
+        image_formats (tuple, optional): variant formats the browser supports, see getStimulusURLs. Defaults to ().
+
+    Returns:
+        tuple: FrozenTrial copies of the trials with the URLs filled in
+    """
+    urls = Stimulus.objects.resolveURLs([(use, trial['stimulus']) for trial in trials], image_formats=image_formats)
+    return tuple(FrozenTrial(trial, stimulus=url) for trial, url in zip(trials, urls))
+
  
-def tutorialParameters(version=1):
+def tutorialParameters(version=1,image_formats=()):
     """
-    Specifies the parameters for the tutorial blocks. Only a single version is currently supported, but it
-    is easy to extend with other versions.
+    Specifies the parameters for the tutorial blocks. The versions are defined in task_versions.json,
+    see drone_recon.task_versions.
 
     Args:
         version (int, optional): version of the tutorial. Defaults to 1.
+        image_formats (tuple, optional): variant formats the browser supports, see getStimulusURLs. Defaults to ().
 
     Raises:
         ValueError: incorrect version
 
     Returns:
-        dicts: tutorial_types, tutorial_types_keys, tutorial_train_stimuli, tutorial_test_stimuli
+        tuples: tutorial_types, tutorial_types_keys, tutorial_train_stimuli, tutorial_test_stimuli
     """
-    if version==1:
-        # Names and keys associated with each drone type
-        tutorial_types = ['Army','Navy']
-        tutorial_types_keys = ['j','k']
-        # Dictionaries with stimulus/reward associations of each block
-        tutorial_train_stimuli = [{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_A_prototype')[0].image.url,
-                'correct_response': tutorial_types_keys[0], 
-                'drone_type': tutorial_types[0], 
-                'block': 'tutorial_train'
-            },{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_A_d1_1')[0].image.url,
-                'correct_response': tutorial_types_keys[0], 
-                'drone_type': tutorial_types[0], 
-                'block': 'tutorial_train'
-            },{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_B_prototype')[0].image.url,
-                'correct_response': tutorial_types_keys[1], 
-                'drone_type': tutorial_types[1], 
-                'block': 'tutorial_train'                
-            },{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_B_d1_1')[0].image.url,
-                'correct_response': tutorial_types_keys[1], 
-                'drone_type': tutorial_types[1], 
-                'block': 'tutorial_train'                
-            }
-        ]
-        tutorial_test_stimuli = [{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_A_prototype')[0].image.url,
-                'correct_response': tutorial_types_keys[0], 
-                'drone_type': tutorial_types[0], 
-                'block': 'tutorial_test'
-            },{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_A_d1_2')[0].image.url,
-                'correct_response': tutorial_types_keys[0], 
-                'drone_type': tutorial_types[0], 
-                'block': 'tutorial_test'
-            },{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_A_d1_3')[0].image.url,
-                'correct_response': tutorial_types_keys[0], 
-                'drone_type': tutorial_types[0], 
-                'block': 'tutorial_test'
-            },{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_B_prototype')[0].image.url,
-                'correct_response': tutorial_types_keys[1], 
-                'drone_type': tutorial_types[1], 
-                'block': 'tutorial_test'
-            },{
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_B_d1_2')[0].image.url,
-                'correct_response': tutorial_types_keys[1], 
-                'drone_type': tutorial_types[1], 
-                'block': 'tutorial_test'
-            },
-            {
-                'stimulus': Stimulus.objects.filter(use='tutorial',name='training_B_d1_3')[0].image.url,
-                'correct_response': tutorial_types_keys[1], 
-                'drone_type': tutorial_types[1], 
-                'block': 'tutorial_test'
-            },
-        ]   
-    else:
-        raise ValueError('Invalid tutorial version. Only version 1 is currently supported.')
-    return tutorial_types, tutorial_types_keys, tutorial_train_stimuli, tutorial_test_stimuli
+    trial_set = getTrialSet('tutorial', version)
+    tutorial_train_stimuli = resolveTrialStimuli(trial_set.train, use=trial_set.use, image_formats=image_formats)
+    tutorial_test_stimuli = resolveTrialStimuli(trial_set.test, use=trial_set.use, image_formats=image_formats)
+    return trial_set.types, trial_set.keys, tutorial_train_stimuli, tutorial_test_stimuli
 
 
 def confidenceParameters(version=1):
@@ -215,10 +207,10 @@ def confidenceParameters(version=1):
     return confidence_labels, confidence_keys
 
 
-def taskParameters(version=1,initial_test=True):
+def taskParameters(version=1,initial_test=True,retest_number=None,image_formats=()):
     """
-    Builds the task parameters. Only a single version is currently supported, but it is easy to extend 
-    with other versions.
+    Builds the task parameters. The versions and their initial test and retest stimuli are defined in 
+    task_versions.json, see drone_recon.task_versions.
     
     Version 0 is a short task used for development
     Version 1 is the full task used for data collection
@@ -226,221 +218,212 @@ def taskParameters(version=1,initial_test=True):
     Args:
         version (int, optional): version of the task. Defaults to 1.
         initial_test (bool, optional): whether it is initial test or later. Defaults to True.
+        retest_number (int, optional): which retest stimulus set to use. If None, it gets it from the global variable. Defaults to None.
+        image_formats (tuple, optional): variant formats the browser supports, see getStimulusURLs. Defaults to ().
+
+    Raises:
+        ValueError: incorrect version or retest number
 
     Returns:
-        dicts: drone_types, drone_types_keys, train_stimuli, test_stimuli
+        tuples: drone_types, drone_types_keys, train_stimuli, test_stimuli
     """
-    if version == 0:
-         # Names and keys associated with each drone type
-        drone_types = ['friendly','hostile']
-        drone_types_keys = ['n','m']
-        # Placeholder dictionaries for faster building
-        train_A_dict = {'stimulus': "placeholder",  
-                        'correct_response': drone_types_keys[0], 
-                        'drone_type': drone_types[0], 
-                        'block': 'train'}
-        train_B_dict = copy.deepcopy(train_A_dict)
-        train_B_dict['correct_response'] = drone_types_keys[1]
-        train_B_dict['drone_type'] = drone_types[1]
-        test_A_dict = copy.deepcopy(train_A_dict)
-        test_A_dict['block'] = 'test'
-        test_B_dict = copy.deepcopy(train_B_dict)
-        test_B_dict['block'] = 'test'
-        # Stimuli names
-        train_A_stimuli = ['A_prototype','A_d1_1']
-        train_B_stimuli = [stim.replace('A_','B_') for stim in train_A_stimuli]
-        test_A_stimuli = ['A_prototype','A_d1_3']
-        test_B_stimuli = [stim.replace('A_','B_') for stim in test_A_stimuli]
-        # Build dictionaries
-        train_stimuli = []
-        for stim in train_A_stimuli:
-            train_A_dict['stimulus'] = Stimulus.objects.filter(use='task',name=stim)[0].image.url
-            train_stimuli.append(copy.deepcopy(train_A_dict))
-        for stim in train_B_stimuli:
-            train_B_dict['stimulus'] = Stimulus.objects.filter(use='task',name=stim)[0].image.url
-            train_stimuli.append(copy.deepcopy(train_B_dict))
-        test_stimuli = []
-        for stim in test_A_stimuli:
-            test_A_dict['stimulus'] = Stimulus.objects.filter(use='task',name=stim)[0].image.url
-            test_stimuli.append(copy.deepcopy(test_A_dict))
-        for stim in test_B_stimuli:
-            test_B_dict['stimulus'] = Stimulus.objects.filter(use='task',name=stim)[0].image.url
-            test_stimuli.append(copy.deepcopy(test_B_dict))       
-    elif version == 1:
-        # Names and keys associated with each drone type
-        drone_types = ['friendly','hostile']
-        drone_types_keys = ['n','m']
-        # Placeholder dictionaries for faster building
-        train_A_dict = {'stimulus': "placeholder",  
-                        'correct_response': drone_types_keys[0], 
-                        'drone_type': drone_types[0], 
-                        'block': 'train'}
-        train_B_dict = copy.deepcopy(train_A_dict)
-        train_B_dict['correct_response'] = drone_types_keys[1]
-        train_B_dict['drone_type'] = drone_types[1]
-        test_A_dict = copy.deepcopy(train_A_dict)
-        test_A_dict['block'] = 'test'
-        test_B_dict = copy.deepcopy(train_B_dict)
-        test_B_dict['block'] = 'test'
-        # Stimuli names
-        if initial_test:
-            train_A_stimuli = ['A_prototype','A_d1_1','A_d1_2','A_d2_1','A_d2_2','A_d2_3','A_d3_1','A_d3_2',\
-                'A_d3_3','A_d4_1','A_d4_2']
-            train_B_stimuli = [stim.replace('A_','B_') for stim in train_A_stimuli]
-            test_A_stimuli = ['A_prototype','A_d1_3','A_d1_4','A_d1_5','A_d1_6','A_d1_7','A_d2_4','A_d2_5',\
-                'A_d2_6','A_d2_7','A_d2_8','A_d3_4','A_d3_5','A_d3_6','A_d3_7','A_d3_8','A_d4_3','A_d4_4',\
-                'A_d4_5','A_d4_6','A_d4_7']
-            test_B_stimuli = [stim.replace('A_','B_') for stim in test_A_stimuli]
-        elif RETEST_NUMBER == 1: 
-            train_A_stimuli =  ['0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-1_4-E-1_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-1_5-A-4_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-1_4-E-1_5-A-3_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-1_4-E-1_5-A-3_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-2_3-D-2_4-E-2_5-A-3_6-B-3_7-C-4_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-1_5-A-4_6-B-3_7-C-3_8-D-4_9-E-4']
-            train_B_stimuli =  ['0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-1_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-1_5-A-4_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-4_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-3_7-C-3_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-1_3-D-2_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-2_4-E-2_5-A-4_6-B-4_7-C-4_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-2_3-D-1_4-E-1_5-A-4_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-1_1-B-2_2-C-2_3-D-2_4-E-2_5-A-3_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-3_6-B-3_7-C-4_8-D-4_9-E-3']
-            test_A_stimuli =   ['0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-4_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-4_8-D-4_9-E-3',
-                                '0-A-2_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-2_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-4_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-2_5-A-3_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-2_5-A-3_6-B-3_7-C-4_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-2_5-A-3_6-B-3_7-C-4_8-D-4_9-E-3',
-                                '0-A-2_1-B-2_2-C-1_3-D-2_4-E-1_5-A-3_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-2_1-B-1_2-C-1_3-D-2_4-E-2_5-A-4_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-2_5-A-4_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-1_4-E-2_5-A-3_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-2_1-B-2_2-C-2_3-D-2_4-E-2_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-2_5-A-4_6-B-3_7-C-4_8-D-4_9-E-4',
-                                '0-A-2_1-B-1_2-C-1_3-D-2_4-E-2_5-A-4_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-2_1-B-2_2-C-1_3-D-2_4-E-1_5-A-3_6-B-4_7-C-3_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4']
-            test_B_stimuli =   ['0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-3_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-4_9-E-4',
-                                '0-A-2_1-B-2_2-C-1_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-1_5-A-4_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-2_4-E-2_5-A-4_6-B-4_7-C-3_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-1_5-A-3_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-2_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-1_1-B-2_2-C-2_3-D-1_4-E-2_5-A-3_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-1_3-D-1_4-E-1_5-A-4_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-1_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-4_9-E-4',
-                                '0-A-2_1-B-2_2-C-1_3-D-1_4-E-2_5-A-4_6-B-4_7-C-3_8-D-3_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-2_5-A-3_6-B-4_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-4_7-C-3_8-D-3_9-E-3',
-                                '0-A-2_1-B-2_2-C-2_3-D-2_4-E-1_5-A-4_6-B-3_7-C-3_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-1_5-A-3_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-2_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-2_4-E-2_5-A-4_6-B-3_7-C-4_8-D-4_9-E-4']
-        elif RETEST_NUMBER == 2:
-            train_A_stimuli =  ['0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-2_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-2_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-2_1-B-2_2-C-1_3-D-1_4-E-2_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-2_3-D-2_4-E-1_5-A-3_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-1_1-B-2_2-C-2_3-D-1_4-E-1_5-A-4_6-B-4_7-C-4_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-2_5-A-3_6-B-4_7-C-4_8-D-4_9-E-3']
-            train_B_stimuli =  ['0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-4_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-2_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-2_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-1_3-D-1_4-E-2_5-A-3_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-1_4-E-1_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-2_5-A-4_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-1_5-A-3_6-B-3_7-C-4_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-4_7-C-3_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-2_4-E-2_5-A-4_6-B-3_7-C-3_8-D-4_9-E-3']
-            test_A_stimuli =   ['0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-3_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-3_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-2_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-4_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-2_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-4_8-D-4_9-E-4',
-                                '0-A-2_1-B-1_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-1_5-A-4_6-B-3_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-2_2-C-2_3-D-2_4-E-1_5-A-4_6-B-3_7-C-3_8-D-4_9-E-4',
-                                '0-A-1_1-B-1_2-C-1_3-D-1_4-E-1_5-A-4_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-2_1-B-2_2-C-1_3-D-2_4-E-2_5-A-4_6-B-4_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-3_8-D-3_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-1_5-A-3_6-B-4_7-C-4_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-1_5-A-4_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-2_4-E-2_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-2_5-A-4_6-B-4_7-C-4_8-D-4_9-E-4',
-                                '0-A-2_1-B-1_2-C-1_3-D-2_4-E-1_5-A-4_6-B-3_7-C-3_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-1_3-D-2_4-E-1_5-A-4_6-B-4_7-C-4_8-D-4_9-E-3',
-                                '0-A-1_1-B-2_2-C-1_3-D-1_4-E-1_5-A-3_6-B-4_7-C-3_8-D-3_9-E-3']
-            test_B_stimuli =   ['0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-3_7-C-3_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-1_3-D-1_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-4_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-4_7-C-4_8-D-4_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-2_5-A-4_6-B-4_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-1_2-C-2_3-D-1_4-E-1_5-A-3_6-B-3_7-C-3_8-D-3_9-E-3',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-1_5-A-3_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-1_2-C-2_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-3_9-E-3',
-                                '0-A-1_1-B-2_2-C-2_3-D-1_4-E-2_5-A-4_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-1_3-D-1_4-E-2_5-A-3_6-B-3_7-C-4_8-D-3_9-E-4',
-                                '0-A-2_1-B-2_2-C-1_3-D-1_4-E-2_5-A-4_6-B-3_7-C-4_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-2_4-E-2_5-A-3_6-B-4_7-C-3_8-D-3_9-E-3',
-                                '0-A-1_1-B-1_2-C-2_3-D-1_4-E-2_5-A-3_6-B-3_7-C-3_8-D-4_9-E-4',
-                                '0-A-2_1-B-1_2-C-1_3-D-1_4-E-2_5-A-4_6-B-3_7-C-4_8-D-4_9-E-4',
-                                '0-A-2_1-B-2_2-C-2_3-D-1_4-E-1_5-A-4_6-B-3_7-C-4_8-D-4_9-E-3',
-                                '0-A-2_1-B-2_2-C-1_3-D-1_4-E-1_5-A-3_6-B-3_7-C-4_8-D-3_9-E-4']
-        else:
-            raise ValueError('Error in the determination of initial test or retest stimuli')
-        # Build dictionaries
-        train_stimuli = []
-        for stim in train_A_stimuli:
-            train_A_dict['stimulus'] = Stimulus.objects.filter(use='task',name=stim)[0].image.url
-            train_stimuli.append(copy.deepcopy(train_A_dict))
-        for stim in train_B_stimuli:
-            train_B_dict['stimulus'] = Stimulus.objects.filter(use='task',name=stim)[0].image.url
-            train_stimuli.append(copy.deepcopy(train_B_dict))
-        test_stimuli = []
-        for stim in test_A_stimuli:
-            test_A_dict['stimulus'] = Stimulus.objects.filter(use='task',name=stim)[0].image.url
-            test_stimuli.append(copy.deepcopy(test_A_dict))
-        for stim in test_B_stimuli:
-            test_B_dict['stimulus'] = Stimulus.objects.filter(use='task',name=stim)[0].image.url
-            test_stimuli.append(copy.deepcopy(test_B_dict))
-    else:
-        raise ValueError('Invalid task version. Only version 1 is currently supported.')
-    return drone_types, drone_types_keys, train_stimuli, test_stimuli
+    if retest_number is None:
+        retest_number = RETEST_NUMBER
+    trial_set = getTrialSet('task', version, initial_test=initial_test, retest_number=retest_number)
+    train_stimuli = resolveTrialStimuli(trial_set.train, use=trial_set.use, image_formats=image_formats)
+    test_stimuli = resolveTrialStimuli(trial_set.test, use=trial_set.use, image_formats=image_formats)
+    return trial_set.types, trial_set.keys, train_stimuli, test_stimuli
+
+
+# Per-worker cache of built stimulus manifests, keyed by (task_version, tutorial_version, initial_test, retest_number, image_formats)
+_STIMULUS_MANIFESTS = {}
+_STIMULUS_MANIFESTS_LOCK = threading.Lock()
+# Bumped by invalidateStimulusManifest, so a build that was running at the time isn't cached
+_STIMULUS_MANIFESTS_GENERATION = 0
+
+
+def buildStimulusManifest(task_version=1,tutorial_version=1,initial_test=True,retest_number=None,image_formats=(),bundle=None):
+    """
+    Builds all the stimulus lists and URLs the game page needs for one task configuration. This is what
+    getStimulusManifest caches, so it should only be called directly when a fresh copy is needed.
+
+    Args:
+        task_version (int, optional): version of the task. Defaults to 1.
+        tutorial_version (int, optional): version of the tutorial. Defaults to 1.
+        initial_test (bool, optional): whether it is initial test or later. Defaults to True.
+        retest_number (int, optional): which retest stimulus set to use. Defaults to None.
+        image_formats (tuple, optional): variant formats the browser supports, see getStimulusURLs. Defaults to ().
+        bundle (bool, optional): whether to add the stimulus bundle. If None, it gets it from STIMULUS_BUNDLE. Defaults to None.
+
+    Returns:
+        dict: manifest with the tutorial and task parameters, the schematic and feedback URLs, and the stimulus
+            bundle (None if it is off or couldn't be built, in which case the images load one by one)
+    """
+    tutorial_types, tutorial_types_keys, tutorial_train_stimuli, tutorial_test_stimuli = \
+        tutorialParameters(version=tutorial_version,image_formats=image_formats)
+    drone_types, drone_types_keys, train_stimuli, test_stimuli = \
+        taskParameters(version=task_version,initial_test=initial_test,retest_number=retest_number,image_formats=image_formats)
+    manifest = {
+        'tutorial_types': tutorial_types,
+        'tutorial_types_keys': tutorial_types_keys,
+        'tutorial_train_stimuli': tutorial_train_stimuli,
+        'tutorial_test_stimuli': tutorial_test_stimuli,
+        'drone_types': drone_types,
+        'drone_types_keys': drone_types_keys,
+        'train_stimuli': train_stimuli,
+        'test_stimuli': test_stimuli,
+        'stim_schematic_urls': tuple(getStimulusURLs(use='schematic',image_formats=image_formats)),
+        'stim_feedback_urls': tuple(getStimulusURLs(use='feedback',image_formats=image_formats)),
+        'stimulus_bundle': None,
+    }
+    if bundle is None:
+        bundle = STIMULUS_BUNDLE
+    if bundle:
+        try:
+            manifest['stimulus_bundle'] = getStimulusBundle(manifest)
+        except Exception:
+            logging.exception('Could not build the stimulus bundle. The images will be preloaded one by one.')
+    return manifest
+
+
+def getStimulusManifest(task_version=None,tutorial_version=None,initial_test=None,retest_number=None,image_formats=()):
+    """
+    Gets the stimulus manifest for a task configuration. The manifest is built once per worker and then
+    served from memory, so rendering the game page does not touch the Stimulus table. Concurrent requests on
+    a cold worker share a single build (see singleflight.py). Any save or delete of a Stimulus clears it
+    (see drone_recon.signals). The returned manifest is shared, so do not modify it.
+
+    Args:
+        task_version (int, optional): version of the task. If None, it gets it from the global variable. Defaults to None.
+        tutorial_version (int, optional): version of the tutorial. If None, it gets it from the global variable. Defaults to None.
+        initial_test (bool, optional): whether it is initial test or later. If None, it gets it from the global variable. Defaults to None.
+        retest_number (int, optional): which retest stimulus set to use. If None, it gets it from the global variable. Defaults to None.
+        image_formats (tuple, optional): variant formats the browser supports, see image_variants.acceptedImageFormats.
+            A manifest is cached for each combination. Defaults to (), the original images.
+
+    Returns:
+        dict: manifest, see buildStimulusManifest
+    """
+    if task_version is None:
+        task_version = TASK_VERSION
+    if tutorial_version is None:
+        tutorial_version = TUTORIAL_VERSION
+    if initial_test is None:
+        initial_test = INITIAL_TEST
+    if retest_number is None:
+        retest_number = RETEST_NUMBER
+    image_formats = tuple(image_formats)
+    key = (task_version, tutorial_version, initial_test, retest_number, image_formats)
+
+    def build():
+        generation = _STIMULUS_MANIFESTS_GENERATION
+        manifest = buildStimulusManifest(task_version=task_version,tutorial_version=tutorial_version,
+            initial_test=initial_test,retest_number=retest_number,image_formats=image_formats)
+        with _STIMULUS_MANIFESTS_LOCK:
+            if generation == _STIMULUS_MANIFESTS_GENERATION:
+                _STIMULUS_MANIFESTS[key] = manifest
+        return manifest
+
+    return getSingleFlight('stimulus_manifest').get(key, lambda: _STIMULUS_MANIFESTS.get(key), build)
+
+
+def invalidateStimulusManifest():
+    """
+    Drops every cached stimulus manifest in this worker. Called whenever the Stimulus table changes.
+
+    Returns:
+        int: 0
+    """
+    global _STIMULUS_MANIFESTS_GENERATION
+    with _STIMULUS_MANIFESTS_LOCK:
+        _STIMULUS_MANIFESTS.clear()
+        _STIMULUS_MANIFESTS_GENERATION += 1
+    return 0
+
+
+def clearLocalStimulusCaches():
+    """
+    Drops the stimulus URLs and manifests cached in this worker. Runs when another process invalidates the
+    shared store, e.g. after a catalog sync.
+
+    Returns:
+        int: 0
+    """
+    Stimulus.objects.clearURLCache()
+    invalidateStimulusManifest()
+    return 0
+
+
+getSharedStore().onInvalidate(clearLocalStimulusCaches)
+
+
+def buildGameConfig(image_formats=()):
+    """
+    Builds the configuration the game page fetches: the task and tutorial parameters from the stimulus manifest,
+    the confidence labels, and the session settings.
+
+    Args:
+        image_formats (tuple, optional): variant formats the browser supports, see getStimulusURLs. Defaults to ().
+
+    Returns:
+        bytes: the JSON configuration
+    """
+    manifest = getStimulusManifest(task_version=TASK_VERSION,tutorial_version=TUTORIAL_VERSION,
+        initial_test=INITIAL_TEST,retest_number=RETEST_NUMBER,image_formats=image_formats)
+    confidence_labels, confidence_keys = confidenceParameters(version=CONFIDENCE_VERSION)
+    config = {
+        'version': {'game': GAME, 'task_version': TASK_VERSION, 'tutorial_version': TUTORIAL_VERSION,
+                    'confidence_version': CONFIDENCE_VERSION, 'initial_test': INITIAL_TEST,
+                    'retest_number': RETEST_NUMBER},
+        'confidence_labels': confidence_labels,
+        'confidence_keys': confidence_keys,
+        'require_fullscreen': REQUIRE_FULLSCREEN,
+        'initial_test': INITIAL_TEST,
+        'chunk_trials': TRIAL_CHUNK_SIZE,
+        'trial_format': TRIAL_FORMAT,
+    }
+    config.update(manifest)
+    return json.dumps(config, separators=(',', ':')).encode()
+
+
+def getGameConfig(image_formats=()):
+    """
+    Gets the game configuration. It is kept in the store shared by the workers (see shared_store.py), so it is
+    built by one worker per image formats and catalog version, and mapped by the others. Within a worker,
+    concurrent requests share a single build (see singleflight.py).
+
+    Args:
+        image_formats (tuple, optional): variant formats the browser supports, see getStimulusURLs. Defaults to ().
+
+    Returns:
+        bytes, str: the JSON configuration, and its ETag (a hash of the JSON)
+    """
+    store = getSharedStore()
+    key = 'game_config:' + ','.join(image_formats)
+
+    def lookup():
+        config, digest = store.get(key)
+        return (config, digest) if config is not None else None
+
+    def build():
+        try:
+            # Read before building, so a configuration built from a manifest the store was invalidated after
+            # is not published
+            generation = store.currentGeneration()
+        except OSError:
+            logging.exception('Could not read the generation of the shared store')
+            generation = None
+        config = buildGameConfig(image_formats=tuple(image_formats))
+        digest = hashlib.sha256(config).hexdigest()
+        if generation is not None:
+            try:
+                store.publish(key, config, generation=generation)
+            except OSError:
+                logging.exception('Could not publish the game configuration to the shared store')
+        return config, digest
+
+    config, digest = getSingleFlight('game_config').get(key, lookup, build)
+    return config, digest[:32]
 
 
 def getPaymentToken():
@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import tempfile
 from drone_recon.questionnaires import *
 
 global PROLIFIC, DEPLOYMENT, DEBUG, PAYMENT_TOKEN, PAYMENT_TOKEN_LENGTH, ATTENTION_FAILURE_TOKEN,\
@@ -36,6 +37,20 @@ MAX_N_ATTENTION_FAILURES = 2 # Maximum number of attention check failures before
 TUTORIAL_VERSION = 1 # Version of the tutorial
 TASK_VERSION = 1 # Version of the task
 CONFIDENCE_VERSION = 1 # Version of the confidence rating
+STIMULUS_VARIANT_FORMATS = ['webp'] # Compressed stimulus formats made at ingestion. Add 'avif' to also make (lossy) AVIF when Pillow supports it
+STIMULUS_BUNDLE = True # Whether the game page downloads all stimuli as one bundle, rather than one request per image
+STIMULUS_DISPLAY_WIDTH = 1200 # Width of the display-sized stimulus renditions. Wider images are also stored at this width
+TRIAL_CHUNK_SIZE = 20 # The game page uploads its trials every this many trials, and at the end of every block
+TRIAL_FORMAT = 1 # Wire format the game page uploads its trials in. 0 is the jsPsych data as it is, 1 is gzipped columns, see wire_format.py
+TRIAL_BLOCKS = True # Whether each session's trials are also kept packed in one SessionTrialBlock row, see trial_blocks.py
+TRIAL_SPOOL = False # Whether the game views spool the posted trials and answer right away, rather than wait for the DB. See spool.py
+# The spool is a SQLite file in WAL mode, which needs a local disk: WAL is not safe on a network file system, like the SMB-mounted /home
+# (and so the app folder) on Azure App Service. It defaults to the local temporary folder, which is per instance, so each instance
+# needs its spool worker (TRIAL_SPOOL_WORKER, or processtrialspool run there), and entries not yet recorded are lost if the instance is replaced.
+TRIAL_SPOOL_WORKER = True # Whether each web process records its spooled posts in a background thread. Otherwise run processtrialspool
+TRIAL_SPOOL_DIR = os.environ.get('TRIAL_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'drone_recon', 'trial_spool')) # Folder of the spool file, on a local disk
+QUESTIONNAIRE_COMPACT = True # Whether the questionnaire page posts only the answers, named by questionnaire and question number, rather than each question's hidden fields. See forms.readCompactAnswers
+SHARED_STORE_DIR = os.environ.get('SHARED_STORE_DIR', os.path.join(tempfile.gettempdir(), 'drone_recon', 'shared_store')) # Folder of the store the workers share, see shared_store.py. Local to each instance, like the workers
 
 SUBJECT_SOURCES = [('internal', 'Internal')] # List of sources for subjects when PROLIFIC is False
 
@@ -0,0 +1,216 @@
+'''
+Compressed and display-sized renditions of the stimulus images, recorded as StimulusVariant rows.
+
+The game page preloads every stimulus before the first trial, so the images it is handed decide how long a
+participant waits. At ingestion, each image gets a lossless WebP copy (and an AVIF copy if 'avif' is in
+STIMULUS_VARIANT_FORMATS), and images wider than STIMULUS_DISPLAY_WIDTH also get WebP and PNG renditions
+at that width. Only variants smaller than the original PNG are kept. When resolving URLs, the
+StimulusManager picks the smallest variant in a format the browser accepts, and falls back to the original.
+
+Stimuli added before this existed can be given variants with the buildstimulusvariants management command.
+
+'''
+
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, features
+from django.core.files.base import ContentFile
+
+from drone_recon.models import Stimulus, StimulusVariant
+from drone_recon.global_variables import STIMULUS_VARIANT_FORMATS, STIMULUS_DISPLAY_WIDTH
+
+
+# Pillow save options for each variant format. WebP and PNG are lossless, AVIF is not.
+VARIANT_ENCODERS = {
+    'webp': {'format': 'WEBP', 'lossless': True, 'quality': 100, 'method': 6},
+    'avif': {'format': 'AVIF', 'quality': 90},
+    'png': {'format': 'PNG', 'optimize': True},
+}
+
+# Accept header MIME type of each format that browsers may not support. PNG is always accepted.
+VARIANT_MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+
+
+def variantFormats(formats=None):
+    """Gets the compressed formats to make, leaving out any this Pillow build can't encode.
+
+    Args:
+        formats (list, optional): requested formats. Defaults to STIMULUS_VARIANT_FORMATS.
+
+    Raises:
+        ValueError: a format is not in VARIANT_ENCODERS
+
+    Returns:
+        list: formats to make
+    """
+    if formats is None:
+        formats = STIMULUS_VARIANT_FORMATS
+    for image_format in formats:
+        if image_format not in VARIANT_ENCODERS:
+            raise ValueError(f'Invalid variant format {image_format}. Must be one of {list(VARIANT_ENCODERS)}')
+    return [image_format for image_format in formats if (image_format == 'png') or features.check(image_format)]
+
+
+def acceptedImageFormats(accept_header):
+    """Gets the variant formats a browser accepts, from the Accept header of its request.
+
+    Args:
+        accept_header (str): HTTP Accept header
+
+    Returns:
+        tuple: accepted formats, always including 'png'
+    """
+    accepted = [image_format for image_format, mime_type in VARIANT_MIME_TYPES.items()
+                if (mime_type in accept_header) and (image_format in variantFormats())]
+    return tuple(accepted) + ('png',)
+
+
+def parseImageFormats(value):
+    """Reads a comma-separated list of variant formats, e.g. from a query string, in the same form as
+    acceptedImageFormats. Unknown formats are dropped.
+
+    Args:
+        value (str): e.g. 'webp,png'
+
+    Returns:
+        tuple: the formats
+    """
+    requested = value.split(',')
+    accepted = [image_format for image_format in VARIANT_MIME_TYPES
+                if (image_format in requested) and (image_format in variantFormats())]
+    return tuple(accepted) + (('png',) if 'png' in requested else ())
+
+
+def renderVariants(data, formats=None, display_width=None):
+    """Encodes the variants of an image. Variants that are not smaller than the original are dropped.
+
+    Args:
+        data (bytes): contents of the original PNG
+        formats (list, optional): compressed formats, see variantFormats. Defaults to None.
+        display_width (int, optional): width of the display-sized renditions. Defaults to STIMULUS_DISPLAY_WIDTH.
+
+    Returns:
+        list: (format, width, height, encoded bytes) for each variant
+    """
+    if display_width is None:
+        display_width = STIMULUS_DISPLAY_WIDTH
+    formats = variantFormats(formats)
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ['RGB', 'RGBA']:
+        image = image.convert('RGBA')
+    renditions = [(image, formats)]
+    if image.width > display_width:
+        display_height = round(image.height * display_width / image.width)
+        renditions.append((image.resize((display_width, display_height), Image.LANCZOS), formats + ['png']))
+    variants = []
+    for rendition, rendition_formats in renditions:
+        for image_format in rendition_formats:
+            buffer = io.BytesIO()
+            rendition.save(buffer, **VARIANT_ENCODERS[image_format])
+            encoded = buffer.getvalue()
+            if len(encoded) < len(data):
+                variants.append((image_format, rendition.width, rendition.height, encoded))
+    return variants
+
+
+def storeVariants(file_name, data, formats=None, display_width=None):
+    """Encodes the variants of an image and saves them to the image storage.
+
+    Args:
+        file_name (str): file name of the original, e.g. 'A_d2_3.png'. Variant names start with its stem,
+            so they can still be recognised by name on the game page.
+        data (bytes): contents of the original PNG
+        formats (list, optional): see renderVariants. Defaults to None.
+        display_width (int, optional): see renderVariants. Defaults to None.
+
+    Returns:
+        list: dictionaries with the format, width, height, byte_size and stored image path of each variant
+    """
+    image_field = StimulusVariant._meta.get_field('image')
+    stem = os.path.splitext(file_name)[0]
+    stored = []
+    for image_format, width, height, encoded in renderVariants(data, formats=formats, display_width=display_width):
+        variant_name = f'{stem}_{width}w.{image_format}'
+        path = image_field.storage.save(image_field.generate_filename(None, variant_name), ContentFile(encoded))
+        stored.append({'format': image_format, 'width': width, 'height': height, 'byte_size': len(encoded),
+                       'image': path})
+    return stored
+
+
+def knownVariants(content_hashes):
+    """Gets the stored variants of images already in the catalog, so byte-identical files can reuse them.
+
+    Args:
+        content_hashes (list): content hashes to look up
+
+    Returns:
+        dict: content hash -> list of variant dictionaries, see storeVariants
+    """
+    known = {}
+    variants = StimulusVariant.objects.filter(stimulus__content_hash__in=[h for h in content_hashes if h])\
+        .values('stimulus_id', 'stimulus__content_hash', 'format', 'width', 'height', 'byte_size', 'image')
+    first_stimulus = {}
+    for variant in variants:
+        content_hash = variant.pop('stimulus__content_hash')
+        stimulus_id = variant.pop('stimulus_id')
+        # Several stimuli can share an image. Take the variants of one of them.
+        if first_stimulus.setdefault(content_hash, stimulus_id) == stimulus_id:
+            known.setdefault(content_hash, []).append(variant)
+    return known
+
+
+def createVariantRows(variants_by_name):
+    """Inserts the variant rows for stimuli that were just added to the catalog. Costs one query to look up
+    the stimuli plus the bulk_create.
+
+    Args:
+        variants_by_name (dict): stimulus name -> list of variant dictionaries, see storeVariants
+
+    Returns:
+        int: number of variants added
+    """
+    stimulus_ids = dict(Stimulus.objects.filter(name__in=list(variants_by_name)).values_list('name', 'id'))
+    rows = [StimulusVariant(stimulus_id=stimulus_ids[name], **variant)
+            for name, variants in variants_by_name.items() if name in stimulus_ids for variant in variants]
+    StimulusVariant.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+def buildStimulusVariants(stimuli=None, rebuild=False, formats=None, display_width=None, max_workers=8):
+    """Makes the variants of stimuli already in the catalog, by reading their stored images.
+
+    Args:
+        stimuli (list, optional): stimuli to process. Defaults to every stimulus without variants.
+        rebuild (bool, optional): replace existing variants. Defaults to False.
+        formats (list, optional): see renderVariants. Defaults to None.
+        display_width (int, optional): see renderVariants. Defaults to None.
+        max_workers (int, optional): number of threads encoding and uploading. Defaults to 8.
+
+    Returns:
+        int: number of variants added
+    """
+    if stimuli is None:
+        stimuli = Stimulus.objects.all() if rebuild else Stimulus.objects.filter(variants__isnull=True)
+    stimuli = list(stimuli)
+
+    def build(stimulus):
+        with stimulus.image.open('rb') as f:
+            data = f.read()
+        return stimulus, storeVariants(os.path.basename(stimulus.image.name), data, formats=formats,
+                                       display_width=display_width)
+
+    from drone_recon.ingestion import bulkStimulusChanges, clearStimulusCaches
+    # Deleting the variants sends post_delete for each of them
+    with bulkStimulusChanges():
+        if rebuild:
+            StimulusVariant.objects.filter(stimulus__in=stimuli).delete()
+        rows = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for stimulus, variants in executor.map(build, stimuli):
+                rows.extend(StimulusVariant(stimulus=stimulus, **variant) for variant in variants)
+        StimulusVariant.objects.bulk_create(rows, batch_size=500)
+        if len(rows) > 0:
+            clearStimulusCaches()
+    return len(rows)
@@ -0,0 +1,464 @@
+'''
+Concurrent, resumable ingestion of stimulus images into the database. Used by buildStimulusDB when
+ingestion='concurrent', and by the syncstimuli management command.
+
+Existing stimuli are found with one bulk query, images are fetched and uploaded to storage through a
+bounded thread pool, and the rows are inserted with bulk_create. Every upload is appended to a progress
+file, so a build that is interrupted picks up where it stopped without re-uploading anything.
+
+Each stimulus records the MD5 content hash, byte size and pixel dimensions of its image. A file that is
+byte-identical to one already in the catalog reuses the stored image instead of being uploaded again,
+and syncStimuli uses the hashes to upload only new or changed files.
+
+Unless variants=False, the compressed and display-sized variants of each image are made while its bytes
+are in hand, see drone_recon.image_variants. The feature fields parsed from each name are filled in as the
+rows are created, see drone_recon.stimulus_features.
+
+LocalBlobContainerClient stands in for an Azure container, so the blob storage path can be run and
+benchmarked offline against a folder of images.
+
+'''
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from glob import glob
+from types import SimpleNamespace
+
+from PIL import Image
+from django.core.files.base import ContentFile
+
+from drone_recon.models import Stimulus, StimulusVariant
+from drone_recon.image_variants import storeVariants, knownVariants, createVariantRows
+from drone_recon.stimulus_features import stimulusCategoryIndex, stimulusFeatureFields
+
+
+# A stimulus image available from a source. fetch() returns the bytes. content_hash is None when the
+# source can't provide it without downloading the file.
+StimulusFile = namedtuple('StimulusFile', ['name', 'file_name', 'fetch', 'content_hash'])
+
+
+class LocalBlobContainerClient:
+    """Filesystem stand-in for azure.storage.blob.ContainerClient. Each file in the folder is a blob.
+
+    Args:
+        root (str): folder that plays the role of the container
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def list_blobs(self, name_starts_with=None):
+        """Lists the files in the folder, like ContainerClient.list_blobs. As with blobs uploaded to Azure,
+        the properties include the Content-MD5.
+
+        Args:
+            name_starts_with (str, optional): only list blobs whose names start with this. Defaults to None.
+
+        Returns:
+            list: blob properties with name, size and content_settings.content_md5
+        """
+        blobs = []
+        for blob_name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, blob_name)
+            if os.path.isfile(path) and ((name_starts_with is None) or blob_name.startswith(name_starts_with)):
+                with open(path, 'rb') as f:
+                    content_md5 = bytearray(hashlib.md5(f.read()).digest())
+                blobs.append(SimpleNamespace(name=blob_name, size=os.path.getsize(path),
+                                             content_settings=SimpleNamespace(content_md5=content_md5)))
+        return blobs
+
+    def download_blob(self, blob):
+        """Opens a file for download, like ContainerClient.download_blob.
+
+        Args:
+            blob (str): name of the blob
+
+        Returns:
+            downloader with a readall() method
+        """
+        path = os.path.join(self.root, blob)
+        return SimpleNamespace(readall=lambda: open(path, 'rb').read())
+
+
+def getContainerClient(source, account_url, container_name):
+    """Gets the container client for a blob source.
+
+    Args:
+        source (str): 'blob_storage' for Azure, or 'filesystem_blob' for a local folder standing in for it.
+        account_url (str): Azure account URL, or the folder holding the containers for 'filesystem_blob'.
+        container_name (str): name of the container
+
+    Returns:
+        ContainerClient or LocalBlobContainerClient
+    """
+    if source == 'filesystem_blob':
+        return LocalBlobContainerClient(os.path.join(account_url, container_name))
+    from azure.storage.blob import BlobServiceClient
+    blob_service_client = BlobServiceClient(account_url=account_url)
+    return blob_service_client.get_container_client(container=container_name)
+
+
+def listStimulusFiles(source, file_dir='', account_url='', container_name='', file_base=''):
+    """Lists the stimulus image files available from a source.
+
+    Args:
+        source (str): 'local', 'blob_storage' or 'filesystem_blob'
+        file_dir (str, optional): folder with the images for 'local'. Defaults to ''.
+        account_url (str, optional): see getContainerClient. Defaults to ''.
+        container_name (str, optional): see getContainerClient. Defaults to ''.
+        file_base (str, optional): The start of the file name. Defaults to ''.
+
+    Returns:
+        list: StimulusFile for each image
+    """
+    files = []
+    if source == 'local':
+        for path in sorted(glob(os.path.join(file_dir, file_base) + '*' + '.png')):
+            file_name = os.path.basename(path)
+            with open(path, 'rb') as f:
+                content_hash = hashlib.md5(f.read()).hexdigest()
+            files.append(StimulusFile(file_name.split('.')[0], file_name, lambda path=path: open(path, 'rb').read(),
+                                      content_hash))
+    elif source in ['blob_storage', 'filesystem_blob']:
+        container_client = getContainerClient(source, account_url, container_name)
+        for blob in container_client.list_blobs(name_starts_with=file_base or None):
+            content_md5 = getattr(getattr(blob, 'content_settings', None), 'content_md5', None)
+            files.append(StimulusFile(blob.name.split('.')[0], os.path.basename(blob.name),
+                                      lambda blob_name=blob.name: container_client.download_blob(blob_name).readall(),
+                                      bytes(content_md5).hex() if content_md5 else None))
+    else:
+        raise ValueError(f'Invalid source {source}. Must be "local", "blob_storage" or "filesystem_blob"')
+    return files
+
+
+def describeImage(data):
+    """Computes the catalog metadata for an image.
+
+    Args:
+        data (bytes): contents of the image file
+
+    Returns:
+        dict: content_hash, byte_size, width, height
+    """
+    width, height = Image.open(io.BytesIO(data)).size
+    return {'content_hash': hashlib.md5(data).hexdigest(), 'byte_size': len(data), 'width': width, 'height': height}
+
+
+class StimulusUploader:
+    """Uploads stimulus files to the image storage, skipping files that are already stored. Safe to use from
+    several threads.
+
+    Args:
+        known_paths (dict, optional): content hash -> stored image path of images already in storage
+        known_variants (dict, optional): content hash -> stored variants of those images, see knownVariants
+        variants (bool, optional): also make and store the image variants. Defaults to True.
+    """
+    def __init__(self, known_paths=None, known_variants=None, variants=True):
+        self.image_field = Stimulus._meta.get_field('image')
+        self.known_paths = dict(known_paths or {})
+        self.known_variants = dict(known_variants or {})
+        self.variants = variants
+        self.lock = threading.Lock()
+
+    def upload(self, stimulus_file):
+        """Fetches and stores one file and its variants. A byte-identical file that was stored before is reused.
+
+        Args:
+            stimulus_file (StimulusFile): file to upload
+
+        Returns:
+            StimulusFile, str, dict, list: the file, stored image path, describeImage output and stored variants
+        """
+        data = stimulus_file.fetch()
+        description = describeImage(data)
+        content_hash = description['content_hash']
+        with self.lock:
+            path = self.known_paths.get(content_hash)
+            variants = self.known_variants.get(content_hash)
+        if path is None:
+            path = self.image_field.storage.save(self.image_field.generate_filename(None, stimulus_file.file_name),
+                                                 ContentFile(data))
+            with self.lock:
+                self.known_paths.setdefault(content_hash, path)
+        if self.variants and (variants is None):
+            variants = storeVariants(stimulus_file.file_name, data)
+            with self.lock:
+                self.known_variants.setdefault(content_hash, variants)
+        return stimulus_file, path, description, (variants or []) if self.variants else []
+
+    def uploadAll(self, files, max_workers=8):
+        """Uploads files through a bounded thread pool, yielding each result as it completes.
+
+        Args:
+            files (list): StimulusFile to upload
+            max_workers (int, optional): number of threads fetching and uploading. Defaults to 8.
+
+        Yields:
+            StimulusFile, str, dict, list: see upload
+        """
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(self.upload, f) for f in files]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # Don't start new uploads if one failed or the run was interrupted
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def knownImagePaths(content_hashes=None):
+    """Gets the stored image path for content hashes already in the catalog.
+
+    Args:
+        content_hashes (list, optional): hashes to look up. If None, every hashed stimulus. Defaults to None.
+
+    Returns:
+        dict: content hash -> stored image path
+    """
+    stimuli = Stimulus.objects.exclude(content_hash='')
+    if content_hashes is not None:
+        stimuli = stimuli.filter(content_hash__in=[h for h in content_hashes if h])
+    return {content_hash: image for content_hash, image in stimuli.values_list('content_hash', 'image')}
+
+
+def readIngestionProgress(progress_file):
+    """Reads the uploads recorded by an earlier, interrupted ingestion.
+
+    Args:
+        progress_file (str): path of the progress file
+
+    Returns:
+        dict: stimulus name -> (stored image path, describeImage output, stored variants)
+    """
+    uploaded = {}
+    if os.path.exists(progress_file):
+        with open(progress_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A partially written last line from a crash
+                    continue
+                uploaded[record['name']] = (record['path'], record.get('description', {}), record.get('variants', []))
+    return uploaded
+
+
+def clearStimulusCaches():
+    """bulk_create and bulk_update don't send post_save, so anything using them clears the caches here.
+    """
+    from drone_recon.signals import stimulusChanged
+    stimulusChanged(Stimulus)
+
+
+# Depth of the bulkStimulusChanges blocks the thread is in, and whether anything changed in them
+_BULK_CHANGES = threading.local()
+
+
+def deferStimulusChange():
+    """Records a change of the stimuli, if this thread is in a bulkStimulusChanges block, so the caches are
+    cleared when it exits.
+
+    Returns:
+        bool: whether the change was deferred, so the caches are not to be cleared now
+    """
+    if getattr(_BULK_CHANGES, 'depth', 0) == 0:
+        return False
+    _BULK_CHANGES.changed = True
+    return True
+
+
+@contextlib.contextmanager
+def bulkStimulusChanges():
+    """Context in which stimuli and variants are saved or deleted without clearing the caches each time, as
+    signals.stimulusChanged otherwise does, e.g. once per image of a serial build. If anything changed, the
+    caches are cleared once when the outermost block exits.
+    """
+    depth = getattr(_BULK_CHANGES, 'depth', 0)
+    if depth == 0:
+        _BULK_CHANGES.changed = False
+    _BULK_CHANGES.depth = depth + 1
+    try:
+        yield
+    finally:
+        _BULK_CHANGES.depth = depth
+        if (depth == 0) and _BULK_CHANGES.changed:
+            clearStimulusCaches()
+
+
+def ingestStimuli(files, use='', max_workers=8, batch_size=100, progress_file=None, variants=True):
+    """Adds stimulus files to the database concurrently. Files whose name is already in the DB are skipped.
+
+    Args:
+        files (list): StimulusFile for each image, see listStimulusFiles
+        use (str, optional): use of the stimuli, see buildStimulusDB. Defaults to ''.
+        max_workers (int, optional): number of threads fetching and uploading. Defaults to 8.
+        batch_size (int, optional): rows per bulk_create. Defaults to 100.
+        progress_file (str, optional): where to record uploads so an interrupted run can resume. If None,
+            progress is not recorded. Defaults to None.
+        variants (bool, optional): also make the image variants, see drone_recon.image_variants. Defaults to True.
+
+    Returns:
+        int: number of stimuli added
+    """
+    start_time = time.time()
+    # One query for everything that is already there
+    existing = set(Stimulus.objects.filter(name__in=[f.name for f in files]).values_list('name', flat=True))
+    uploaded = readIngestionProgress(progress_file) if progress_file is not None else {}
+    to_upload = [f for f in files if (f.name not in existing) and (f.name not in uploaded)]
+    index = stimulusCategoryIndex()
+    # Uploads from an interrupted run that never made it into the DB
+    pending = [Stimulus(name=name, use=use, image=path, **description, **stimulusFeatureFields(name, index))
+               for name, (path, description, _) in uploaded.items() if name not in existing]
+    pending_variants = {name: stored for name, (_, _, stored) in uploaded.items() if name not in existing}
+    print(f'{len(existing)} existing stimuli, {len(pending)} uploaded by an earlier run, {len(to_upload)} to upload')
+
+    content_hashes = [f.content_hash for f in to_upload]
+    uploader = StimulusUploader(knownImagePaths(content_hashes),
+                                knownVariants(content_hashes) if variants else None, variants=variants)
+    n_added = 0
+    progress = None
+    if progress_file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(progress_file)), exist_ok=True)
+        progress = open(progress_file, 'a')
+    try:
+        for i, (stimulus_file, path, description, stored) in enumerate(uploader.uploadAll(to_upload, max_workers=max_workers)):
+            if progress is not None:
+                progress.write(json.dumps({'name': stimulus_file.name, 'path': path, 'description': description,
+                                           'variants': stored}) + '\n')
+                progress.flush()
+            pending.append(Stimulus(name=stimulus_file.name, use=use, image=path, **description,
+                                    **stimulusFeatureFields(stimulus_file.name, index)))
+            pending_variants[stimulus_file.name] = stored
+            if len(pending) >= batch_size:
+                Stimulus.objects.bulk_create(pending)
+                createVariantRows(pending_variants)
+                n_added += len(pending)
+                pending, pending_variants = [], {}
+                print(f'Processed stimulus {i+1} of {len(to_upload)}')
+        if len(pending) > 0:
+            Stimulus.objects.bulk_create(pending)
+            createVariantRows(pending_variants)
+            n_added += len(pending)
+    finally:
+        if progress is not None:
+            progress.close()
+        if n_added > 0:
+            clearStimulusCaches()
+    # Finished cleanly, so there is nothing to resume
+    if (progress_file is not None) and os.path.exists(progress_file):
+        os.remove(progress_file)
+    print(f'Added {n_added} stimuli in {time.time() - start_time:.1f} s')
+    return n_added
+
+
+def backfillStimulusMetadata(stimuli=None, max_workers=8, save=True):
+    """Computes the content hash, size and dimensions of stimuli that don't have them yet, by reading
+    their stored images.
+
+    Args:
+        stimuli (list, optional): stimuli to backfill. Defaults to every stimulus without a hash.
+        max_workers (int, optional): number of threads reading images. Defaults to 8.
+        save (bool, optional): save the values. Otherwise they are only set on the stimuli. Defaults to True.
+
+    Returns:
+        int: number of stimuli updated
+    """
+    if stimuli is None:
+        stimuli = Stimulus.objects.filter(content_hash='')
+    stimuli = list(stimuli)
+
+    def describe(stimulus):
+        with stimulus.image.open('rb') as f:
+            return stimulus, describeImage(f.read())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for stimulus, description in executor.map(describe, stimuli):
+            for field, value in description.items():
+                setattr(stimulus, field, value)
+    if save and (len(stimuli) > 0):
+        Stimulus.objects.bulk_update(stimuli, ['content_hash', 'byte_size', 'width', 'height'], batch_size=500)
+        clearStimulusCaches()
+    return len(stimuli)
+
+
+def syncStimuli(files, use='', file_base='', dry_run=False, max_workers=8, variants=True):
+    """Brings the catalog in line with a source, uploading only new or changed files.
+
+    Every file is classified as:
+        new: the name is not in the catalog. It is uploaded, unless a byte-identical image is already
+            stored, in which case the new row points at that image (listed under 'duplicate_of').
+        changed: the name is in the catalog but the content hash differs. The image and its variants are replaced.
+        unchanged: same name and content hash. Nothing is done.
+    Catalog stimuli with this use and file base that the source doesn't have are reported as 'missing',
+    but not deleted. Catalog rows without a hash are backfilled first, so they can be compared. A dry run
+    computes their hashes without saving them.
+
+    Args:
+        files (list): StimulusFile for each image, see listStimulusFiles
+        use (str, optional): use of the stimuli, see buildStimulusDB. Defaults to ''.
+        file_base (str, optional): start of the file names, used to find missing stimuli. Defaults to ''.
+        dry_run (bool, optional): only report the differences. Defaults to False.
+        max_workers (int, optional): number of threads fetching and uploading. Defaults to 8.
+        variants (bool, optional): also make the image variants, see drone_recon.image_variants. Defaults to True.
+
+    Returns:
+        dict: diff report with 'new', 'changed', 'unchanged', 'missing', 'duplicate_of' and 'seconds'
+    """
+    start_time = time.time()
+    catalog = {s.name: s for s in Stimulus.objects.filter(name__in=[f.name for f in files])}
+    unhashed_stimuli = [s for s in catalog.values() if s.content_hash == '']
+    if len(unhashed_stimuli) > 0:
+        backfillStimulusMetadata(unhashed_stimuli, max_workers=max_workers, save=not dry_run)
+    # Files whose hash the listing doesn't give have to be fetched to compare
+    unhashed_files = [f for f in files if (f.content_hash is None) and (f.name in catalog)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fetched_hashes = dict(executor.map(lambda f: (f.name, hashlib.md5(f.fetch()).hexdigest()), unhashed_files))
+    report = {'new': [], 'changed': [], 'unchanged': [], 'missing': [], 'duplicate_of': {}}
+    to_upload = []
+    for f in files:
+        content_hash = f.content_hash or fetched_hashes.get(f.name)
+        if f.name not in catalog:
+            report['new'].append(f.name)
+            to_upload.append(f)
+        elif catalog[f.name].content_hash != content_hash:
+            report['changed'].append(f.name)
+            to_upload.append(f)
+        else:
+            report['unchanged'].append(f.name)
+    in_source = set(f.name for f in files)
+    report['missing'] = sorted(name for name in Stimulus.objects.filter(use=use, name__startswith=file_base)\
+                               .values_list('name', flat=True) if name not in in_source)
+    known_paths = knownImagePaths([f.content_hash for f in to_upload])
+    report['duplicate_of'] = {f.name: known_paths[f.content_hash] for f in to_upload if f.content_hash in known_paths}
+    if (not dry_run) and (len(to_upload) > 0):
+        uploader = StimulusUploader(known_paths, knownVariants(list(known_paths)) if variants else None,
+                                    variants=variants)
+        new_stimuli, changed_stimuli, new_variants = [], [], {}
+        index = stimulusCategoryIndex()
+        for stimulus_file, path, description, stored in uploader.uploadAll(to_upload, max_workers=max_workers):
+            new_variants[stimulus_file.name] = stored
+            if stimulus_file.name in catalog:
+                stimulus = catalog[stimulus_file.name]
+                stimulus.image = path
+                for field, value in description.items():
+                    setattr(stimulus, field, value)
+                changed_stimuli.append(stimulus)
+            else:
+                new_stimuli.append(Stimulus(name=stimulus_file.name, use=use, image=path, **description,
+                                            **stimulusFeatureFields(stimulus_file.name, index)))
+        # Deleting the variants sends post_delete for each of them
+        with bulkStimulusChanges():
+            Stimulus.objects.bulk_create(new_stimuli, batch_size=500)
+            Stimulus.objects.bulk_update(changed_stimuli, ['image', 'content_hash', 'byte_size', 'width', 'height'],
+                                         batch_size=500)
+            StimulusVariant.objects.filter(stimulus__in=changed_stimuli).delete()
+            createVariantRows(new_variants)
+            clearStimulusCaches()
+    report['seconds'] = round(time.time() - start_time, 2)
+    return report
@@ -0,0 +1,76 @@
+'''
+Management command that measures what recording a game submission costs. It records synthetic submissions
+of several sizes for a throwaway session, counts the queries and times them, then rolls everything back.
+The submissions are not archived, so nothing is left in storage.
+See submissions.recordGameSubmission.
+
+Example:
+    python manage.py benchmarksubmission --n-trials 10 70 300
+
+'''
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from drone_recon.models import Stimulus, Subject, Session
+from drone_recon.submissions import recordGameSubmission
+
+
+class Rollback(Exception):
+    pass
+
+
+def makeGameSubmission(stimuli, n_trials):
+    """Builds the data the game page posts, with a classification and a confidence trial per stimulus shown.
+
+    Args:
+        stimuli (list): Stimulus objects to cycle through
+        n_trials (int): number of trials
+
+    Returns:
+        dict: classification_data, confidence_data, strategy_free_data and strategy_radio_data
+    """
+    classification_trials, confidence_trials = [], []
+    for i in range(n_trials):
+        url = stimuli[i % len(stimuli)].image.url
+        classification_trials.append({'stimulus': url, 'response': 'n', 'correct_response': 'n',
+                                      'drone_type': 'friendly', 'type_selected': 'friendly', 'rt': 812.4,
+                                      'block': 'train' if i < n_trials // 2 else 'test', 'trial_index_aligned': i})
+        confidence_trials.append({'stimulus': url, 'response': 3, 'rt': 455, 'trial_index_aligned': i})
+    return {
+        'classification_data': {'trials': classification_trials},
+        'confidence_data': {'trials': confidence_trials},
+        'strategy_free_data': {'trials': [{'response': {'Q0': 'Looked at the wings'}}]},
+        'strategy_radio_data': {'trials': [{'response': {'rule': 'yes', 'memory': 'no'}}]},
+    }
+
+
+class Command(BaseCommand):
+    help = 'Counts the queries and time taken to record game submissions of several sizes. Nothing is kept.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--n-trials', type=int, nargs='+', default=[10, 70, 300])
+
+    def handle(self, *args, **options):
+        stimuli = list(Stimulus.objects.filter(use='task').order_by('id')[:100])
+        if len(stimuli) == 0:
+            raise CommandError('The catalog has no task stimuli, run buildstimulusdb first')
+        try:
+            with transaction.atomic():
+                subject = Subject.objects.create(external_ID='benchmark', external_source='benchmark')
+                for n_trials in options['n_trials']:
+                    session = Session.objects.create(subject=subject, start_time=timezone.now(),
+                                                     end_time=timezone.now())
+                    submission = makeGameSubmission(stimuli, n_trials)
+                    start_time = time.perf_counter()
+                    with CaptureQueriesContext(connection) as queries:
+                        recordGameSubmission(session.id, archive=False, **submission)
+                    self.stdout.write(f'{n_trials} trials: {len(queries)} queries in '
+                                      f'{1000 * (time.perf_counter() - start_time):.1f} ms')
+                raise Rollback()
+        except Rollback:
+            pass
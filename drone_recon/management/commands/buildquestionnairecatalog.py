@@ -0,0 +1,23 @@
+'''
+Management command that adds the questions of QUESTIONNAIRES and QUESTIONNAIRES_CONDITIONAL to the
+QuestionnaireItem catalog, e.g. after a questionnaire is added or reworded in questionnaires.py. Questions
+are otherwise added the first time they are answered. See models.QuestionnaireItemRegistry.
+
+Example:
+    python manage.py buildquestionnairecatalog
+
+'''
+
+from django.core.management.base import BaseCommand
+
+from drone_recon.forms import getQuestionnaireCatalog
+from drone_recon.models import QUESTIONNAIRE_ITEMS
+
+
+class Command(BaseCommand):
+    help = 'Adds the questions of the configured questionnaires to the questionnaire item catalog.'
+
+    def handle(self, *args, **options):
+        questions = [question for question, _ in getQuestionnaireCatalog().values()]
+        item_ids = QUESTIONNAIRE_ITEMS.itemIds(questions)
+        self.stdout.write(f'{len(questions)} questions, in {len(set(item_ids))} catalog items')
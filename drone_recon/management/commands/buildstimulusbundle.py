@@ -0,0 +1,40 @@
+'''
+Management command that builds the stimulus bundle the game page downloads, so the first participant after a
+deployment doesn't wait for it. See stimulus_bundle.py.
+
+Example, for the configured task version and browsers that accept WebP:
+    python manage.py buildstimulusbundle --image-formats webp png
+
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from drone_recon.functions import buildStimulusManifest
+from drone_recon.stimulus_bundle import getStimulusBundle
+from drone_recon.global_variables import TASK_VERSION, TUTORIAL_VERSION, INITIAL_TEST, RETEST_NUMBER
+
+
+class Command(BaseCommand):
+    help = 'Packs the images of a task configuration into one content-addressed bundle.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--task-version', type=int, default=TASK_VERSION)
+        parser.add_argument('--tutorial-version', type=int, default=TUTORIAL_VERSION)
+        parser.add_argument('--retest-number', type=int, default=RETEST_NUMBER,
+                            help='Build the bundle of this retest instead of the initial test')
+        parser.add_argument('--image-formats', nargs='*', default=[],
+                            help='Variant formats the browsers accept, e.g. webp png. Defaults to the original images')
+        parser.add_argument('--rebuild', action='store_true', help='Pack the images again even if the bundle exists')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        initial_test = INITIAL_TEST if options['retest_number'] is None else False
+        # Build the manifest without its bundle, so the bundle is only built once, here
+        manifest = buildStimulusManifest(task_version=options['task_version'],
+            tutorial_version=options['tutorial_version'], initial_test=initial_test,
+            retest_number=options['retest_number'], image_formats=tuple(options['image_formats']), bundle=False)
+        bundle = getStimulusBundle(manifest, rebuild=options['rebuild'])
+        self.stdout.write(f"{bundle['url']}: {len(bundle['entries'])} images, {bundle['size']} bytes " +
+                          f"in {time.time() - start_time:.1f} s")
@@ -0,0 +1,33 @@
+'''
+Management command that builds the full stimulus database, see functions.createFullStimulusDB.
+
+Example, running the blob storage path offline against a folder laid out like the storage account:
+    python manage.py buildstimulusdb --source filesystem_blob --account-url ../blob_mirror --ingestion concurrent
+
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from drone_recon.functions import createFullStimulusDB
+
+
+class Command(BaseCommand):
+    help = 'Builds the full stimulus database for the task, tutorial, schematics and feedback.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default='local', choices=['local', 'blob_storage', 'filesystem_blob'])
+        parser.add_argument('--file-dir', default='../drone_pngs', help='Folder with the images for --source local')
+        parser.add_argument('--account-url', default='https://dronereconstorage.blob.core.windows.net',
+                            help='Storage account URL, or the local folder holding the containers for filesystem_blob')
+        parser.add_argument('--container-name', default='media-public')
+        parser.add_argument('--ingestion', default='concurrent', choices=['serial', 'concurrent'])
+        parser.add_argument('--max-workers', type=int, default=8)
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        createFullStimulusDB(file_dir=options['file_dir'], account_url=options['account_url'],
+                             container_name=options['container_name'], source=options['source'],
+                             ingestion=options['ingestion'], max_workers=options['max_workers'])
+        self.stdout.write(f'Built the stimulus database in {time.time() - start_time:.1f} s')
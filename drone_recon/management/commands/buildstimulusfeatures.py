@@ -0,0 +1,24 @@
+'''
+Management command that fills in the feature fields parsed from the stimulus names, for stimuli added
+before they existed or after the prototypes in task_versions.json change. See
+stimulus_features.buildStimulusFeatures.
+
+Example:
+    python manage.py buildstimulusfeatures
+
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from drone_recon.stimulus_features import buildStimulusFeatures
+
+
+class Command(BaseCommand):
+    help = 'Parses the feature vector, distortion level and prototype distances of every catalog stimulus from its name.'
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        n_changed = buildStimulusFeatures()
+        self.stdout.write(f'Updated the features of {n_changed} stimuli in {time.time() - start_time:.1f} s')
@@ -0,0 +1,30 @@
+'''
+Management command that makes the compressed and display-sized variants of stimuli already in the catalog.
+See image_variants.buildStimulusVariants.
+
+Example, after adding AVIF to STIMULUS_VARIANT_FORMATS:
+    python manage.py buildstimulusvariants --rebuild
+
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from drone_recon.image_variants import buildStimulusVariants, variantFormats
+
+
+class Command(BaseCommand):
+    help = 'Makes the WebP/AVIF and display-sized variants of catalog stimuli that do not have them yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Replace the variants of every stimulus')
+        parser.add_argument('--display-width', type=int, default=None,
+                            help='Width of the display-sized renditions. Defaults to STIMULUS_DISPLAY_WIDTH')
+        parser.add_argument('--max-workers', type=int, default=8)
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        n_added = buildStimulusVariants(rebuild=options['rebuild'], display_width=options['display_width'],
+                                        max_workers=options['max_workers'])
+        self.stdout.write(f"Added {n_added} variants ({', '.join(variantFormats())}) in {time.time() - start_time:.1f} s")
@@ -0,0 +1,26 @@
+'''
+Management command that writes the packed trial blocks of sessions from their Trial rows, for sessions
+recorded before TRIAL_BLOCKS was on. See trial_blocks.buildTrialBlocks.
+
+Example:
+    python manage.py buildtrialblocks
+
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from drone_recon.trial_blocks import buildTrialBlocks
+
+
+class Command(BaseCommand):
+    help = 'Packs the trials of every session, or of the given sessions, into their SessionTrialBlock rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--session', type=int, nargs='+', default=None, help='Ids of the sessions')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        n_sessions = buildTrialBlocks(options['session'])
+        self.stdout.write(f'Wrote the trial blocks of {n_sessions} sessions in {time.time() - start_time:.1f} s')
@@ -0,0 +1,39 @@
+'''
+Management command that records the trial data spooled by the game views when TRIAL_SPOOL is on. See
+spool.processSpool.
+
+Examples, to record what is due once, or to keep recording every 5 seconds:
+    python manage.py processtrialspool
+    python manage.py processtrialspool --interval 5
+
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from drone_recon.spool import getTrialSpool, processSpool
+
+
+class Command(BaseCommand):
+    help = 'Records the spooled game posts as Trial and Strategy rows, retrying failures.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running, checking the spool every this many seconds')
+        parser.add_argument('--limit', type=int, default=1000, help='Most entries to record per check')
+        parser.add_argument('--retry-failed', action='store_true', help='Put the entries that were given up back in the queue')
+
+    def handle(self, *args, **options):
+        spool = getTrialSpool()
+        if options['retry_failed']:
+            self.stdout.write(f'Queued {spool.retryFailed()} failed entries again')
+        while True:
+            start_time = time.time()
+            n_recorded, n_failed = processSpool(spool, limit=options['limit'])
+            if (n_recorded + n_failed > 0) or (options['interval'] is None):
+                self.stdout.write(f'Recorded {n_recorded} entries, {n_failed} failed, in {time.time() - start_time:.1f} s. '
+                                  f'Spool: {spool.statistics()}')
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
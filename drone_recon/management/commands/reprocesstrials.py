@@ -0,0 +1,46 @@
+'''
+Management command that derives the Trial and Strategy rows of sessions again from their archived posts,
+over a process pool. See reprocessing.reprocessSessions.
+
+Examples:
+    python manage.py reprocesstrials --project pilots --workers 8
+    python manage.py reprocesstrials --session 12 15
+
+'''
+
+from django.core.management.base import BaseCommand, CommandError
+
+from drone_recon.models import SubmissionArchive
+from drone_recon.reprocessing import reprocessSessions
+
+
+class Command(BaseCommand):
+    help = 'Re-derives the trials of archived sessions and swaps them in, one transaction per session.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--session', type=int, nargs='+', default=None, help='Ids of the sessions')
+        parser.add_argument('--project', default=None, help='Only sessions of this project')
+        parser.add_argument('--all', action='store_true', help='Every session with archived posts')
+        parser.add_argument('--workers', type=int, default=4, help='Number of processes')
+
+    def handle(self, *args, **options):
+        if (options['session'] is None) and (options['project'] is None) and (not options['all']):
+            raise CommandError('Give --session, --project or --all')
+        archives = SubmissionArchive.objects.all()
+        if options['session'] is not None:
+            archives = archives.filter(session_id__in=options['session'])
+        if options['project'] is not None:
+            archives = archives.filter(session__project=options['project'])
+        session_ids = sorted(set(archives.values_list('session_id', flat=True)))
+        if options['session'] is not None:
+            for session_id in sorted(set(options['session']) - set(session_ids)):
+                self.stderr.write(f'Session {session_id} has no archived posts')
+        self.stdout.write(f'Reprocessing {len(session_ids)} sessions with {options["workers"]} workers')
+
+        def progress(session_id, n_trials, error):
+            if error:
+                self.stderr.write(f'Session {session_id} failed: {error}')
+
+        result = reprocessSessions(session_ids, max_workers=options['workers'], progress=progress)
+        self.stdout.write(f"Derived {result['trials']} trials of {result['sessions']} sessions in "
+                          f"{result['seconds']:.1f} s, {len(result['failed'])} failed")
@@ -0,0 +1,56 @@
+'''
+Management command that syncs the stimulus catalog with a source, only uploading new or changed files.
+See ingestion.syncStimuli.
+
+Example, checking what a refresh of the task stimuli would do:
+    python manage.py syncstimuli --source local --file-dir ../drone_pngs --file-base 0- --use task --dry-run
+
+'''
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from drone_recon.ingestion import listStimulusFiles, syncStimuli, backfillStimulusMetadata
+
+
+class Command(BaseCommand):
+    help = 'Compares a folder or blob container with the stimulus catalog and uploads only new or changed files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default='local', choices=['local', 'blob_storage', 'filesystem_blob'])
+        parser.add_argument('--file-dir', default='../drone_pngs', help='Folder with the images for --source local')
+        parser.add_argument('--account-url', default='https://dronereconstorage.blob.core.windows.net',
+                            help='Storage account URL, or the local folder holding the containers for filesystem_blob')
+        parser.add_argument('--container-name', default='media-public')
+        parser.add_argument('--file-base', default='', help='Only sync files whose names start with this')
+        parser.add_argument('--use', default='', help="Use of the stimuli: 'task', 'tutorial', 'schematic' or 'feedback'")
+        parser.add_argument('--dry-run', action='store_true', help='Only report the differences')
+        parser.add_argument('--max-workers', type=int, default=8)
+        parser.add_argument('--report', default=None, help='Also write the full diff report to this JSON file')
+        parser.add_argument('--backfill', action='store_true',
+                            help='Compute the hash, size and dimensions of every catalog stimulus missing them, then exit')
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            n_updated = backfillStimulusMetadata(max_workers=options['max_workers'])
+            self.stdout.write(f'Backfilled {n_updated} stimuli')
+            return
+        files = listStimulusFiles(options['source'], file_dir=options['file_dir'], account_url=options['account_url'],
+                                  container_name=options['container_name'], file_base=options['file_base'])
+        report = syncStimuli(files, use=options['use'], file_base=options['file_base'], dry_run=options['dry_run'],
+                             max_workers=options['max_workers'])
+        prefix = '[dry run] ' if options['dry_run'] else ''
+        for name in report['new']:
+            duplicate = f" (same image as {report['duplicate_of'][name]})" if name in report['duplicate_of'] else ''
+            self.stdout.write(f'{prefix}+ {name}{duplicate}')
+        for name in report['changed']:
+            self.stdout.write(f'{prefix}~ {name}')
+        for name in report['missing']:
+            self.stdout.write(f'{prefix}- {name} (in catalog, not in source)')
+        self.stdout.write(f"{prefix}{len(report['new'])} new, {len(report['changed'])} changed, " +
+                          f"{len(report['unchanged'])} unchanged, {len(report['missing'])} missing " +
+                          f"in {report['seconds']} s")
+        if options['report'] is not None:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.7 on 2026-10-17 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0008_auto_20230825_0000'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stimulus',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='stimulus',
+            name='byte_size',
+            field=models.IntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='stimulus',
+            name='width',
+            field=models.IntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='stimulus',
+            name='height',
+            field=models.IntegerField(default=None, null=True),
+        ),
+    ]
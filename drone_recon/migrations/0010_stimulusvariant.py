@@ -0,0 +1,26 @@
+# Generated by Django 4.1.7 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0009_stimulus_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StimulusVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(max_length=10)),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('byte_size', models.IntegerField()),
+                ('image', models.ImageField(upload_to='images/variants/')),
+                ('stimulus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='drone_recon.stimulus')),
+            ],
+        ),
+    ]
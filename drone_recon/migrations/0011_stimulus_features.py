@@ -0,0 +1,33 @@
+# Generated by Django 4.1.7 on 2026-10-17 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0010_stimulusvariant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stimulus',
+            name='category',
+            field=models.CharField(blank=True, default='', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='stimulus',
+            name='features',
+            field=models.BinaryField(default=None, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='stimulus',
+            name='distortion_level',
+            field=models.SmallIntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='stimulus',
+            name='prototype_distances',
+            field=models.BinaryField(default=None, max_length=2, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.7 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0011_stimulus_features'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrialChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.IntegerField()),
+                ('idempotency_key', models.CharField(max_length=64)),
+                ('n_trials', models.IntegerField(default=0)),
+                ('received_time', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trial_chunks', to='drone_recon.session')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='trialchunk',
+            constraint=models.UniqueConstraint(fields=('session', 'sequence'), name='unique_trial_chunk_sequence'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.1.7 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0012_trialchunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubmissionArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20)),
+                ('sequence', models.IntegerField(default=None, null=True)),
+                ('content_hash', models.CharField(db_index=True, max_length=64)),
+                ('byte_size', models.IntegerField()),
+                ('archive', models.FileField(upload_to='submissions/')),
+                ('received_time', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='submission_archives', to='drone_recon.session')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.7 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0013_submissionarchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionTrialBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('n_trials', models.IntegerField(default=0)),
+                ('levels', models.JSONField(default=dict)),
+                ('stimulus_id', models.BinaryField(default=b'')),
+                ('correct', models.BinaryField(default=b'')),
+                ('correct_class', models.BinaryField(default=b'')),
+                ('response', models.BinaryField(default=b'')),
+                ('confidence', models.BinaryField(default=b'')),
+                ('rt_classification', models.BinaryField(default=b'')),
+                ('rt_confidence', models.BinaryField(default=b'')),
+                ('feedback_given', models.BinaryField(default=b'')),
+                ('block', models.BinaryField(default=b'')),
+                ('trial_number', models.BinaryField(default=b'')),
+                ('session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='trial_block', to='drone_recon.session')),
+            ],
+        ),
+    ]
@@ -0,0 +1,128 @@
+# Generated by Django 4.1.7 on 2026-10-17 10:00
+
+from django.db import migrations, models
+from django.db.models import Case, When, Value
+import drone_recon.models
+
+
+LABEL_FIELDS = ['correct_class', 'response', 'block']
+# Trial rows converted per UPDATE, so the table is never locked for long
+BATCH_SIZE = 20000
+
+
+def batches(Trial):
+    """Yields (first id, last id + 1) ranges of BATCH_SIZE ids covering the Trial table."""
+    ids = Trial.objects.aggregate(first=models.Min('id'), last=models.Max('id'))
+    if ids['first'] is None:
+        return
+    for start in range(ids['first'], ids['last'] + 1, BATCH_SIZE):
+        yield start, start + BATCH_SIZE
+
+
+def encodeLabels(apps, schema_editor):
+    Trial = apps.get_model('drone_recon', 'Trial')
+    TrialLabel = apps.get_model('drone_recon', 'TrialLabel')
+    labels = set()
+    for field in LABEL_FIELDS:
+        labels.update(Trial.objects.order_by().values_list(field, flat=True).distinct())
+    labels.discard(None)
+    TrialLabel.objects.bulk_create([TrialLabel(label=label) for label in sorted(labels)], ignore_conflicts=True)
+    codes = dict(TrialLabel.objects.values_list('label', 'id'))
+    for start, stop in batches(Trial):
+        Trial.objects.filter(id__gte=start, id__lt=stop).update(**{
+            f'{field}_code': Case(*[When(**{field: label}, then=Value(code)) for label, code in codes.items()],
+                                  output_field=models.SmallIntegerField())
+            for field in LABEL_FIELDS})
+
+
+def decodeLabels(apps, schema_editor):
+    Trial = apps.get_model('drone_recon', 'Trial')
+    TrialLabel = apps.get_model('drone_recon', 'TrialLabel')
+    codes = dict(TrialLabel.objects.values_list('id', 'label'))
+    for start, stop in batches(Trial):
+        Trial.objects.filter(id__gte=start, id__lt=stop).update(**{
+            field: Case(*[When(**{f'{field}_code': code}, then=Value(label)) for code, label in codes.items()],
+                        default=Value(''), output_field=models.CharField())
+            for field in LABEL_FIELDS})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0014_sessiontrialblock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrialLabel',
+            fields=[
+                ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+                ('label', models.CharField(max_length=100, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='trial',
+            name='correct_class_code',
+            field=models.SmallIntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='trial',
+            name='response_code',
+            field=models.SmallIntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='trial',
+            name='block_code',
+            field=models.SmallIntegerField(default=None, null=True),
+        ),
+        migrations.RunPython(encodeLabels, decodeLabels),
+        # Only block had no default, which reversing its RemoveField needs to add the column back to a
+        # table that has rows. decodeLabels then fills it in.
+        migrations.AlterField(
+            model_name='trial',
+            name='block',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.RemoveField(
+            model_name='trial',
+            name='correct_class',
+        ),
+        migrations.RemoveField(
+            model_name='trial',
+            name='response',
+        ),
+        migrations.RemoveField(
+            model_name='trial',
+            name='block',
+        ),
+        migrations.RenameField(
+            model_name='trial',
+            old_name='correct_class_code',
+            new_name='correct_class',
+        ),
+        migrations.RenameField(
+            model_name='trial',
+            old_name='response_code',
+            new_name='response',
+        ),
+        migrations.RenameField(
+            model_name='trial',
+            old_name='block_code',
+            new_name='block',
+        ),
+        migrations.AlterField(
+            model_name='trial',
+            name='correct_class',
+            field=drone_recon.models.TrialLabelField(default=''),
+        ),
+        migrations.AlterField(
+            model_name='trial',
+            name='response',
+            field=drone_recon.models.TrialLabelField(default=''),
+        ),
+        migrations.AlterField(
+            model_name='trial',
+            name='block',
+            field=drone_recon.models.TrialLabelField(),
+        ),
+    ]
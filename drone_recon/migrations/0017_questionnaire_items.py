@@ -0,0 +1,129 @@
+# Generated by Django 4.1.7 on 2026-10-17 10:00
+
+import hashlib
+import json
+
+from django.core.management.color import no_style
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+ITEM_FIELDS = ['questionnaire_name', 'questionnaire_question_number', 'subscale', 'question', 'possible_answers']
+# QuestionnaireQ rows copied per batch
+BATCH_SIZE = 20000
+
+CREATE_VIEW = '''
+CREATE VIEW drone_recon_questionnaireq AS
+SELECT answer.id, answer.session_id, item.questionnaire_name, item.subscale, item.possible_answers, item.question,
+       answer.answer, item.questionnaire_question_number
+FROM drone_recon_questionnaireanswer answer
+JOIN drone_recon_questionnaireitem item ON item.id = answer.item_id
+'''
+DROP_VIEW = 'DROP VIEW drone_recon_questionnaireq'
+
+
+def itemHash(fields):
+    """Same as models.questionnaireItemHash when this migration was written."""
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def batches(model):
+    """Yields (first id, last id + 1) ranges of BATCH_SIZE ids covering the table of a model."""
+    ids = model.objects.aggregate(first=models.Min('id'), last=models.Max('id'))
+    if ids['first'] is None:
+        return
+    for start in range(ids['first'], ids['last'] + 1, BATCH_SIZE):
+        yield start, start + BATCH_SIZE
+
+
+def resetSequence(schema_editor, model):
+    """Moves the id sequence of a model past the ids copied into it."""
+    with schema_editor.connection.cursor() as cursor:
+        for sql in schema_editor.connection.ops.sequence_reset_sql(no_style(), [model]):
+            cursor.execute(sql)
+
+
+def copyAnswers(apps, schema_editor):
+    QuestionnaireQ = apps.get_model('drone_recon', 'QuestionnaireQ')
+    QuestionnaireItem = apps.get_model('drone_recon', 'QuestionnaireItem')
+    QuestionnaireAnswer = apps.get_model('drone_recon', 'QuestionnaireAnswer')
+    item_ids = dict(QuestionnaireItem.objects.values_list('content_hash', 'id'))
+    for start, stop in batches(QuestionnaireQ):
+        answers = []
+        rows = QuestionnaireQ.objects.filter(id__gte=start, id__lt=stop)\
+            .values_list('id', 'session_id', 'answer', *ITEM_FIELDS)
+        for question_id, session_id, answer, *fields in rows:
+            content_hash = itemHash(fields)
+            if content_hash not in item_ids:
+                item_ids[content_hash] = QuestionnaireItem.objects.create(
+                    content_hash=content_hash, **dict(zip(ITEM_FIELDS, fields))).id
+            answers.append(QuestionnaireAnswer(id=question_id, session_id=session_id,
+                                               item_id=item_ids[content_hash], answer=answer))
+        QuestionnaireAnswer.objects.bulk_create(answers)
+    resetSequence(schema_editor, QuestionnaireAnswer)
+
+
+def restoreAnswers(apps, schema_editor):
+    QuestionnaireQ = apps.get_model('drone_recon', 'QuestionnaireQ')
+    QuestionnaireAnswer = apps.get_model('drone_recon', 'QuestionnaireAnswer')
+    for start, stop in batches(QuestionnaireAnswer):
+        rows = QuestionnaireAnswer.objects.filter(id__gte=start, id__lt=stop)\
+            .values_list('id', 'session_id', 'answer', *[f'item__{field}' for field in ITEM_FIELDS])
+        QuestionnaireQ.objects.bulk_create([
+            QuestionnaireQ(id=question_id, session_id=session_id, answer=answer, **dict(zip(ITEM_FIELDS, fields)))
+            for question_id, session_id, answer, *fields in rows])
+    resetSequence(schema_editor, QuestionnaireQ)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0016_submissionfingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionnaireItem',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('questionnaire_name', models.CharField(max_length=100)),
+                ('questionnaire_question_number', models.IntegerField()),
+                ('subscale', models.CharField(blank=True, max_length=100, null=True)),
+                ('question', models.CharField(max_length=1000)),
+                ('possible_answers', models.JSONField(default=dict)),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QuestionnaireAnswer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('answer', models.IntegerField()),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='answers', to='drone_recon.questionnaireitem')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='questionnaire_answers', to='drone_recon.session')),
+            ],
+        ),
+        migrations.RunPython(copyAnswers, restoreAnswers),
+        migrations.DeleteModel(
+            name='QuestionnaireQ',
+        ),
+        migrations.CreateModel(
+            name='QuestionnaireQ',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('questionnaire_name', models.CharField(max_length=100)),
+                ('subscale', models.CharField(blank=True, max_length=100, null=True)),
+                ('possible_answers', models.JSONField(default=dict)),
+                ('question', models.CharField(max_length=1000)),
+                ('answer', models.IntegerField()),
+                ('questionnaire_question_number', models.IntegerField()),
+                ('session', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='questionnaire_q', to='drone_recon.session')),
+            ],
+            options={
+                'db_table': 'drone_recon_questionnaireq',
+                'managed': False,
+            },
+        ),
+        migrations.RunSQL(CREATE_VIEW, DROP_VIEW),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.7 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import drone_recon.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drone_recon', '0017_questionnaire_items'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='submissionarchive',
+            name='archive',
+            field=models.FileField(storage=drone_recon.models.submissionArchiveStorage, upload_to='submissions/'),
+        ),
+    ]
@@ -1,8 +1,125 @@
+import hashlib
+import json
+import threading
+
+from django import forms
+from django.conf import settings
+from django.core.exceptions import FieldError
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.utils.module_loading import import_string
 
 # Create your models here.
 
+class StimulusManager(models.Manager):
+    """Manager for Stimulus that resolves stimulus names to image URLs in bulk.
+
+    Args:
+        models (models.Manager): Django manager class
+    """
+    # (use, name, image_formats) -> image URL, shared by every manager instance in the worker
+    _url_cache = {}
+
+    def _cacheURLs(self, stimuli, image_formats):
+        """Caches the URL to serve for each stimulus: the smallest variant in one of the image formats,
+        or the original image if there is none. Costs one query for the variants when formats are given.
+
+        Args:
+            stimuli (list): Stimulus objects
+            image_formats (tuple): formats the browser supports, e.g. ('avif', 'webp')
+        """
+        smallest = {}
+        if (len(image_formats) > 0) and (len(stimuli) > 0):
+            variants = StimulusVariant.objects.filter(stimulus__in=stimuli, format__in=image_formats)\
+                .only('stimulus_id', 'image', 'byte_size').order_by('byte_size')
+            for variant in variants:
+                smallest.setdefault(variant.stimulus_id, variant)
+        for stimulus in stimuli:
+            key = (stimulus.use, stimulus.name, image_formats)
+            if key in self._url_cache:
+                continue
+            variant = smallest.get(stimulus.id)
+            if (variant is not None) and ((stimulus.byte_size is None) or (variant.byte_size < stimulus.byte_size)):
+                self._url_cache[key] = variant.image.url
+            else:
+                self._url_cache[key] = stimulus.image.url
+
+    def resolveURLs(self, pairs, image_formats=()):
+        """Resolves a list of (use, name) pairs to image URLs with a single query (plus one for the variants
+        if image formats are given). URLs are cached, so names that were resolved before do not hit the DB again.
+
+        Args:
+            pairs (list): (use, name) tuples
+            image_formats (tuple, optional): variant formats the browser supports, e.g. ('avif', 'webp'). The
+                smallest variant in those formats is served, with the original image as the fallback. Defaults to ().
+
+        Raises:
+            ValueError: one or more stimuli are not in the DB. All missing names are listed.
+
+        Returns:
+            list: image URLs, in the same order as pairs
+        """
+        image_formats = tuple(image_formats)
+        keys = [(use, name, image_formats) for use, name in pairs]
+        missing = set(key for key in keys if key not in self._url_cache)
+        if len(missing) > 0:
+            names = set(name for _, name, _ in missing)
+            stimuli, seen = [], set()
+            for stimulus in self.filter(name__in=names).only('name', 'use', 'image', 'byte_size').order_by('id'):
+                key = (stimulus.use, stimulus.name, image_formats)
+                if (key in missing) and (key not in seen):
+                    stimuli.append(stimulus)
+                    seen.add(key)
+            self._cacheURLs(stimuli, image_formats)
+            not_found = [f'{use}/{name}' for use, name, _ in sorted(missing) if (use, name, image_formats) not in self._url_cache]
+            if len(not_found) > 0:
+                raise ValueError(f'{len(not_found)} stimuli not found in DB: {", ".join(not_found)}')
+        return [self._url_cache[key] for key in keys]
+
+    def urlsForUse(self, use, image_formats=()):
+        """Gets the image URLs of every stimulus with a given use, with a single query (plus one for the
+        variants if image formats are given).
+
+        Args:
+            use (str): 'task', 'tutorial', 'schematic', 'feedback', etc.
+            image_formats (tuple, optional): see resolveURLs. Defaults to ().
+
+        Returns:
+            list: image URLs
+        """
+        image_formats = tuple(image_formats)
+        stimuli = list(self.filter(use=use).only('name', 'use', 'image', 'byte_size'))
+        self._cacheURLs(stimuli, image_formats)
+        return [self._url_cache[(stimulus.use, stimulus.name, image_formats)] for stimulus in stimuli]
+
+    def findByImageURLs(self, urls):
+        """Finds the stimuli that image URLs handed to the browser belong to, whether they point at the
+        original image or at a variant.
+
+        Args:
+            urls (list): image URLs
+
+        Returns:
+            dict: URL -> Stimulus id, for the URLs that were found
+        """
+        paths = {}
+        for url in urls:
+            file_name = url.split('/')[-1]
+            paths['images/' + file_name] = url
+            paths['images/variants/' + file_name] = url
+        found = {}
+        for stimulus_id, image in self.filter(image__in=list(paths)).values_list('id', 'image'):
+            found.setdefault(paths[image], stimulus_id)
+        for stimulus_id, image in StimulusVariant.objects.filter(image__in=list(paths)).values_list('stimulus_id', 'image'):
+            found.setdefault(paths[image], stimulus_id)
+        return found
+
+    def clearURLCache(self):
+        """Drops the cached image URLs. Called whenever the Stimulus table changes.
+        """
+        self._url_cache.clear()
+
+
 class Stimulus(models.Model):
     """Model class for a stimulus. 
 
@@ -15,10 +132,36 @@ class Stimulus(models.Model):
     name = models.CharField(max_length=300)
     use = models.CharField(max_length=50)
     image = models.ImageField(upload_to='images/')
+    # MD5 of the image file, the same digest blob storage reports as Content-MD5, so syncs can compare without downloading
+    content_hash = models.CharField(max_length=32, default='', blank=True, db_index=True)
+    byte_size = models.IntegerField(default=None, null=True)
+    width = models.IntegerField(default=None, null=True)
+    height = models.IntegerField(default=None, null=True)
+    # Parsed from the name at ingestion, see drone_recon.stimulus_features. The vectors are packed int8 arrays.
+    category = models.CharField(max_length=1, default='', blank=True)
+    features = models.BinaryField(max_length=10, default=None, null=True)
+    distortion_level = models.SmallIntegerField(default=None, null=True)
+    prototype_distances = models.BinaryField(max_length=2, default=None, null=True)
+    objects = StimulusManager()
     def __str__(self):
         return self.name
 
 
+class StimulusVariant(models.Model):
+    """Model class for a compressed or resized rendition of a stimulus image, e.g. a lossless WebP. 
+    See drone_recon.image_variants.
+
+    Args:
+        models (models.Model): Django model object class
+    """
+    stimulus = models.ForeignKey(Stimulus, on_delete=models.CASCADE, related_name='variants')
+    format = models.CharField(max_length=10)
+    width = models.IntegerField()
+    height = models.IntegerField()
+    byte_size = models.IntegerField()
+    image = models.ImageField(upload_to='images/variants/')
+
+
 class Subject(models.Model):
     """Model class for a subject.
 
@@ -95,6 +238,149 @@ class Recruitment(models.Model):
     accepted = models.BooleanField(null=True, default=None)
     
     
+class TrialLabel(models.Model):
+    """Model class for the registry of the labels stored as codes in the categorical Trial columns, e.g.
+    'friendly', 'hostile' or 'train'. A label's code is its id. See TrialLabelField.
+
+    Args:
+        models (models.Model): Django model object class
+    """
+    id = models.SmallAutoField(primary_key=True)
+    label = models.CharField(max_length=100, unique=True)
+    def __str__(self):
+        return self.label
+
+
+class TrialLabelRegistry:
+    """Maps labels to their TrialLabel codes and back, caching the registry in the process. A label seen for
+    the first time is added to the registry. It is only cached once that is committed, so a rolled back
+    transaction can't leave a code without its label.
+    """
+    def __init__(self):
+        self.codes = {}
+        self.labels = {}
+        self.lock = threading.Lock()
+
+    def _remember(self, code, label):
+        with self.lock:
+            self.codes[label] = code
+            self.labels[code] = label
+
+    def load(self):
+        """Reads the whole registry, which is a handful of rows. It is cached once the transaction reading it
+        commits, as it may hold labels added by that transaction.
+
+        Returns:
+            dict: label -> code
+        """
+        codes = dict(TrialLabel.objects.values_list('label', 'id'))
+
+        def remember():
+            for label, code in codes.items():
+                self._remember(code, label)
+        transaction.on_commit(remember)
+        return codes
+
+    def code(self, label):
+        """Gets the code of a label, adding it to the registry if it is new.
+
+        Args:
+            label (str): the label
+
+        Returns:
+            int: the code
+        """
+        known_code = self.find(label)
+        if known_code is not None:
+            return known_code
+        trial_label, _ = TrialLabel.objects.get_or_create(label=label)
+        transaction.on_commit(lambda: self._remember(trial_label.id, label))
+        return trial_label.id
+
+    def find(self, label):
+        """Gets the code of a label without adding it, e.g. for a filter.
+
+        Args:
+            label (str): the label
+
+        Returns:
+            int: the code, or None if the label is not in the registry
+        """
+        if label in self.codes:
+            return self.codes[label]
+        return self.load().get(label)
+
+    def label(self, code):
+        """Gets the label of a code.
+
+        Args:
+            code (int): the code
+
+        Raises:
+            ValueError: the code is not in the registry
+
+        Returns:
+            str: the label
+        """
+        if code in self.labels:
+            return self.labels[code]
+        labels = {known_code: label for label, known_code in self.load().items()}
+        if code not in labels:
+            raise ValueError(f'Trial label code {code} is not in the registry')
+        return labels[code]
+
+
+TRIAL_LABELS = TrialLabelRegistry()
+# Code a filter on a label that is not in the registry compares against. No TrialLabel has it, so it matches
+# nothing.
+UNKNOWN_LABEL_CODE = -1
+# Lookups on the text of a label, which the integer column doesn't hold
+PATTERN_LOOKUPS = ['iexact', 'contains', 'icontains', 'startswith', 'istartswith', 'endswith', 'iendswith',
+                   'regex', 'iregex']
+
+
+class TrialLabelField(models.SmallIntegerField):
+    """Small integer column holding a string label, coded through the TrialLabel registry. It reads and
+    writes labels, so it is used like a CharField, including in filters on exact values. A label is only
+    added to the registry when it is saved: filtering on a new label matches nothing. Filters on parts of a
+    label (contains, startswith, ...) are not supported.
+    """
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else TRIAL_LABELS.label(value)
+
+    def to_python(self, value):
+        if (value is None) or isinstance(value, str):
+            return value
+        return TRIAL_LABELS.label(int(value))
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        code = TRIAL_LABELS.find(str(value))
+        return UNKNOWN_LABEL_CODE if code is None else code
+
+    def get_db_prep_save(self, value, connection):
+        if value is None:
+            return None
+        return TRIAL_LABELS.code(str(value))
+
+    def get_lookup(self, lookup_name):
+        if lookup_name in PATTERN_LOOKUPS:
+            raise FieldError(f'{self.name} holds coded labels, which the {lookup_name} lookup can\'t match. '
+                             f'Filter on exact labels, or with __in on the labels that match.')
+        return super().get_lookup(lookup_name)
+
+    @property
+    def validators(self):
+        # The integer range validators don't apply to labels
+        return list(self._validators)
+
+    def formfield(self, **kwargs):
+        # The admin passes its integer widget for integer fields
+        kwargs.pop('widget', None)
+        return forms.CharField(max_length=100, required=not self.blank, **kwargs)
+
+
 class Trial(models.Model):
     """Model class for an individual trial
 
@@ -104,27 +390,228 @@ class Trial(models.Model):
     #All data pertinent for an individual trial
     stimulus = models.ForeignKey(Stimulus, on_delete=models.CASCADE, related_name='trials')
     session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='trials')
-    correct_class = models.CharField(max_length=100, default="")
-    response = models.CharField(max_length=100, default="")
+    # Coded through the TrialLabel registry, read and written as labels
+    correct_class = TrialLabelField(default="")
+    response = TrialLabelField(default="")
     confidence = models.FloatField(default=None, blank=True, null=True)
     correct = models.BooleanField(null=True)
     rt_classification = models.IntegerField(default=None,null=True)
     rt_confidence = models.IntegerField(default=None,null=True)
     feedback_given = models.BooleanField(default=False)
-    block = models.CharField(max_length=100)
+    block = TrialLabelField()
     trial_number = models.IntegerField(default=None)
+
+
+class SessionTrialBlock(models.Model):
+    """Model class for the trials of a session packed into typed arrays, one row per session, so they can be
+    read without a row per trial. Kept alongside the Trial rows. See drone_recon.trial_blocks.
+
+    Args:
+        models (models.Model): Django model object class
+    """
+    session = models.OneToOneField(Session, on_delete=models.CASCADE, related_name='trial_block')
+    n_trials = models.IntegerField(default=0)
+    # Strings of the coded columns, {'correct_class': [...], 'response': [...], 'block': [...]}
+    levels = models.JSONField(default=dict)
+    # Packed arrays of n_trials values, ordered by trial number. See trial_blocks.BLOCK_COLUMNS for the types.
+    stimulus_id = models.BinaryField(default=b'')
+    correct = models.BinaryField(default=b'')
+    correct_class = models.BinaryField(default=b'')
+    response = models.BinaryField(default=b'')
+    confidence = models.BinaryField(default=b'')
+    rt_classification = models.BinaryField(default=b'')
+    rt_confidence = models.BinaryField(default=b'')
+    feedback_given = models.BinaryField(default=b'')
+    block = models.BinaryField(default=b'')
+    trial_number = models.BinaryField(default=b'')
+
+
+class TrialChunk(models.Model):
+    """Model class for a chunk of trials uploaded during the task. Records which chunks of a session were
+    received, so a chunk that is sent again is not saved twice. See drone_recon.submissions.
+
+    Args:
+        models (models.Model): Django model object class
+    """
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='trial_chunks')
+    sequence = models.IntegerField()
+    idempotency_key = models.CharField(max_length=64)
+    n_trials = models.IntegerField(default=0)
+    received_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'sequence'], name='unique_trial_chunk_sequence'),
+        ]
     
 
+class SubmissionFingerprint(models.Model):
+    """Model class for the fingerprint of a session's one-shot game submission, the SHA-256 of its payload.
+    A submission that is posted again is recognized from it and not saved twice. See drone_recon.submissions.
+
+    Args:
+        models (models.Model): Django model object class
+    """
+    session = models.OneToOneField(Session, on_delete=models.CASCADE, related_name='submission_fingerprint')
+    content_hash = models.CharField(max_length=64)
+    n_trials = models.IntegerField(default=0)
+    received_time = models.DateTimeField(auto_now_add=True)
+
+
+def submissionArchiveStorage():
+    """Makes the storage of the archived game posts, set by SUBMISSION_ARCHIVE_STORAGE and
+    SUBMISSION_ARCHIVE_STORAGE_OPTIONS. It is private, unlike the default storage of the media files.
+
+    Returns:
+        Storage: Django storage
+    """
+    return import_string(settings.SUBMISSION_ARCHIVE_STORAGE)(**settings.SUBMISSION_ARCHIVE_STORAGE_OPTIONS)
+
+
+class SubmissionArchive(models.Model):
+    """Model class for the archived payload of a game post, which the trials of a session can be derived from
+    again. See drone_recon.submission_archive.
+
+    Args:
+        models (models.Model): Django model object class
+    """
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='submission_archives')
+    kind = models.CharField(max_length=20)
+    sequence = models.IntegerField(default=None, null=True)
+    content_hash = models.CharField(max_length=64, db_index=True)
+    byte_size = models.IntegerField()
+    archive = models.FileField(upload_to='submissions/', storage=submissionArchiveStorage)
+    received_time = models.DateTimeField(auto_now_add=True)
+
+
+# Fields of a QuestionnaireItem, which are the question fields of QuestionnaireQ
+QUESTIONNAIRE_ITEM_FIELDS = ['questionnaire_name', 'questionnaire_question_number', 'subscale', 'question',
+                             'possible_answers']
+
+
+def questionnaireItemHash(question):
+    """Hashes the fields of a questionnaire item, which identify its version.
+
+    Args:
+        question (dict): the QUESTIONNAIRE_ITEM_FIELDS of the item
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+    fields = [question[field] for field in QUESTIONNAIRE_ITEM_FIELDS]
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class QuestionnaireItem(models.Model):
+    """Model class for a question of a questionnaire, as it was asked. A question whose text, subscale or
+    answers change gets a new item, so the answers given to each version keep pointing at it. See
+    QuestionnaireItemRegistry.
+
+    Args:
+        models (models.Model): Django model object class
+    """
+    id = models.AutoField(primary_key=True)
+    questionnaire_name = models.CharField(max_length=100)
+    questionnaire_question_number = models.IntegerField()
+    subscale = models.CharField(max_length=100,blank=True,null=True)
+    question = models.CharField(max_length=1000)
+    possible_answers = models.JSONField(default=dict)
+    content_hash = models.CharField(max_length=64, unique=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+
+
+class QuestionnaireItemRegistry:
+    """Maps questions to their QuestionnaireItem ids, caching them in the process. Questions seen for the
+    first time are added to the catalog. They are only cached once that is committed, so a rolled back
+    transaction can't leave an id without its item.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def _remember(self, ids):
+        with self.lock:
+            self.ids.update(ids)
+
+    def itemIds(self, questions):
+        """Gets the item ids of questions, adding the new ones to the catalog. Costs no query once the
+        questions have been seen, and at most three otherwise, however many questions there are.
+
+        Args:
+            questions (list): dicts of the QUESTIONNAIRE_ITEM_FIELDS of each question
+
+        Returns:
+            list: the item ids, in the order of questions
+        """
+        hashes = [questionnaireItemHash(question) for question in questions]
+        missing = {content_hash: question for content_hash, question in zip(hashes, questions)
+                   if content_hash not in self.ids}
+        if len(missing) == 0:
+            return [self.ids[content_hash] for content_hash in hashes]
+        ids = dict(QuestionnaireItem.objects.filter(content_hash__in=list(missing)).values_list('content_hash', 'id'))
+        new = [content_hash for content_hash in missing if content_hash not in ids]
+        if len(new) > 0:
+            # Conflicts are items added by a concurrent request, which are read back with the new ones
+            QuestionnaireItem.objects.bulk_create([
+                QuestionnaireItem(content_hash=content_hash,
+                                  **{field: missing[content_hash][field] for field in QUESTIONNAIRE_ITEM_FIELDS})
+                for content_hash in new], ignore_conflicts=True)
+            ids.update(QuestionnaireItem.objects.filter(content_hash__in=new).values_list('content_hash', 'id'))
+        transaction.on_commit(lambda: self._remember(ids))
+        return [self.ids[content_hash] if content_hash in self.ids else ids[content_hash] for content_hash in hashes]
+
+
+QUESTIONNAIRE_ITEMS = QuestionnaireItemRegistry()
+
+
+class QuestionnaireAnswer(models.Model):
+    """Model class for a participant's answer to a questionnaire item. Read them with the question fields
+    through QuestionnaireQ.
+
+    Args:
+        models (models.Model): Django model object class
+    """
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='questionnaire_answers')
+    item = models.ForeignKey(QuestionnaireItem, on_delete=models.PROTECT, related_name='answers')
+    answer = models.IntegerField()
+
+    @classmethod
+    def fromQuestions(cls, session, questions):
+        """Makes the unsaved answers of questions, e.g. for bulk_create.
+
+        Args:
+            session (Session): session of the answers
+            questions (list): dicts of the QUESTIONNAIRE_ITEM_FIELDS and the answer of each question, or
+                unsaved QuestionnaireQ objects
+
+        Returns:
+            list: QuestionnaireAnswer objects
+        """
+        questions = [question if isinstance(question, dict) else
+                     {field: getattr(question, field) for field in QUESTIONNAIRE_ITEM_FIELDS + ['answer']}
+                     for question in questions]
+        item_ids = QUESTIONNAIRE_ITEMS.itemIds(questions)
+        return [cls(session=session, item_id=item_id, answer=int(question['answer']))
+                for question, item_id in zip(questions, item_ids)]
+
+
 class QuestionnaireQ(models.Model):
-    """Model class for a questionnaire question
+    """Model class for a questionnaire question and its answer, read from a database view joining
+    QuestionnaireAnswer and QuestionnaireItem, so it has the shape of the table it replaced. It is not
+    written to: answers are saved as QuestionnaireAnswer (see QuestionnaireAnswer.fromQuestions). It also
+    gives the fields of the questionnaire formsets.
 
     Args:
         models (models.Model): Django model object class
     """
-    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='questionnaire_q')
+    session = models.ForeignKey(Session, on_delete=models.DO_NOTHING, db_constraint=False, related_name='questionnaire_q')
     questionnaire_name = models.CharField(max_length=100)
     subscale = models.CharField(max_length=100,blank=True,null=True)
     possible_answers = models.JSONField(default=dict)
     question = models.CharField(max_length=1000)
     answer = models.IntegerField()
-    questionnaire_question_number = models.IntegerField()
\ No newline at end of file
+    questionnaire_question_number = models.IntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'drone_recon_questionnaireq'
\ No newline at end of file
@@ -0,0 +1,147 @@
+'''
+Derives the Trial and Strategy rows of sessions again from their archived posts (see
+drone_recon.submission_archive), e.g. after a change to how submissions.buildTrials computes a field.
+
+A session's archives are read and decoded, and its trials are built with the same functions that
+recorded them, with the chunks merged in memory. The old rows are then replaced by the new ones in one
+transaction per session, so a session is never seen half-derived, and a session that fails keeps its old rows.
+
+Sessions are spread over a process pool. Each process opens its own database connection. The
+reprocesstrials management command runs this for a project, a list of sessions, or every archived session.
+
+'''
+
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
+from django.db import connections, transaction
+
+from drone_recon.models import Session, Trial, Strategy, SubmissionArchive
+from drone_recon.submission_archive import readArchive
+from drone_recon.submissions import resolveStimuli, buildTrials, mergeConfidence, buildStrategies
+from drone_recon.trial_blocks import writeTrialBlock
+from drone_recon.global_variables import TRIAL_BLOCKS
+
+
+# Order the posts of a session are derived in: a one-shot submission, the chunks, then the seal
+KIND_ORDER = {'submission': 0, 'chunk': 1, 'seal': 2}
+
+
+def deriveSession(session):
+    """Builds the trials and strategy reports of a session from its archived posts.
+
+    Args:
+        session (Session): the session
+
+    Raises:
+        ValueError: the session has no archives, an archive is damaged, or the posts can't be recorded
+            (see submissions.recordGameSubmission)
+
+    Returns:
+        list, list: TrialRecord and unsaved Strategy objects
+    """
+    archives = sorted(SubmissionArchive.objects.filter(session=session),
+                      key=lambda archive: (KIND_ORDER[archive.kind], archive.sequence or 0, archive.id))
+    if len(archives) == 0:
+        raise ValueError(f'Session {session.id} has no archived posts')
+    payloads = [readArchive(archive) for archive in archives]
+    classification_trials, confidence_trials = [], []
+    strategy_free_trials, strategy_radio_trials = [], []
+    for payload in payloads:
+        classification_trials.extend(payload.get('classification_trials', []))
+        confidence_trials.extend(payload.get('confidence_trials', []))
+        if 'strategy_free' in payload:
+            strategy_free_trials, strategy_radio_trials = payload['strategy_free']['trials'], payload['strategy_radio']['trials']
+    stimulus_ids = resolveStimuli(classification_trials + confidence_trials)
+    trials = buildTrials(classification_trials, stimulus_ids)
+    if len(mergeConfidence(trials, confidence_trials, stimulus_ids)) > 0:
+        raise ValueError(f'Session {session.id} has confidence trials without a classification trial')
+    return list(trials.values()), buildStrategies(session, strategy_free_trials, strategy_radio_trials)
+
+
+def reprocessSession(session_id):
+    """Derives the rows of a session again and swaps them in, in one transaction.
+
+    Args:
+        session_id (int): id of the session
+
+    Raises:
+        ValueError: see deriveSession. The old rows are kept.
+
+    Returns:
+        int: number of trials
+    """
+    session = Session.objects.get(id=session_id)
+    trials, strategies = deriveSession(session)
+    with transaction.atomic():
+        # Lock the session, so concurrent reprocessing of the same session is serialized
+        list(Session.objects.select_for_update().filter(id=session_id).only('id'))
+        Trial.objects.filter(session_id=session_id).delete()
+        Strategy.objects.filter(session_id=session_id).delete()
+        Trial.objects.bulk_create([record.toTrial(session) for record in trials], batch_size=500)
+        Strategy.objects.bulk_create(strategies)
+        if TRIAL_BLOCKS:
+            writeTrialBlock(session_id)
+    return len(trials)
+
+
+def initWorker():
+    """Sets up Django in a pool process, which is only needed when processes are spawned rather than forked,
+    and drops the database connections inherited from the parent.
+    """
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+def reprocessWorker(session_id):
+    """Reprocesses a session in a pool process.
+
+    Returns:
+        int, int, str: session id, number of trials, and the error or ''
+    """
+    try:
+        return session_id, reprocessSession(session_id), ''
+    except Exception as e:
+        logging.exception('Reprocessing session %s failed', session_id)
+        return session_id, 0, repr(e)
+
+
+def reprocessSessions(session_ids, max_workers=4, progress=None):
+    """Reprocesses sessions over a process pool.
+
+    Args:
+        session_ids (list): ids of the sessions
+        max_workers (int, optional): number of processes. 1 runs in this process. Defaults to 4.
+        progress (function, optional): called with (session id, number of trials, error) as each session
+            finishes. Defaults to None.
+
+    Returns:
+        dict: 'sessions', 'trials' and 'seconds', and 'failed', session id -> error
+    """
+    start_time = time.time()
+    n_sessions, n_trials, failed = 0, 0, {}
+    if max_workers <= 1:
+        results = (reprocessWorker(session_id) for session_id in session_ids)
+    else:
+        # The children must not share the parent's database connections
+        connections.close_all()
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=initWorker)
+        futures = [executor.submit(reprocessWorker, session_id) for session_id in session_ids]
+        results = (future.result() for future in as_completed(futures))
+    try:
+        for session_id, session_trials, error in results:
+            if error:
+                failed[session_id] = error
+            else:
+                n_sessions += 1
+                n_trials += session_trials
+            if progress is not None:
+                progress(session_id, session_trials, error)
+    finally:
+        if max_workers > 1:
+            executor.shutdown()
+    return {'sessions': n_sessions, 'trials': n_trials, 'failed': failed, 'seconds': time.time() - start_time}
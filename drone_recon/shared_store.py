@@ -0,0 +1,329 @@
+'''
+Read-only store of serialized values shared by all the worker processes on a machine through a
+memory-mapped file. Used for the game configuration and the questionnaire schemas, so that gunicorn
+workers map the values built by whichever worker got there first, instead of each building its own.
+
+Values are bytes stored under string keys. A store is a data file, named after the hash of its contents,
+and a pointer file holding that name. Data files are never modified: adding a value writes a new data file
+and swaps the pointer to it with os.replace, so readers always see a complete store. Readers check the
+pointer at most once per check_interval, and keep serving the file they have mapped in between.
+
+The pointer file name includes a code stamp, a hash of the source files, so a redeploy starts from an
+empty store. invalidate() removes the pointer and starts a new generation, written to a generation file,
+e.g. when the stimulus catalog changes. A process that sees the generation change runs the callbacks
+registered with onInvalidate to drop anything it cached from the old values. A value built from data that
+may be stale is published with the generation read before building it (see currentGeneration), and is
+dropped if the store was invalidated in between, so it can't outlive the invalidation.
+
+'''
+
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from secrets import token_hex
+
+try:
+    import fcntl
+except ImportError:
+    # Windows. Concurrent publishes may then drop each other's values, which are rebuilt on the next miss.
+    fcntl = None
+
+from drone_recon.global_variables import SHARED_STORE_DIR
+
+
+# Magic bytes, format version and header length, followed by the JSON header and the values
+FILE_HEADER = struct.Struct('<4sII')
+MAGIC = b'DRSS'
+FORMAT_VERSION = 1
+# Data files that are no longer current are removed after this long. Processes that still have them
+# mapped keep their mapping.
+STALE_FILE_SECONDS = 600
+
+
+def codeStamp(directory=None):
+    """Hashes the Python and JSON files of a package, so stores built by different code are kept apart.
+
+    Args:
+        directory (str, optional): package folder. Defaults to the drone_recon folder.
+
+    Returns:
+        str: 16 character hex stamp
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(directory, '*.py')) + glob.glob(os.path.join(directory, '*.json'))):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class SharedStore:
+    """Memory-mapped key-value store shared between processes. Safe to use from several threads.
+
+    Args:
+        name (str): name of the store, used for its file names
+        directory (str): folder for the store files. It is created if needed.
+        code_stamp (str, optional): see codeStamp. Defaults to ''.
+        check_interval (float, optional): seconds between checks of the pointer file. Defaults to 1.0.
+    """
+    def __init__(self, name, directory, code_stamp='', check_interval=1.0):
+        self.name = name
+        self.directory = directory
+        self.pointer_path = os.path.join(directory, f'{name}-{code_stamp}.current')
+        self.generation_path = os.path.join(directory, f'{name}-{code_stamp}.generation')
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.callbacks = []
+        # (data file name, mmap, header) of the mapped data file, or None
+        self.mapped = None
+        self.generation = None
+        self.checked = None
+
+    def onInvalidate(self, callback):
+        """Registers a function to call when another process invalidates the store.
+
+        Args:
+            callback (function): called without arguments
+        """
+        self.callbacks.append(callback)
+
+    def _readFile(self, path):
+        try:
+            with open(path) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _map(self, file_name):
+        """Maps a data file.
+
+        Returns:
+            tuple: (file name, mmap, header), or None if the file is gone, truncated or not a store
+        """
+        try:
+            with open(os.path.join(self.directory, file_name), 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            magic, version, header_length = FILE_HEADER.unpack_from(mapping, 0)
+            if (magic != MAGIC) or (version != FORMAT_VERSION):
+                raise ValueError(f'{file_name} is not a store')
+            header = json.loads(mapping[FILE_HEADER.size:FILE_HEADER.size + header_length])
+            header['start'] = FILE_HEADER.size + header_length
+            if any(header['start'] + offset + length > len(mapping)
+                   for offset, length, _ in header['entries'].values()):
+                raise ValueError(f'{file_name} is truncated')
+        except (struct.error, ValueError, KeyError):
+            mapping.close()
+            return None
+        return file_name, mapping, header
+
+    def _refresh(self, force=False):
+        """Maps the current data file if the pointer has moved. Call with the lock held.
+
+        Returns:
+            bool: whether another process invalidated the store, so the callbacks should run
+        """
+        now = time.monotonic()
+        if (not force) and (self.checked is not None) and (now - self.checked < self.check_interval):
+            return False
+        first_check = self.checked is None
+        self.checked = now
+        generation = self._readFile(self.generation_path)
+        file_name = self._readFile(self.pointer_path)
+        if (generation == self.generation) and (file_name == (self.mapped[0] if self.mapped is not None else None)):
+            return False
+        # The old mapping is unmapped once nothing refers to it. Values are only copied out under the lock.
+        self.mapped = self._map(file_name) if file_name is not None else None
+        if (self.mapped is not None) and (self.mapped[2]['generation'] != generation):
+            self.mapped = None
+        previous, self.generation = self.generation, generation
+        return (not first_check) and (generation != previous)
+
+    def _runCallbacks(self):
+        # Called without the lock held, as the callbacks may take locks of their own
+        for callback in self.callbacks:
+            callback()
+
+    def get(self, key):
+        """Gets a value.
+
+        Args:
+            key (str): key of the value
+
+        Returns:
+            bytes, str: the value and its SHA-256 digest, or None, None if it isn't in the store
+        """
+        value, digest = None, None
+        with self.lock:
+            invalidated = self._refresh()
+            entry = self.mapped[2]['entries'].get(key) if self.mapped is not None else None
+            if entry is not None:
+                offset, length, digest = entry
+                start = self.mapped[2]['start'] + offset
+                value = self.mapped[1][start:start + length]
+        if invalidated:
+            self._runCallbacks()
+        return value, digest
+
+    def getJSON(self, key):
+        """Gets a value stored with publishJSON.
+
+        Args:
+            key (str): key of the value
+
+        Returns:
+            decoded JSON, or None if it isn't in the store
+        """
+        value, _ = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def currentGeneration(self):
+        """Gets the generation of the store, starting one if there is none. Runs the callbacks first if
+        another process invalidated the store, so caches built after this call are from the current data. A
+        value built from them is published with this generation.
+
+        Returns:
+            str: the generation
+        """
+        with self.lock:
+            invalidated = self._refresh(force=True)
+            generation = self.generation
+        if generation is None:
+            with self._fileLock(), self.lock:
+                invalidated = self._refresh(force=True) or invalidated
+                if self.generation is None:
+                    self.generation = token_hex(8)
+                    self._writeAtomic(self.generation_path, self.generation.encode())
+                generation = self.generation
+        if invalidated:
+            self._runCallbacks()
+        return generation
+
+    def _fileLock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(self.pointer_path + '.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def publish(self, key, value, generation=None):
+        """Adds or replaces a value, by writing a new data file and swapping the pointer to it.
+
+        Args:
+            key (str): key of the value
+            value (bytes): the value
+            generation (str, optional): generation the value was built in, see currentGeneration. The value
+                is not published if the store was invalidated since. Defaults to None, to publish it in any
+                generation.
+
+        Returns:
+            str: SHA-256 digest of the value
+        """
+        digest = hashlib.sha256(value).hexdigest()
+        with self._fileLock(), self.lock:
+            invalidated = self._refresh(force=True)
+            # A value built in an older generation may be from stale data. It is served to its caller but
+            # not shared.
+            if (generation is None) or (generation == self.generation):
+                self._writeData(key, value)
+        if invalidated:
+            self._runCallbacks()
+        return digest
+
+    def _writeData(self, key, value):
+        """Writes a data file with a value added to the current ones, and swaps the pointer to it. Call with
+        the file lock and the lock held, after a forced refresh.
+        """
+        if self.generation is None:
+            self.generation = token_hex(8)
+            self._writeAtomic(self.generation_path, self.generation.encode())
+        values = {}
+        if self.mapped is not None:
+            start = self.mapped[2]['start']
+            for other_key, (offset, length, _) in self.mapped[2]['entries'].items():
+                values[other_key] = self.mapped[1][start + offset:start + offset + length]
+        values[key] = value
+        entries, offset = {}, 0
+        for entry_key, entry_value in values.items():
+            entries[entry_key] = [offset, len(entry_value), hashlib.sha256(entry_value).hexdigest()]
+            offset += len(entry_value)
+        header = json.dumps({'generation': self.generation, 'entries': entries}).encode()
+        data = FILE_HEADER.pack(MAGIC, FORMAT_VERSION, len(header)) + header + b''.join(values.values())
+        file_name = f'{self.name}-{hashlib.sha256(data).hexdigest()[:16]}.bin'
+        self._writeAtomic(os.path.join(self.directory, file_name), data)
+        self._writeAtomic(self.pointer_path, file_name.encode())
+        self._refresh(force=True)
+        self._removeStaleFiles(file_name)
+
+    def publishJSON(self, key, value, generation=None):
+        """Adds or replaces a JSON-serializable value.
+
+        Args:
+            key (str): key of the value
+            value: the value
+            generation (str, optional): see publish. Defaults to None.
+
+        Returns:
+            str: SHA-256 digest of the serialized value
+        """
+        return self.publish(key, json.dumps(value, separators=(',', ':')).encode(), generation=generation)
+
+    def invalidate(self):
+        """Removes the pointer and starts a new generation, so every process drops the stored values. Does not
+        run this process's callbacks.
+        """
+        with self._fileLock(), self.lock:
+            generation = token_hex(8)
+            self._writeAtomic(self.generation_path, generation.encode())
+            try:
+                os.remove(self.pointer_path)
+            except FileNotFoundError:
+                pass
+            self.mapped = None
+            self.generation = generation
+            self.checked = time.monotonic()
+
+    def _writeAtomic(self, path, data):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _removeStaleFiles(self, current):
+        for path in glob.glob(os.path.join(self.directory, f'{self.name}-*.bin')):
+            if os.path.basename(path) == current:
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) > STALE_FILE_SECONDS:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_SHARED_STORE = None
+_SHARED_STORE_LOCK = threading.Lock()
+
+
+def getSharedStore():
+    """Gets this process's handle on the shared store, in SHARED_STORE_DIR.
+
+    Returns:
+        SharedStore: the store
+    """
+    global _SHARED_STORE
+    if _SHARED_STORE is None:
+        with _SHARED_STORE_LOCK:
+            if _SHARED_STORE is None:
+                _SHARED_STORE = SharedStore('drone_recon', SHARED_STORE_DIR, code_stamp=codeStamp())
+    return _SHARED_STORE
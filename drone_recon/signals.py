@@ -0,0 +1,31 @@
+'''
+Signal handlers that keep the in-process caches in line with the database.
+
+'''
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from drone_recon.models import Stimulus, StimulusVariant
+from drone_recon.functions import invalidateStimulusManifest
+from drone_recon.ingestion import deferStimulusChange
+from drone_recon.shared_store import getSharedStore
+
+
+@receiver(post_save, sender=Stimulus)
+@receiver(post_delete, sender=Stimulus)
+@receiver(post_save, sender=StimulusVariant)
+@receiver(post_delete, sender=StimulusVariant)
+def stimulusChanged(sender, **kwargs):
+    """Clears the cached stimulus URLs and manifests whenever a Stimulus or StimulusVariant row is saved or deleted.
+    The shared store is invalidated too, so the other workers drop theirs. Within ingestion.bulkStimulusChanges,
+    this is done once at the end instead.
+
+    Args:
+        sender (models.Model): the Stimulus or StimulusVariant model class
+    """
+    if deferStimulusChange():
+        return
+    Stimulus.objects.clearURLCache()
+    invalidateStimulusManifest()
+    getSharedStore().invalidate()
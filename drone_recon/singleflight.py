@@ -0,0 +1,147 @@
+'''
+Request coalescing for expensive builds, such as the stimulus manifests, game configurations and
+questionnaire schemas.
+
+When many requests need the same value on a cold worker, only the first one builds it. The others wait
+for that build and share its result. A build that fails raises its exception in every caller waiting on
+it, and nothing is remembered, so the next call tries again. Coalescing is per key, so builds of
+different keys (e.g. different task versions) run concurrently.
+
+Each SingleFlight counts its cache hits, waits, builds and failures, and times its builds. The counts
+of every instance are available from singleFlightStats, and the health view reports them.
+
+'''
+
+import logging
+import threading
+import time
+
+
+class Flight:
+    """A build in progress that other callers can wait on.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent builds of the same key. Safe to use from several threads.
+
+    Args:
+        name (str): name used in the logs and statistics
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = {'hits': 0, 'waits': 0, 'builds': 0, 'failures': 0, 'build_seconds': 0.0,
+                      'max_build_seconds': 0.0}
+
+    def do(self, key, build):
+        """Builds the value of a key, or waits for the build already in progress and returns its result.
+
+        Args:
+            key (hashable): what is being built
+            build (function): called without arguments to build the value
+
+        Raises:
+            Exception: whatever the build raised, in the caller that ran it and in every caller waiting on it
+
+        Returns:
+            the value
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+            else:
+                self.stats['waits'] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        start_time = time.perf_counter()
+        try:
+            flight.result = build()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            build_seconds = time.perf_counter() - start_time
+            with self.lock:
+                del self.flights[key]
+                self.stats['failures' if flight.error is not None else 'builds'] += 1
+                self.stats['build_seconds'] += build_seconds
+                self.stats['max_build_seconds'] = max(self.stats['max_build_seconds'], build_seconds)
+            flight.done.set()
+            logging.info(f'{self.name}: built {key} in {build_seconds:.3f} s' +
+                         (' (failed)' if flight.error is not None else ''))
+        return flight.result
+
+    def get(self, key, lookup, build):
+        """Gets a cached value, or builds it with do() on a miss.
+
+        Args:
+            key (hashable): what is being looked up
+            lookup (function): called without arguments, returns the cached value or None
+            build (function): called without arguments to build the value. It should also cache it.
+
+        Returns:
+            the value
+        """
+        value = lookup()
+        if value is not None:
+            with self.lock:
+                self.stats['hits'] += 1
+            return value
+
+        def buildIfMissing():
+            # A build may have finished between the lookup and now
+            value = lookup()
+            return value if value is not None else build()
+
+        return self.do(key, buildIfMissing)
+
+    def statistics(self):
+        """Gets the counts and timings.
+
+        Returns:
+            dict: hits, waits, builds, failures, build_seconds, max_build_seconds and in_flight
+        """
+        with self.lock:
+            return dict(self.stats, in_flight=len(self.flights))
+
+
+_SINGLE_FLIGHTS = {}
+_SINGLE_FLIGHTS_LOCK = threading.Lock()
+
+
+def getSingleFlight(name):
+    """Gets the SingleFlight with a name, creating it on first use.
+
+    Args:
+        name (str): e.g. 'stimulus_manifest'
+
+    Returns:
+        SingleFlight: the instance, shared by everything in the process that uses the name
+    """
+    with _SINGLE_FLIGHTS_LOCK:
+        if name not in _SINGLE_FLIGHTS:
+            _SINGLE_FLIGHTS[name] = SingleFlight(name)
+        return _SINGLE_FLIGHTS[name]
+
+
+def singleFlightStats():
+    """Gets the statistics of every SingleFlight in this process.
+
+    Returns:
+        dict: name -> statistics, see SingleFlight.statistics
+    """
+    with _SINGLE_FLIGHTS_LOCK:
+        single_flights = list(_SINGLE_FLIGHTS.values())
+    return {single_flight.name: single_flight.statistics() for single_flight in single_flights}
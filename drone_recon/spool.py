@@ -0,0 +1,337 @@
+'''
+Durable local spool for the trial data the game page posts, so a participant isn't kept waiting on the
+database. With TRIAL_SPOOL on, the game POST, chunk and seal views append the raw request body to the spool
+and answer right away. A worker then records the spooled posts with drone_recon.submissions.
+
+The spool is a SQLite file in TRIAL_SPOOL_DIR, written with synchronous=FULL so an acknowledged post
+survives a crash. Every process on the machine appends to the same file. It is in WAL mode, so the folder
+must be on a local disk, not a network file system (see TRIAL_SPOOL_DIR). Entries are recorded in the order
+they arrived. An entry waits while an earlier entry of the same session is unfinished, so a session's chunks
+are recorded before its seal.
+
+A failed entry is retried with a growing delay, up to MAX_ATTEMPTS times. Errors in the data itself
+(ValueError, e.g. an unknown stimulus) are not retried. Entries that give up stay in the spool with status
+'failed' and their error, for inspection and for processtrialspool --retry-failed. An entry claimed by a
+worker that died is claimed again after LEASE_SECONDS.
+
+The worker is either the processtrialspool management command, or, with TRIAL_SPOOL_WORKER on, a
+background thread in each web process that drains the spool after it appends to it.
+
+'''
+
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.db import close_old_connections
+
+from drone_recon.global_variables import TRIAL_SPOOL_DIR
+from drone_recon.submissions import recordGameSubmission, recordTrialChunk, sealGameSubmission
+from drone_recon.wire_format import readJSONStream, decodeTrialPayload
+from drone_recon.submission_schema import validateSubmission
+
+
+MAX_ATTEMPTS = 8
+# Seconds before the first retry. It doubles with each attempt, up to MAX_RETRY_DELAY.
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 600
+LEASE_SECONDS = 300
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    session_id INTEGER NOT NULL,
+    trial_format INTEGER NOT NULL,
+    content_encoding TEXT NOT NULL,
+    body BLOB NOT NULL,
+    received REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    error TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS spool_status ON spool (status, next_attempt);
+CREATE INDEX IF NOT EXISTS spool_session ON spool (session_id, status);
+'''
+
+
+class RetryLater(Exception):
+    """Raised by a handler when the entry can't be recorded yet, e.g. a seal whose chunks haven't arrived."""
+    pass
+
+
+def recordSubmission(session_id, payload):
+    recordGameSubmission(session_id, {'trials': payload['classification_trials']},
+                         {'trials': payload['confidence_trials']}, payload['strategy_free'],
+                         payload['strategy_radio'])
+
+
+def recordChunk(session_id, payload):
+    recordTrialChunk(session_id, int(payload['sequence']), str(payload['idempotency_key']),
+                     payload['classification_trials'], payload['confidence_trials'])
+
+
+def recordSeal(session_id, payload):
+    missing = sealGameSubmission(session_id, int(payload['n_chunks']), payload['strategy_free'],
+                                 payload['strategy_radio'])
+    if len(missing) > 0:
+        raise RetryLater(f'Chunks {missing} of session {session_id} have not been recorded')
+
+
+# Kind of entry -> function recording its decoded payload
+HANDLERS = {
+    'submission': recordSubmission,
+    'chunk': recordChunk,
+    'seal': recordSeal,
+}
+
+
+class TrialSpool:
+    """Append-only queue of posted trial data in a SQLite file. Safe to use from several threads and processes.
+
+    Args:
+        path (str): the SQLite file. Its folder is created if needed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            if connection.execute('PRAGMA journal_mode=WAL').fetchone()[0] != 'wal':
+                logging.warning('The trial spool %s is not in WAL mode. Is TRIAL_SPOOL_DIR on a local disk?', self.path)
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    def append(self, kind, session_id, body, trial_format=0, content_encoding=''):
+        """Adds a post to the spool. It is on disk when this returns.
+
+        Args:
+            kind (str): 'submission', 'chunk' or 'seal', see HANDLERS
+            session_id (int): id of the session
+            body (bytes): the request body
+            trial_format (int, optional): its wire format, see wire_format.py. Defaults to 0.
+            content_encoding (str, optional): 'gzip' or ''. Defaults to ''.
+
+        Returns:
+            int: id of the entry
+        """
+        if kind not in HANDLERS:
+            raise ValueError(f'Unknown spool entry kind {kind}')
+        now = time.time()
+        cursor = self._connect().execute(
+            'INSERT INTO spool (kind, session_id, trial_format, content_encoding, body, received, next_attempt) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (kind, int(session_id), int(trial_format), content_encoding, sqlite3.Binary(body), now, now))
+        return cursor.lastrowid
+
+    def claim(self, limit=10):
+        """Claims the entries that are due, skipping those of sessions with an earlier unfinished entry.
+
+        Args:
+            limit (int, optional): most entries to claim. Defaults to 10.
+
+        Returns:
+            list: (id, kind, session_id, trial_format, content_encoding, body, attempts) tuples, oldest first
+        """
+        connection = self._connect()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Entries of a worker that died go back to the queue
+            connection.execute("UPDATE spool SET status = 'pending' WHERE status = 'processing' AND next_attempt < ?",
+                               (now - LEASE_SECONDS,))
+            entries = connection.execute(
+                "SELECT id, kind, session_id, trial_format, content_encoding, body, attempts FROM spool AS entry "
+                "WHERE status = 'pending' AND next_attempt <= ? AND NOT EXISTS ("
+                "    SELECT 1 FROM spool AS earlier WHERE earlier.session_id = entry.session_id "
+                "    AND earlier.id < entry.id AND earlier.status IN ('pending', 'processing')) "
+                "ORDER BY id LIMIT ?", (now, limit)).fetchall()
+            connection.executemany("UPDATE spool SET status = 'processing', next_attempt = ? WHERE id = ?",
+                                   [(now, entry[0]) for entry in entries])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return entries
+
+    def complete(self, entry_id):
+        """Removes a recorded entry.
+
+        Args:
+            entry_id (int): id of the entry
+        """
+        self._connect().execute('DELETE FROM spool WHERE id = ?', (entry_id,))
+
+    def fail(self, entry_id, error, retry_in=None):
+        """Records a failed attempt. The entry is tried again after retry_in seconds, or given up.
+
+        Args:
+            entry_id (int): id of the entry
+            error (str): what went wrong
+            retry_in (float, optional): seconds before the next attempt, or None to give up. Defaults to None.
+        """
+        if retry_in is None:
+            self._connect().execute("UPDATE spool SET status = 'failed', attempts = attempts + 1, error = ? WHERE id = ?",
+                                    (error, entry_id))
+        else:
+            self._connect().execute(
+                "UPDATE spool SET status = 'pending', attempts = attempts + 1, error = ?, next_attempt = ? WHERE id = ?",
+                (error, time.time() + retry_in, entry_id))
+
+    def retryFailed(self):
+        """Puts the entries that were given up back in the queue, with their attempts reset.
+
+        Returns:
+            int: number of entries
+        """
+        cursor = self._connect().execute(
+            "UPDATE spool SET status = 'pending', attempts = 0, next_attempt = ? WHERE status = 'failed'", (time.time(),))
+        return cursor.rowcount
+
+    def statistics(self):
+        """Counts the entries by status.
+
+        Returns:
+            dict: status -> number of entries, and the age in seconds of the oldest pending entry
+        """
+        connection = self._connect()
+        counts = dict(connection.execute('SELECT status, COUNT(*) FROM spool GROUP BY status').fetchall())
+        oldest = connection.execute("SELECT MIN(received) FROM spool WHERE status != 'failed'").fetchone()[0]
+        counts['oldest_seconds'] = 0 if oldest is None else time.time() - oldest
+        return counts
+
+
+def processEntry(entry):
+    """Records a spooled post.
+
+    Args:
+        entry (tuple): see TrialSpool.claim
+
+    Raises:
+        ValueError: the post doesn't follow its schema or can't be recorded, see drone_recon.submissions
+        RetryLater: the post can't be recorded yet
+    """
+    _, kind, session_id, trial_format, content_encoding, body, _ = entry
+    payload = decodeTrialPayload(readJSONStream(io.BytesIO(body), content_encoding), trial_format)
+    # Posts are checked before they are spooled, but entries spooled by an older version may not have been
+    validateSubmission(kind, payload)
+    HANDLERS[kind](session_id, payload)
+
+
+def processSpool(spool=None, limit=100):
+    """Records the entries of the spool that are due.
+
+    Args:
+        spool (TrialSpool, optional): Defaults to the spool in TRIAL_SPOOL_DIR.
+        limit (int, optional): most entries to process. Defaults to 100.
+
+    Returns:
+        int, int: number of entries recorded, and number that failed
+    """
+    if spool is None:
+        spool = getTrialSpool()
+    n_recorded, n_failed = 0, 0
+    while n_recorded + n_failed < limit:
+        entries = spool.claim(min(10, limit - n_recorded - n_failed))
+        if len(entries) == 0:
+            break
+        for entry in entries:
+            entry_id, attempts = entry[0], entry[-1]
+            try:
+                processEntry(entry)
+            except (ValueError, KeyError, TypeError) as e:
+                logging.exception('Spooled entry %s can not be recorded', entry_id)
+                spool.fail(entry_id, repr(e))
+                n_failed += 1
+            except Exception as e:
+                if not isinstance(e, RetryLater):
+                    logging.exception('Spooled entry %s failed on attempt %s', entry_id, attempts + 1)
+                    # A broken connection is replaced on the next query
+                    close_old_connections()
+                retry_in = None if attempts + 1 >= MAX_ATTEMPTS else min(RETRY_DELAY * 2 ** attempts, MAX_RETRY_DELAY)
+                spool.fail(entry_id, repr(e), retry_in=retry_in)
+                n_failed += 1
+            else:
+                spool.complete(entry_id)
+                n_recorded += 1
+    return n_recorded, n_failed
+
+
+class SpoolWorker(threading.Thread):
+    """Background thread that drains the spool, started by wake() after a post is spooled. It stops once
+    nothing is due, and checks again every poll_interval seconds while entries wait for a retry.
+
+    Args:
+        spool (TrialSpool): the spool
+        poll_interval (float, optional): seconds between checks. Defaults to 5.0.
+    """
+    def __init__(self, spool, poll_interval=5.0):
+        super().__init__(name='trial-spool-worker', daemon=True)
+        self.spool = spool
+        self.poll_interval = poll_interval
+        self.woken = threading.Event()
+        self.stopped = False
+
+    def wake(self):
+        self.woken.set()
+
+    def run(self):
+        try:
+            while True:
+                self.woken.clear()
+                try:
+                    processSpool(self.spool)
+                except Exception:
+                    logging.exception('Trial spool worker failed')
+                statistics = self.spool.statistics()
+                if statistics.get('pending', 0) + statistics.get('processing', 0) == 0:
+                    # Stop unless a post was spooled since the check. wakeSpoolWorker starts a new thread after.
+                    with _TRIAL_SPOOL_LOCK:
+                        if not self.woken.is_set():
+                            self.stopped = True
+                            break
+                    continue
+                self.woken.wait(self.poll_interval)
+        finally:
+            close_old_connections()
+
+
+_TRIAL_SPOOL = None
+_SPOOL_WORKER = None
+_TRIAL_SPOOL_LOCK = threading.Lock()
+
+
+def getTrialSpool():
+    """Gets this process's handle on the spool in TRIAL_SPOOL_DIR.
+
+    Returns:
+        TrialSpool: the spool
+    """
+    global _TRIAL_SPOOL
+    if _TRIAL_SPOOL is None:
+        with _TRIAL_SPOOL_LOCK:
+            if _TRIAL_SPOOL is None:
+                _TRIAL_SPOOL = TrialSpool(os.path.join(TRIAL_SPOOL_DIR, 'trials.sqlite3'))
+    return _TRIAL_SPOOL
+
+
+def wakeSpoolWorker():
+    """Starts this process's spool worker thread, or wakes it if it is running.
+    """
+    global _SPOOL_WORKER
+    with _TRIAL_SPOOL_LOCK:
+        if (_SPOOL_WORKER is None) or _SPOOL_WORKER.stopped or (not _SPOOL_WORKER.is_alive()):
+            _SPOOL_WORKER = SpoolWorker(getTrialSpool())
+            _SPOOL_WORKER.start()
+        else:
+            _SPOOL_WORKER.wake()
@@ -0,0 +1,146 @@
+'''
+Packs every image the game page preloads into a single immutable file, so a participant downloads them
+in one request instead of one per image.
+
+A bundle is the bytes of the images one after the other. Its index lists the original URL, byte offset,
+length and MIME type of each image, and the game page slices the bundle into object URLs with it (see
+loadStimulusBundle in static/js/functions.js). The bundle is named after the SHA-256 of its contents,
+so its URL changes whenever an image does and it can be cached indefinitely.
+
+Bundles are built from the stimulus manifest (see functions.buildStimulusManifest) and stored next to the
+images. A small index file, named after the hash of the manifest's URL list, is stored with each bundle,
+so a worker that starts up only has to read that file to find an existing bundle. Stored images never
+change in place (a changed image is saved under a new name), so the same URLs always mean the same bundle.
+The buildstimulusbundle management command builds the bundle ahead of time, e.g. at deployment.
+
+The page fetches the bundle with fetch(), so when the images are served from another origin (e.g. Azure
+blob storage), the container needs a CORS rule for the site. If the bundle can't be loaded, the page falls
+back to preloading the images one by one.
+
+'''
+
+import hashlib
+import json
+import logging
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.base import ContentFile
+
+from drone_recon.models import Stimulus, StimulusVariant
+
+
+BUNDLE_DIR = 'bundles'
+
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+
+def bundleStorage():
+    """Gets the storage the bundles are kept in, which is the stimulus image storage.
+
+    Returns:
+        Storage: Django storage
+    """
+    return Stimulus._meta.get_field('image').storage
+
+
+def manifestImageURLs(manifest):
+    """Lists every image URL in a stimulus manifest, in the order they are first used, without repeats.
+
+    Args:
+        manifest (dict): see functions.buildStimulusManifest
+
+    Returns:
+        list: image URLs
+    """
+    urls = []
+    for trials in ['tutorial_train_stimuli', 'tutorial_test_stimuli', 'train_stimuli', 'test_stimuli']:
+        urls.extend(trial['stimulus'] for trial in manifest[trials])
+    urls.extend(manifest['stim_schematic_urls'])
+    urls.extend(manifest['stim_feedback_urls'])
+    return list(dict.fromkeys(urls))
+
+
+def imagePathsForURLs(urls):
+    """Finds the stored image path behind each image URL, for originals and variants alike. Costs two queries.
+
+    Args:
+        urls (list): image URLs
+
+    Raises:
+        ValueError: some URLs are not stimulus images. All of them are listed.
+
+    Returns:
+        dict: URL -> stored image path
+    """
+    storage = bundleStorage()
+    candidates = set()
+    for url in urls:
+        file_name = url.split('/')[-1]
+        candidates.update(['images/' + file_name, 'images/variants/' + file_name])
+    stored = set(Stimulus.objects.filter(image__in=candidates).values_list('image', flat=True))
+    stored |= set(StimulusVariant.objects.filter(image__in=candidates).values_list('image', flat=True))
+    paths = {storage.url(path): path for path in stored}
+    not_found = [url for url in urls if url not in paths]
+    if len(not_found) > 0:
+        raise ValueError(f'{len(not_found)} bundle images not found in DB: {", ".join(not_found)}')
+    return {url: paths[url] for url in urls}
+
+
+def packStimulusBundle(urls, max_workers=8):
+    """Reads the images and packs them into a bundle.
+
+    Args:
+        urls (list): image URLs, in the order they should be packed
+        max_workers (int, optional): number of threads reading images. Defaults to 8.
+
+    Returns:
+        bytes, list: the bundle, and [url, offset, length, MIME type] for each image
+    """
+    storage = bundleStorage()
+    paths = imagePathsForURLs(urls)
+
+    def read(url):
+        with storage.open(paths[url], 'rb') as f:
+            return f.read()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        images = list(executor.map(read, urls))
+    entries = []
+    offset = 0
+    for url, data in zip(urls, images):
+        mime_type = mimetypes.guess_type(paths[url])[0] or 'application/octet-stream'
+        entries.append([url, offset, len(data), mime_type])
+        offset += len(data)
+    return b''.join(images), entries
+
+
+def getStimulusBundle(manifest, rebuild=False):
+    """Gets the bundle of a stimulus manifest, building and storing it if it doesn't exist yet.
+
+    Args:
+        manifest (dict): see functions.buildStimulusManifest
+        rebuild (bool, optional): pack the images again even if the bundle exists. Defaults to False.
+
+    Returns:
+        dict: 'url' and 'size' of the bundle, and its 'entries', see packStimulusBundle
+    """
+    storage = bundleStorage()
+    urls = manifestImageURLs(manifest)
+    urls_hash = hashlib.sha256('\n'.join(urls).encode()).hexdigest()[:20]
+    index_path = f'{BUNDLE_DIR}/index-{urls_hash}.json'
+    if (not rebuild) and storage.exists(index_path):
+        with storage.open(index_path, 'rb') as f:
+            index = json.loads(f.read())
+        if storage.exists(index['path']):
+            return {'url': storage.url(index['path']), 'size': index['size'], 'entries': index['entries']}
+    data, entries = packStimulusBundle(urls)
+    bundle_path = f'{BUNDLE_DIR}/stimuli-{hashlib.sha256(data).hexdigest()[:20]}.bin'
+    if not storage.exists(bundle_path):
+        bundle_path = storage.save(bundle_path, ContentFile(data))
+    if storage.exists(index_path):
+        storage.delete(index_path)
+    storage.save(index_path, ContentFile(json.dumps({'path': bundle_path, 'size': len(data), 'entries': entries})))
+    logging.info(f'Built stimulus bundle {bundle_path} with {len(entries)} images ({len(data)} bytes)')
+    return {'url': storage.url(bundle_path), 'size': len(data), 'entries': entries}
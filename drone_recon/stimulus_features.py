@@ -0,0 +1,224 @@
+'''
+Stimulus features parsed from the structured stimulus names, stored on the catalog so analyses don't have
+to parse names again.
+
+Two naming schemes are understood:
+    feature names, e.g. '0-A-1_1-B-1_2-C-1_3-D-2_4-E-1_5-A-3_6-B-3_7-C-3_8-D-4_9-E-3': one
+        'position-part-value' triple for each of the FEATURE_WIDTH positions. The feature vector holds the values.
+    distortion names, e.g. 'A_prototype', 'A_d2_3' or 'training_B_d1_1': the category, and the distortion
+        level ('prototype' is level 0, 'd2' is level 2) and exemplar number. These have no feature vector.
+
+Each stimulus records its category ('A' or 'B', as listed in task_versions.json), its feature vector packed
+as FEATURE_WIDTH signed bytes, its distortion level, and its distance to the prototype of each category
+packed as one signed byte per category. For feature names the distances are the number of positions that
+differ from each prototype, and the distortion level is the distance to the prototype of its own category.
+For distortion names only the distance to its own prototype is known. Unknown values are UNKNOWN (-1).
+
+The fields are filled in at ingestion. Stimuli added before this existed, or after the prototypes in
+task_versions.json change, can be updated with the buildstimulusfeatures management command. A name listed
+in several variants with different prototypes takes its distances from the first.
+
+stimulusFeatureArrays and trialFeatureArrays return the fields of many stimuli or trials as NumPy arrays,
+with one query for the stimuli however many trials there are.
+
+'''
+
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from drone_recon.models import Stimulus
+from drone_recon.task_versions import TASK_VERSIONS
+
+
+FEATURE_WIDTH = 10
+CATEGORIES = ('A', 'B')
+UNKNOWN = -1
+FEATURE_FIELDS = ['category', 'features', 'distortion_level', 'prototype_distances']
+
+FEATURE_PART = re.compile(r'^(\d+)-([A-Z])-(\d+)$')
+DISTORTION_NAME = re.compile(r'^(?:training_)?([AB])_(?:prototype|d(\d+)_(\d+))$')
+
+# Parsed stimulus name. features is a tuple of FEATURE_WIDTH values or None, category is '' when the
+# name doesn't give it, distortion_level is None when unknown.
+ParsedName = namedtuple('ParsedName', ['features', 'category', 'distortion_level'])
+
+# Arrays returned by stimulusFeatureArrays, one row per requested stimulus
+FeatureArrays = namedtuple('FeatureArrays', ['stimulus_id', 'category', 'features', 'distortion_level',
+                                             'prototype_distances'])
+
+
+def parseStimulusName(name):
+    """Parses a feature name or a distortion name.
+
+    Args:
+        name (str): stimulus name
+
+    Returns:
+        ParsedName: the parsed name, or None if it follows neither scheme
+    """
+    parts = [FEATURE_PART.match(part) for part in name.split('_')]
+    if (len(parts) == FEATURE_WIDTH) and all(parts) and \
+            all(int(part.group(1)) == position for position, part in enumerate(parts)):
+        return ParsedName(tuple(int(part.group(3)) for part in parts), '', None)
+    match = DISTORTION_NAME.match(name)
+    if match is not None:
+        return ParsedName(None, match.group(1), int(match.group(2) or 0))
+    return None
+
+
+def featureDistance(features, other):
+    """Counts the positions in which two feature vectors differ.
+
+    Args:
+        features (tuple): feature values
+        other (tuple): feature values of the same width
+
+    Returns:
+        int: number of differing positions
+    """
+    return sum(a != b for a, b in zip(features, other))
+
+
+def stimulusCategoryIndex(registry=None):
+    """Finds the category and category prototypes of every stimulus listed in the task version registry.
+
+    Args:
+        registry (dict, optional): see task_versions.loadTaskVersions. Defaults to TASK_VERSIONS.
+
+    Returns:
+        dict: stimulus name -> (category, prototype names or None). The first variant listing a name wins.
+    """
+    if registry is None:
+        registry = TASK_VERSIONS
+    index = {}
+    for kind in ['tutorial', 'task']:
+        for version in sorted(registry[kind]):
+            for trial_set in registry[kind][version].values():
+                for trial in trial_set.train + trial_set.test:
+                    category = CATEGORIES[trial_set.types.index(trial['drone_type'])]
+                    index.setdefault(trial['stimulus'], (category, trial_set.prototypes))
+    return index
+
+
+def stimulusFeatureFields(name, index=None):
+    """Computes the feature fields of a stimulus, for the Stimulus constructor or a bulk_update.
+
+    Args:
+        name (str): stimulus name
+        index (dict, optional): see stimulusCategoryIndex. Defaults to the index of TASK_VERSIONS.
+
+    Returns:
+        dict: category, features, distortion_level and prototype_distances
+    """
+    if index is None:
+        index = stimulusCategoryIndex()
+    parsed = parseStimulusName(name)
+    category, prototypes = index.get(name, ('', None))
+    fields = {'category': category, 'features': None, 'distortion_level': None, 'prototype_distances': None}
+    if parsed is None:
+        return fields
+    category = category or parsed.category
+    fields['category'] = category
+    distances = [UNKNOWN] * len(CATEGORIES)
+    if parsed.features is not None:
+        fields['features'] = np.array(parsed.features, dtype=np.int8).tobytes()
+        prototype_features = [parseStimulusName(prototype) for prototype in (prototypes or [])]
+        for i, prototype in enumerate(prototype_features):
+            if (prototype is not None) and (prototype.features is not None):
+                distances[i] = featureDistance(parsed.features, prototype.features)
+        if (category in CATEGORIES) and (distances[CATEGORIES.index(category)] != UNKNOWN):
+            fields['distortion_level'] = distances[CATEGORIES.index(category)]
+    else:
+        fields['distortion_level'] = parsed.distortion_level
+        distances[CATEGORIES.index(category)] = parsed.distortion_level
+    fields['prototype_distances'] = np.array(distances, dtype=np.int8).tobytes()
+    return fields
+
+
+def buildStimulusFeatures(stimuli=None):
+    """Recomputes the feature fields of stimuli already in the catalog. Only the names are needed, so no
+    images are read.
+
+    Args:
+        stimuli (list, optional): stimuli to update. Defaults to every stimulus.
+
+    Returns:
+        int: number of stimuli whose fields changed
+    """
+    if stimuli is None:
+        stimuli = Stimulus.objects.all()
+    index = stimulusCategoryIndex()
+    changed = []
+    for stimulus in stimuli:
+        fields = stimulusFeatureFields(stimulus.name, index)
+        # BinaryField values read from the DB may be memoryviews
+        current = {field: bytes(value) if isinstance(value, memoryview) else value
+                   for field, value in ((field, getattr(stimulus, field)) for field in FEATURE_FIELDS)}
+        if current != fields:
+            for field, value in fields.items():
+                setattr(stimulus, field, value)
+            changed.append(stimulus)
+    if len(changed) > 0:
+        Stimulus.objects.bulk_update(changed, FEATURE_FIELDS, batch_size=500)
+    return len(changed)
+
+
+def stimulusFeatureArrays(stimulus_ids, chunk_size=500):
+    """Gets the feature fields of stimuli as NumPy arrays, one row per id. Ids may repeat, e.g. one per
+    trial. Costs one query per chunk_size distinct stimuli.
+
+    Args:
+        stimulus_ids (list or np.ndarray): Stimulus ids
+        chunk_size (int, optional): distinct ids per query. Defaults to 500.
+
+    Raises:
+        ValueError: one or more ids are not in the catalog
+
+    Returns:
+        FeatureArrays: stimulus_id (n,) int64, category (n,) '<U1' ('' if unknown), features
+            (n, FEATURE_WIDTH) int8, distortion_level (n,) int8 and prototype_distances (n, len(CATEGORIES))
+            int8. Unknown values are UNKNOWN.
+    """
+    stimulus_ids = np.asarray(stimulus_ids, dtype=np.int64).reshape(-1)
+    unique_ids, inverse = np.unique(stimulus_ids, return_inverse=True)
+    n = len(unique_ids)
+    category = np.full(n, '', dtype='<U1')
+    features = np.full((n, FEATURE_WIDTH), UNKNOWN, dtype=np.int8)
+    distortion_level = np.full(n, UNKNOWN, dtype=np.int8)
+    prototype_distances = np.full((n, len(CATEGORIES)), UNKNOWN, dtype=np.int8)
+    found = np.zeros(n, dtype=bool)
+    for start in range(0, n, chunk_size):
+        rows = Stimulus.objects.filter(id__in=unique_ids[start:start + chunk_size].tolist())\
+            .values_list('id', 'category', 'features', 'distortion_level', 'prototype_distances')
+        for stimulus_id, row_category, row_features, row_level, row_distances in rows:
+            i = np.searchsorted(unique_ids, stimulus_id)
+            found[i] = True
+            category[i] = row_category
+            if row_features is not None:
+                features[i] = np.frombuffer(bytes(row_features), dtype=np.int8)
+            if row_level is not None:
+                distortion_level[i] = row_level
+            if row_distances is not None:
+                prototype_distances[i] = np.frombuffer(bytes(row_distances), dtype=np.int8)
+    if not found.all():
+        raise ValueError(f'{(~found).sum()} stimuli not found in DB: ids {unique_ids[~found].tolist()}')
+    return FeatureArrays(stimulus_ids, category[inverse], features[inverse], distortion_level[inverse],
+                         prototype_distances[inverse])
+
+
+def trialFeatureArrays(trials):
+    """Gets the feature fields of the stimulus of each trial as NumPy arrays, see stimulusFeatureArrays.
+
+    Args:
+        trials (QuerySet or list): Trial queryset, or Trial objects
+
+    Returns:
+        FeatureArrays: one row per trial, in the order of trials
+    """
+    if hasattr(trials, 'values_list'):
+        stimulus_ids = np.fromiter(trials.values_list('stimulus_id', flat=True), dtype=np.int64)
+    else:
+        stimulus_ids = np.array([trial.stimulus_id for trial in trials], dtype=np.int64)
+    return stimulusFeatureArrays(stimulus_ids)
@@ -0,0 +1,119 @@
+'''
+Archive of the trial data posted by the game page, so trials can be derived again from what was sent when
+the derivation changes (e.g. how feedback_given or correct are computed). See drone_recon.reprocessing.
+
+Each recorded post (a whole submission, a chunk or a seal) is stored as the format 0 JSON of its payload,
+gzipped, under a name made from the SHA-256 of the JSON. Posts with the same content share a file. A
+SubmissionArchive row links the file to its session, and is created in the same transaction as the trials,
+so a session's archives are exactly the posts its trials came from. The file is only written once that
+transaction commits, so a post that is rolled back leaves no file behind. The files are kept in their own private
+storage, set by SUBMISSION_ARCHIVE_STORAGE, rather than with the publicly served media files.
+
+'''
+
+import gzip
+import hashlib
+import json
+import logging
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from drone_recon.models import SubmissionArchive
+
+
+ARCHIVE_DIR = 'submissions'
+
+
+def archiveStorage():
+    """Gets the storage the archives are kept in.
+
+    Returns:
+        Storage: Django storage
+    """
+    return SubmissionArchive._meta.get_field('archive').storage
+
+
+def canonicalPayload(payload):
+    """Serializes a payload the same way whatever the order of its keys, for hashing and archiving.
+
+    Args:
+        payload (dict): the payload in format 0, see wire_format.py
+
+    Returns:
+        bytes: compact JSON with sorted keys
+    """
+    return json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()
+
+
+def payloadHash(payload):
+    """Gets the SHA-256 of a payload, the content_hash of its archive.
+
+    Args:
+        payload (dict): the payload in format 0
+
+    Returns:
+        str: hex digest
+    """
+    return hashlib.sha256(canonicalPayload(payload)).hexdigest()
+
+
+def storeArchiveFile(path, compressed):
+    """Writes an archive file, unless a post with the same content was stored before.
+
+    Args:
+        path (str): name of the file in the archive storage
+        compressed (bytes): the gzipped payload
+    """
+    storage = archiveStorage()
+    try:
+        if storage.exists(path):
+            return
+        stored_path = storage.save(path, ContentFile(compressed))
+        if stored_path != path:
+            # Stored under another name because a post with the same content was stored in between
+            storage.delete(stored_path)
+    except Exception:
+        # The trials are committed by now, so the post is still recorded, without its archive
+        logging.exception(f'Could not store the submission archive {path}')
+
+
+def archivePayload(session, kind, payload, sequence=None):
+    """Makes the unsaved SubmissionArchive row of a payload, and stores its file once the transaction
+    commits. Call it inside the transaction that saves the row.
+
+    Args:
+        session (Session): session the post belongs to
+        kind (str): 'submission', 'chunk' or 'seal'
+        payload (dict): the payload in format 0, see wire_format.py
+        sequence (int, optional): number of the chunk. Defaults to None.
+
+    Returns:
+        SubmissionArchive: the row, to save with the trials
+    """
+    data = canonicalPayload(payload)
+    content_hash = hashlib.sha256(data).hexdigest()
+    path = f'{ARCHIVE_DIR}/{content_hash[:2]}/{content_hash}.json.gz'
+    compressed = gzip.compress(data, mtime=0)
+    transaction.on_commit(lambda: storeArchiveFile(path, compressed))
+    return SubmissionArchive(session=session, kind=kind, sequence=sequence, content_hash=content_hash,
+                             byte_size=len(compressed), archive=path)
+
+
+def readArchive(archive):
+    """Reads an archived payload back.
+
+    Args:
+        archive (SubmissionArchive): the row
+
+    Raises:
+        ValueError: the file doesn't match its content hash
+
+    Returns:
+        dict: the payload in format 0
+    """
+    with archiveStorage().open(archive.archive.name, 'rb') as f:
+        data = gzip.decompress(f.read())
+    if hashlib.sha256(data).hexdigest() != archive.content_hash:
+        raise ValueError(f'Archive {archive.archive.name} does not match its content hash')
+    return json.loads(data)
@@ -0,0 +1,250 @@
+'''
+Schema of the trial data the game page posts, checked before anything of a post is saved or spooled.
+
+A schema is written as nested literals:
+    - a dict of key -> schema is an object that must have those keys. Other keys are allowed, since the
+      jsPsych data of a trial holds many more fields than are recorded.
+    - a list of one schema is an array whose items all follow it
+    - {str: schema} is an object of any keys whose values follow the schema
+    - 'string', 'integer', 'number' or 'any' is a value of that kind. ('string', n) is a string of at most n
+      characters. An 'integer' may be sent as an integral float or a string of digits, as int() takes them.
+
+Each schema is compiled twice when the module is imported: compileMatcher makes a predicate that only says
+whether a value follows the schema, and compileSchema a check that lists where it doesn't. A post is
+matched first, which is a walk over its values with no schema lookups or error paths, and only a post that
+doesn't match is checked again for its errors. Checking stops after MAX_ERRORS errors, so a payload that is
+wrong everywhere costs no more than one that is wrong a few times.
+
+validateSubmission checks a decoded post (see drone_recon.wire_format.decodeTrialPayload) and raises
+SubmissionInvalid with the list of errors, each {'path': 'classification_trials[3].rt', 'error': ...}.
+
+'''
+
+import math
+
+
+MAX_ERRORS = 20
+# Longest strategy report saved, the max_length of Strategy.response
+MAX_RESPONSE_LENGTH = 1000
+# The max_length of TrialChunk.idempotency_key
+MAX_KEY_LENGTH = 64
+
+CLASSIFICATION_TRIAL = {
+    'stimulus': 'string',
+    'response': 'any',
+    'correct_response': 'any',
+    'drone_type': 'string',
+    'type_selected': 'string',
+    'rt': 'number',
+    'block': 'string',
+    'trial_index_aligned': 'integer',
+}
+CONFIDENCE_TRIAL = {
+    'stimulus': 'string',
+    'response': 'integer',
+    'rt': 'number',
+    'trial_index_aligned': 'integer',
+}
+STRATEGY_FREE = {'trials': [{'response': {'Q0': ('string', MAX_RESPONSE_LENGTH)}}]}
+STRATEGY_RADIO = {'trials': [{'response': {str: ('string', MAX_RESPONSE_LENGTH)}}]}
+
+# Kind of post -> schema of its payload
+SUBMISSION_SCHEMAS = {
+    'submission': {
+        'classification_trials': [CLASSIFICATION_TRIAL],
+        'confidence_trials': [CONFIDENCE_TRIAL],
+        'strategy_free': STRATEGY_FREE,
+        'strategy_radio': STRATEGY_RADIO,
+    },
+    'chunk': {
+        'sequence': 'integer',
+        'idempotency_key': ('string', MAX_KEY_LENGTH),
+        'classification_trials': [CLASSIFICATION_TRIAL],
+        'confidence_trials': [CONFIDENCE_TRIAL],
+    },
+    # A one-shot submission posted as form fields, each a JSON object with a 'trials' list
+    'submission_form': {
+        'classification_trials': {'trials': [CLASSIFICATION_TRIAL]},
+        'confidence_trials': {'trials': [CONFIDENCE_TRIAL]},
+        'strategy_free': STRATEGY_FREE,
+        'strategy_radio': STRATEGY_RADIO,
+    },
+    'seal': {
+        'n_chunks': 'integer',
+        'strategy_free': STRATEGY_FREE,
+        'strategy_radio': STRATEGY_RADIO,
+    },
+}
+
+
+class SubmissionInvalid(ValueError):
+    """Raised when a post doesn't follow its schema.
+
+    Args:
+        errors (list): {'path', 'error'} dicts, at most MAX_ERRORS
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(f"{error['path']}: {error['error']}" for error in errors))
+
+
+class TooManyErrors(Exception):
+    """Raised inside a check to stop it once MAX_ERRORS errors are found."""
+    pass
+
+
+def addError(errors, path, error):
+    errors.append({'path': path, 'error': error})
+    if len(errors) >= MAX_ERRORS:
+        raise TooManyErrors()
+
+
+def isInteger(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return True
+    if isinstance(value, float):
+        return math.isfinite(value) and value.is_integer()
+    if isinstance(value, str):
+        return value.strip().lstrip('+-').isdigit()
+    return False
+
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and (not isinstance(value, bool)) and math.isfinite(value)
+
+
+def compileMatcher(schema):
+    """Makes the predicate of whether a value follows a schema.
+
+    Args:
+        schema: see the module docstring
+
+    Raises:
+        ValueError: the schema is not valid
+
+    Returns:
+        function: match(value) -> bool
+    """
+    if isinstance(schema, list):
+        match_item = compileMatcher(schema[0])
+        return lambda value: isinstance(value, list) and all(map(match_item, value))
+    if isinstance(schema, dict) and (list(schema) == [str]):
+        match_value = compileMatcher(schema[str])
+        return lambda value: isinstance(value, dict) and all(map(match_value, value.values()))
+    if isinstance(schema, dict):
+        fields = [(key, compileMatcher(field_schema)) for key, field_schema in schema.items()]
+        return lambda value: isinstance(value, dict) and all((key in value) and match_field(value[key])
+                                                             for key, match_field in fields)
+    if isinstance(schema, tuple) and (schema[0] == 'string'):
+        max_length = schema[1]
+        return lambda value: isinstance(value, str) and (len(value) <= max_length)
+    if schema == 'string':
+        return lambda value: isinstance(value, str)
+    if schema == 'integer':
+        return isInteger
+    if schema == 'number':
+        return isNumber
+    if schema == 'any':
+        return lambda value: True
+    raise ValueError(f'Invalid schema {schema!r}')
+
+
+def compileSchema(schema):
+    """Makes the function that checks values against a schema.
+
+    Args:
+        schema: see the module docstring
+
+    Raises:
+        ValueError: the schema is not valid
+
+    Returns:
+        function: check(value, path, errors), which adds an error to errors for each value that doesn't
+            follow the schema
+    """
+    if isinstance(schema, list):
+        check_item = compileSchema(schema[0])
+
+        def checkList(value, path, errors):
+            if not isinstance(value, list):
+                return addError(errors, path, 'expected an array')
+            for i, item in enumerate(value):
+                check_item(item, f'{path}[{i}]', errors)
+        return checkList
+    if isinstance(schema, dict) and (list(schema) == [str]):
+        check_value = compileSchema(schema[str])
+
+        def checkMapping(value, path, errors):
+            if not isinstance(value, dict):
+                return addError(errors, path, 'expected an object')
+            for key, item in value.items():
+                check_value(item, f'{path}.{key}', errors)
+        return checkMapping
+    if isinstance(schema, dict):
+        fields = [(key, compileSchema(field_schema)) for key, field_schema in schema.items()]
+
+        def checkObject(value, path, errors):
+            if not isinstance(value, dict):
+                return addError(errors, path or 'payload', 'expected an object')
+            for key, check_field in fields:
+                field_path = f'{path}.{key}' if path else key
+                if key not in value:
+                    addError(errors, field_path, 'missing')
+                else:
+                    check_field(value[key], field_path, errors)
+        return checkObject
+    if isinstance(schema, tuple) and (schema[0] == 'string'):
+        max_length = schema[1]
+
+        def checkText(value, path, errors):
+            if not isinstance(value, str):
+                addError(errors, path, 'expected a string')
+            elif len(value) > max_length:
+                addError(errors, path, f'longer than {max_length} characters')
+        return checkText
+    if schema == 'string':
+        def checkString(value, path, errors):
+            if not isinstance(value, str):
+                addError(errors, path, 'expected a string')
+        return checkString
+    if schema == 'integer':
+        def checkInteger(value, path, errors):
+            if not isInteger(value):
+                addError(errors, path, 'expected an integer')
+        return checkInteger
+    if schema == 'number':
+        def checkNumber(value, path, errors):
+            if not isNumber(value):
+                addError(errors, path, 'expected a number')
+        return checkNumber
+    if schema == 'any':
+        return lambda value, path, errors: None
+    raise ValueError(f'Invalid schema {schema!r}')
+
+
+# Kind of post -> its compiled predicate and check
+MATCHERS = {kind: compileMatcher(schema) for kind, schema in SUBMISSION_SCHEMAS.items()}
+VALIDATORS = {kind: compileSchema(schema) for kind, schema in SUBMISSION_SCHEMAS.items()}
+
+
+def validateSubmission(kind, payload):
+    """Checks a decoded post against the schema of its kind.
+
+    Args:
+        kind (str): a key of SUBMISSION_SCHEMAS: 'submission', 'submission_form', 'chunk' or 'seal'
+        payload (dict): the post, in wire format 0
+
+    Raises:
+        SubmissionInvalid: the post doesn't follow the schema
+    """
+    if MATCHERS[kind](payload):
+        return
+    errors = []
+    try:
+        VALIDATORS[kind](payload, '', errors)
+    except TooManyErrors:
+        pass
+    if len(errors) > 0:
+        raise SubmissionInvalid(errors)
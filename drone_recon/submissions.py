@@ -0,0 +1,288 @@
+'''
+Recording of the trial data the game page posts.
+
+The classification and confidence trials arrive as jsPsych data lists. They are built into TrialRecords
+(see drone_recon.trial_records) and merged in memory by (stimulus, trial_index_aligned), so each Trial row
+is written once with its confidence rating, and the stimuli of every trial are resolved together. Rows are
+written in one transaction with bulk_create, so a post costs the same small number of queries however many
+trials it has, and a failure leaves nothing half-written.
+
+During the task the page uploads its trials in numbered chunks (recordTrialChunk), after every block and
+every TRIAL_CHUNK_SIZE trials, and seals the session at the end with the strategy reports
+(sealGameSubmission). Each chunk carries a sequence number and an idempotency key, so a chunk that is
+sent again is acknowledged without being saved twice, and the trials of a session that drops out are kept.
+recordGameSubmission saves a whole session posted at once, fingerprinted by the hash of its payload in a
+SubmissionFingerprint row, so a submission that is posted again is acknowledged the same way.
+
+Each post that is recorded is archived with its session (see drone_recon.submission_archive), so the trials
+can be derived again by drone_recon.reprocessing with the same functions. With TRIAL_BLOCKS on, the packed
+trial block of the session (see drone_recon.trial_blocks) is rewritten in the same transaction.
+
+'''
+
+from django.db import transaction, IntegrityError
+
+from drone_recon.models import Session, Stimulus, Trial, Strategy, TrialChunk, SubmissionFingerprint
+from drone_recon.trial_records import TrialRecord, RECORD_FIELDS
+from drone_recon.submission_archive import archivePayload, payloadHash
+from drone_recon.trial_blocks import writeTrialBlock
+from drone_recon.global_variables import TRIAL_BLOCKS
+
+
+def resolveStimuli(trials):
+    """Finds the stimuli of a list of trials with one lookup.
+
+    Args:
+        trials (list): jsPsych data of the trials, with the stimulus URL in 'stimulus'
+
+    Raises:
+        ValueError: a stimulus is not in the DB
+
+    Returns:
+        dict: stimulus URL -> Stimulus id
+    """
+    # The stimulus URLs may point at the original images or at their variants
+    stimulus_ids = Stimulus.objects.findByImageURLs([trial['stimulus'] for trial in trials])
+    for trial in trials:
+        if trial['stimulus'] not in stimulus_ids:
+            raise ValueError(f"Trial stimulus {trial['stimulus']} not found during recording in DB")
+    return stimulus_ids
+
+
+def buildTrials(classification_trials, stimulus_ids):
+    """Builds the records of the classification trials.
+
+    Args:
+        classification_trials (list): jsPsych data of the classification trials
+        stimulus_ids (dict): stimulus URL -> Stimulus id, see resolveStimuli
+
+    Raises:
+        ValueError: two trials have the same stimulus and trial number
+
+    Returns:
+        dict: (stimulus id, trial number) -> TrialRecord, in the order of classification_trials
+    """
+    trials = {}
+    for trial in classification_trials:
+        record = TrialRecord.fromPayload(trial, stimulus_ids[trial['stimulus']])
+        if record.key in trials:
+            raise ValueError(f"Trial {record.key[1]} of stimulus {trial['stimulus']} is posted more than once")
+        trials[record.key] = record
+    return trials
+
+
+def mergeConfidence(trials, confidence_trials, stimulus_ids):
+    """Sets the confidence rating and confidence RT of the trials they were given on.
+
+    Args:
+        trials (dict): (stimulus id, trial number) -> TrialRecord, see buildTrials
+        confidence_trials (list): jsPsych data of the confidence trials
+        stimulus_ids (dict): stimulus URL -> Stimulus id, see resolveStimuli
+
+    Returns:
+        list: the confidence trials whose trial is not in trials
+    """
+    unmatched = []
+    for trial in confidence_trials:
+        record = trials.get((stimulus_ids[trial['stimulus']], int(trial['trial_index_aligned'])))
+        if record is None:
+            unmatched.append(trial)
+            continue
+        record.setConfidence(trial)
+    return unmatched
+
+
+def buildStrategies(session, strategy_free_trials, strategy_radio_trials):
+    """Builds the unsaved Strategy objects of a submission.
+
+    Args:
+        session (Session): session the reports belong to
+        strategy_free_trials (list): jsPsych data of the free response strategy trial
+        strategy_radio_trials (list): jsPsych data of the multiple choice strategy trial
+
+    Returns:
+        list: Strategy objects
+    """
+    strategies = []
+    if len(strategy_free_trials) > 0:
+        strategies.append(Strategy(session=session, prompt='free_response',
+                                   response=strategy_free_trials[0]['response']['Q0']))
+    if len(strategy_radio_trials) > 0:
+        for prompt, response in strategy_radio_trials[0]['response'].items():
+            strategies.append(Strategy(session=session, prompt=prompt, response=response))
+    return strategies
+
+
+def recordGameSubmission(session_id, classification_data, confidence_data, strategy_free_data, strategy_radio_data,
+                         archive=True):
+    """Saves the trials and strategy reports of a session, and marks it completed, in one transaction. The
+    submission is fingerprinted with the hash of its payload, so posting it again, e.g. on a retry or a
+    double click, returns without saving anything.
+
+    Args:
+        session_id (int): id of the session
+        classification_data (dict): posted classification_trials, with a 'trials' list
+        confidence_data (dict): posted confidence_trials, with a 'trials' list
+        strategy_free_data (dict): posted strategy_free, with a 'trials' list
+        strategy_radio_data (dict): posted strategy_radio, with a 'trials' list
+        archive (bool, optional): archive the submission with the session. Defaults to True.
+
+    Raises:
+        ValueError: the session was already submitted with another payload, or its trials were uploaded in
+            chunks, a stimulus is not in the DB, or a confidence trial has no classification trial. Nothing
+            is saved.
+
+    Returns:
+        int, bool: number of trials, and whether they were saved now rather than before
+    """
+    session = Session.objects.filter(id=session_id)[0]
+    classification_trials, confidence_trials = classification_data['trials'], confidence_data['trials']
+    payload = {'classification_trials': classification_trials, 'confidence_trials': confidence_trials,
+               'strategy_free': strategy_free_data, 'strategy_radio': strategy_radio_data}
+    content_hash = payloadHash(payload)
+
+    def previousSubmission():
+        fingerprint = SubmissionFingerprint.objects.filter(session=session).first()
+        if (fingerprint is not None) and (fingerprint.content_hash != content_hash):
+            raise ValueError(f'Session {session_id} was already submitted with other data')
+        return fingerprint
+
+    fingerprint = previousSubmission()
+    if fingerprint is not None:
+        return fingerprint.n_trials, False
+    stimulus_ids = resolveStimuli(classification_trials + confidence_trials)
+    trials = buildTrials(classification_trials, stimulus_ids)
+    if len(mergeConfidence(trials, confidence_trials, stimulus_ids)) > 0:
+        raise ValueError('When syncing confidence rating, trial not found in DB.')
+    strategies = buildStrategies(session, strategy_free_data['trials'], strategy_radio_data['trials'])
+    try:
+        with transaction.atomic():
+            # Locked as sealGameSubmission and recordTrialChunk do. A session whose trials came in chunks has
+            # no fingerprint, so it is refused here rather than having its trials saved again.
+            session = Session.objects.select_for_update().filter(id=session_id)[0]
+            if session.session_completed or TrialChunk.objects.filter(session=session).exists():
+                fingerprint = previousSubmission()
+                if fingerprint is not None:
+                    return fingerprint.n_trials, False
+                raise ValueError(f'Session {session_id} was already recorded from chunks')
+            # Created first, so a concurrent post of the same submission fails here rather than after the trials
+            SubmissionFingerprint.objects.create(session=session, content_hash=content_hash, n_trials=len(trials))
+            Trial.objects.bulk_create([record.toTrial(session) for record in trials.values()], batch_size=500)
+            Strategy.objects.bulk_create(strategies)
+            if archive:
+                archivePayload(session, 'submission', payload).save()
+            if TRIAL_BLOCKS:
+                writeTrialBlock(session.id)
+            # Update the session to reflect that the task is complete
+            session.session_completed = True
+            session.save(update_fields=['session_completed'])
+    except IntegrityError:
+        # The same submission was saved by a concurrent request
+        fingerprint = previousSubmission()
+        if fingerprint is None:
+            raise
+        return fingerprint.n_trials, False
+    return len(trials), True
+
+
+def recordTrialChunk(session_id, sequence, idempotency_key, classification_trials, confidence_trials, archive=True):
+    """Saves a chunk of trials uploaded during the task, in one transaction. A confidence trial whose
+    classification trial came in an earlier chunk is added to the saved trial.
+
+    Args:
+        session_id (int): id of the session
+        sequence (int): number of the chunk in the session, from 0
+        idempotency_key (str): key the page made for the chunk. It is the same when the chunk is sent again.
+        classification_trials (list): jsPsych data of the classification trials
+        confidence_trials (list): jsPsych data of the confidence trials
+        archive (bool, optional): archive the chunk with the session. Defaults to True.
+
+    Raises:
+        ValueError: another chunk was saved with this sequence number, the session was already sealed, a
+            stimulus is not in the DB, or a confidence trial has no classification trial. Nothing is saved.
+
+    Returns:
+        int, bool: number of trials in the chunk, and whether it was saved now rather than before
+    """
+    session = Session.objects.filter(id=session_id)[0]
+
+    def previousChunk():
+        chunk = TrialChunk.objects.filter(session=session, sequence=sequence).first()
+        if (chunk is not None) and (chunk.idempotency_key != idempotency_key):
+            raise ValueError(f'Chunk {sequence} of session {session_id} was already saved with another key')
+        return chunk
+
+    chunk = previousChunk()
+    if chunk is not None:
+        return chunk.n_trials, False
+    stimulus_ids = resolveStimuli(classification_trials + confidence_trials)
+    trials = buildTrials(classification_trials, stimulus_ids)
+    unmatched = mergeConfidence(trials, confidence_trials, stimulus_ids)
+    try:
+        with transaction.atomic():
+            # Locked as sealGameSubmission does, so a chunk can't be added to a session that is being sealed
+            session = Session.objects.select_for_update().filter(id=session_id)[0]
+            if session.session_completed:
+                raise ValueError(f'Session {session_id} was already sealed')
+            saved, saved_ids = {}, {}
+            if len(unmatched) > 0:
+                trial_numbers = [int(trial['trial_index_aligned']) for trial in unmatched]
+                rows = Trial.objects.filter(session=session, trial_number__in=trial_numbers)\
+                    .values_list('id', *RECORD_FIELDS)
+                for trial_id, *row in rows:
+                    record = TrialRecord.fromRow(row)
+                    saved[record.key], saved_ids[record.key] = record, trial_id
+                if len(mergeConfidence(saved, unmatched, stimulus_ids)) > 0:
+                    raise ValueError('When syncing confidence rating, trial not found in DB.')
+                Trial.objects.bulk_update([Trial(id=saved_ids[key], confidence=record.confidence,
+                                                 rt_confidence=record.rt_confidence)
+                                           for key, record in saved.items()], ['confidence', 'rt_confidence'])
+            Trial.objects.bulk_create([record.toTrial(session) for record in trials.values()], batch_size=500)
+            TrialChunk.objects.create(session=session, sequence=sequence, idempotency_key=idempotency_key,
+                                      n_trials=len(trials))
+            if archive:
+                archivePayload(session, 'chunk', {
+                    'sequence': sequence, 'idempotency_key': idempotency_key,
+                    'classification_trials': classification_trials, 'confidence_trials': confidence_trials},
+                    sequence=sequence).save()
+            if TRIAL_BLOCKS:
+                writeTrialBlock(session.id)
+    except IntegrityError:
+        # The same chunk was saved by a concurrent request
+        chunk = previousChunk()
+        if chunk is None:
+            raise
+        return chunk.n_trials, False
+    return len(trials), True
+
+
+def sealGameSubmission(session_id, n_chunks, strategy_free_data, strategy_radio_data, archive=True):
+    """Saves the strategy reports of a session whose trials were uploaded in chunks, and marks it completed.
+    Sealing a completed session again does nothing.
+
+    Args:
+        session_id (int): id of the session
+        n_chunks (int): number of chunks the page sent
+        strategy_free_data (dict): posted strategy_free, with a 'trials' list
+        strategy_radio_data (dict): posted strategy_radio, with a 'trials' list
+        archive (bool, optional): archive the seal with the session. Defaults to True.
+
+    Returns:
+        list: sequence numbers of the chunks that were not received. The session is only sealed when it is empty.
+    """
+    with transaction.atomic():
+        session = Session.objects.select_for_update().filter(id=session_id)[0]
+        if session.session_completed:
+            return []
+        received = set(TrialChunk.objects.filter(session=session).values_list('sequence', flat=True))
+        missing = [sequence for sequence in range(n_chunks) if sequence not in received]
+        if len(missing) > 0:
+            return missing
+        Strategy.objects.bulk_create(buildStrategies(session, strategy_free_data['trials'],
+                                                     strategy_radio_data['trials']))
+        if archive:
+            archivePayload(session, 'seal', {'n_chunks': n_chunks, 'strategy_free': strategy_free_data,
+                                             'strategy_radio': strategy_radio_data}).save()
+        session.session_completed = True
+        session.save(update_fields=['session_completed'])
+    return []
@@ -0,0 +1,200 @@
+'''
+Registry of the tutorial and task versions, loaded from task_versions.json.
+
+Each version lists the drone types and keys, and one or more stimulus variants ('initial', 'retest_1',
+'retest_2', ...). A variant has a 'train' and a 'test' set, each with a block label and the stimulus names
+for type A. The type B names can be given explicitly, or left out, in which case they are the A names
+with 'A_' swapped for 'B_'. A version with "same_for_retest" uses its 'initial' variant for every retest.
+A variant can name the prototype of each type under "prototypes". Otherwise the '..._prototype' stimuli
+of its train set are taken, if it has them. See drone_recon.stimulus_features.
+
+The file is read and validated once, when this module is first imported. The trial lists are built at
+the same time and stored as tuples of FrozenTrial, so they can be shared across requests. Adding a new
+retest variant only needs a new entry in the JSON file.
+
+'''
+
+import json
+import os
+from collections import namedtuple
+
+
+TASK_VERSIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'task_versions.json')
+
+TrialSet = namedtuple('TrialSet', ['use', 'types', 'keys', 'train', 'test', 'prototypes'])
+
+
+class FrozenTrial(dict):
+    """Read-only trial dictionary. It serializes like a dict, but raises TypeError on modification.
+
+    Args:
+        dict (dict): python dictionary class
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('FrozenTrial does not support modification')
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def replace(self, **kwargs):
+        """Returns a new FrozenTrial with some entries changed.
+
+        Returns:
+            FrozenTrial: updated copy
+        """
+        return FrozenTrial(self, **kwargs)
+
+
+def validateTaskVersions(task_versions):
+    """Checks the structure of the raw task version registry.
+
+    Args:
+        task_versions (dict): contents of task_versions.json
+
+    Raises:
+        ValueError: the registry is malformed. The message gives the location of the problem.
+
+    Returns:
+        int: 0
+    """
+    for kind in ['tutorial', 'task']:
+        if kind not in task_versions:
+            raise ValueError(f'Task version registry is missing the "{kind}" section')
+        for version, spec in task_versions[kind].items():
+            where = f'{kind} version {version}'
+            if not version.isdigit():
+                raise ValueError(f'{where}: version must be an integer')
+            for field in ['use', 'types', 'keys', 'variants']:
+                if field not in spec:
+                    raise ValueError(f'{where}: missing "{field}"')
+            if (len(spec['types']) != 2) or (len(spec['keys']) != 2):
+                raise ValueError(f'{where}: exactly two types and two keys are required')
+            if len(spec['variants']) == 0:
+                raise ValueError(f'{where}: at least one variant is required')
+            if spec.get('same_for_retest', False) and ('initial' not in spec['variants']):
+                raise ValueError(f'{where}: "same_for_retest" requires an "initial" variant')
+            for variant, blocks in spec['variants'].items():
+                if (variant != 'initial') and (not variant.startswith('retest_') or not variant[7:].isdigit()):
+                    raise ValueError(f'{where}: invalid variant name "{variant}"')
+                for block in ['train', 'test']:
+                    if block not in blocks:
+                        raise ValueError(f'{where}, {variant}: missing "{block}" set')
+                    block_spec = blocks[block]
+                    if not isinstance(block_spec.get('block'), str):
+                        raise ValueError(f'{where}, {variant}, {block}: missing block label')
+                    for stimulus_type in ['A', 'B']:
+                        names = block_spec.get(stimulus_type, [])
+                        if (not isinstance(names, list)) or not all(isinstance(name, str) for name in names):
+                            raise ValueError(f'{where}, {variant}, {block}: {stimulus_type} must be a list of names')
+                    if len(block_spec.get('A', [])) == 0:
+                        raise ValueError(f'{where}, {variant}, {block}: A needs at least one stimulus')
+                if 'prototypes' in blocks:
+                    prototypes = blocks['prototypes']
+                    if (not isinstance(prototypes, dict)) or (sorted(prototypes) != ['A', 'B']) or \
+                            not all(isinstance(name, str) for name in prototypes.values()):
+                        raise ValueError(f'{where}, {variant}: prototypes must give one name for each of A and B')
+                    for stimulus_type, name in prototypes.items():
+                        listed = [block_spec.get(stimulus_type, [n.replace('A_', 'B_') for n in block_spec['A']])
+                                  for block_spec in [blocks['train'], blocks['test']]]
+                        if not any(name in names for names in listed):
+                            raise ValueError(f'{where}, {variant}: prototype {name} is not a type {stimulus_type} stimulus')
+    return 0
+
+
+def buildTrialSet(spec, variant):
+    """Builds the frozen train and test trial lists for one variant of a version.
+
+    Args:
+        spec (dict): the version entry from the registry
+        variant (str): name of the variant
+
+    Returns:
+        TrialSet: use, types, keys, train, test and prototypes. Trials hold stimulus names, not URLs.
+            prototypes is a (type A name, type B name) tuple, or None if the variant has no prototypes.
+    """
+    trial_lists = {}
+    for block in ['train', 'test']:
+        block_spec = spec['variants'][variant][block]
+        names_A = block_spec['A']
+        names_B = block_spec.get('B', [name.replace('A_', 'B_') for name in names_A])
+        trials = []
+        for type_index, names in enumerate([names_A, names_B]):
+            for name in names:
+                trials.append(FrozenTrial({
+                    'stimulus': name,
+                    'correct_response': spec['keys'][type_index],
+                    'drone_type': spec['types'][type_index],
+                    'block': block_spec['block']
+                }))
+        trial_lists[block] = tuple(trials)
+    prototypes = spec['variants'][variant].get('prototypes')
+    if prototypes is not None:
+        prototypes = (prototypes['A'], prototypes['B'])
+    else:
+        prototypes = tuple(next((trial['stimulus'] for trial in trial_lists['train'] if
+                                 (trial['drone_type'] == drone_type) and trial['stimulus'].endswith('_prototype')), None)
+                           for drone_type in spec['types'])
+        if None in prototypes:
+            prototypes = None
+    return TrialSet(use=spec['use'], types=tuple(spec['types']), keys=tuple(spec['keys']),
+                    train=trial_lists['train'], test=trial_lists['test'], prototypes=prototypes)
+
+
+def loadTaskVersions(path=None):
+    """Reads, validates and builds the task version registry.
+
+    Args:
+        path (str, optional): location of the JSON file. Defaults to TASK_VERSIONS_PATH.
+
+    Returns:
+        dict: registry[kind][version][variant] = TrialSet
+    """
+    if path is None:
+        path = TASK_VERSIONS_PATH
+    with open(path) as f:
+        task_versions = json.load(f)
+    validateTaskVersions(task_versions)
+    registry = {}
+    for kind in ['tutorial', 'task']:
+        registry[kind] = {}
+        for version, spec in task_versions[kind].items():
+            registry[kind][int(version)] = {variant: buildTrialSet(spec, variant) for variant in spec['variants']}
+            if spec.get('same_for_retest', False):
+                registry[kind][int(version)]['same_for_retest'] = registry[kind][int(version)]['initial']
+    return registry
+
+
+def getTrialSet(kind, version, initial_test=True, retest_number=None):
+    """Looks up the trial set for a version and initial test/retest.
+
+    Args:
+        kind (str): 'tutorial' or 'task'
+        version (int): version number
+        initial_test (bool, optional): whether it is initial test or later. Defaults to True.
+        retest_number (int, optional): which retest variant to use. Defaults to None.
+
+    Raises:
+        ValueError: the version or variant is not in the registry
+
+    Returns:
+        TrialSet: the frozen trial set
+    """
+    if version not in TASK_VERSIONS[kind]:
+        raise ValueError(f'Invalid {kind} version {version}. Valid versions are {sorted(TASK_VERSIONS[kind])}')
+    variants = TASK_VERSIONS[kind][version]
+    if 'same_for_retest' in variants:
+        return variants['same_for_retest']
+    variant = 'initial' if initial_test else f'retest_{retest_number}'
+    if variant not in variants:
+        raise ValueError(f'Error in the determination of initial test or retest stimuli: {kind} version {version} ' +
+                         f'has no "{variant}" variant')
+    return variants[variant]
+
+
+TASK_VERSIONS = loadTaskVersions()
@@ -1,3 +1,467 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import sqlite3
+import tempfile
+from unittest import mock
+from django.core.exceptions import FieldError
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
 
-# Create your tests here.
+from drone_recon import shared_store
+from drone_recon.functions import buildStimulusDB
+from drone_recon.ingestion import listStimulusFiles, syncStimuli
+from drone_recon.global_variables import MH_HISTORY
+from drone_recon.submission_archive import archivePayload
+from drone_recon.spool import LEASE_SECONDS, MAX_ATTEMPTS, MAX_RETRY_DELAY, RETRY_DELAY, TrialSpool, processSpool
+from drone_recon.submissions import buildTrials
+from drone_recon.views import readGamePost
+from drone_recon.wire_format import CLASSIFICATION_FIELDS, CONFIDENCE_FIELDS, MAX_BODY_SIZE, decodeTrialPayload,\
+    readJSONStream
+from drone_recon.models import Subject, Session, Stimulus, StimulusVariant, Trial, TrialChunk, TrialLabel, QuestionnaireAnswer,\
+    QuestionnaireItem
+
+
+_shared_store_dir = None
+_shared_store_patcher = None
+
+
+def setUpModule():
+    """Points the shared store at a temporary folder, so the tests neither read nor leave values in SHARED_STORE_DIR."""
+    global _shared_store_dir, _shared_store_patcher
+    _shared_store_dir = tempfile.TemporaryDirectory()
+    store = shared_store.SharedStore('drone_recon', _shared_store_dir.name, code_stamp=shared_store.codeStamp())
+    # Keeps the callbacks the modules registered on import, e.g. functions.clearLocalStimulusCaches
+    for callback in shared_store.getSharedStore().callbacks:
+        store.onInvalidate(callback)
+    _shared_store_patcher = mock.patch.object(shared_store, '_SHARED_STORE', store)
+    _shared_store_patcher.start()
+
+
+def tearDownModule():
+    _shared_store_patcher.stop()
+    _shared_store_dir.cleanup()
+
+
+def questionnaireFormSetData(prefix, questionnaire_name, questions):
+    """Makes the post data of a questionnaire formset, as the questionnaire page sends it.
+
+    Args:
+        prefix (str): prefix of the formset
+        questionnaire_name (str): name of the questionnaire
+        questions (list): (question, answer) of each question
+
+    Returns:
+        dict: post data
+    """
+    data = {f'{prefix}-TOTAL_FORMS': str(len(questions)), f'{prefix}-INITIAL_FORMS': '0',
+            f'{prefix}-MIN_NUM_FORMS': '0', f'{prefix}-MAX_NUM_FORMS': '1000'}
+    for i, (question, answer) in enumerate(questions):
+        data.update({
+            f'{prefix}-{i}-questionnaire_name': questionnaire_name,
+            f'{prefix}-{i}-subscale': 'NA',
+            f'{prefix}-{i}-possible_answers': json.dumps({'Never': 1, 'Very often': 5}),
+            f'{prefix}-{i}-question': question,
+            f'{prefix}-{i}-questionnaire_question_number': str(i + 1),
+            f'{prefix}-{i}-answer': str(answer),
+        })
+    return data
+
+
+def classificationTrial(trial_number, stimulus='/media/images/A_d1_1.png'):
+    """Makes the jsPsych data of a classification trial, as the game page posts it.
+
+    Args:
+        trial_number (int): trial_index_aligned of the trial
+        stimulus (str, optional): image URL. Defaults to '/media/images/A_d1_1.png'.
+
+    Returns:
+        dict: the trial
+    """
+    return {'stimulus': stimulus, 'response': 'f', 'correct_response': 'f', 'drone_type': 'friendly',
+            'type_selected': 'friendly', 'rt': 800, 'block': 'train', 'trial_index_aligned': trial_number}
+
+
+def columnarPayload(classification_trials, confidence_trials):
+    """Encodes trials in wire format 1, as the game page does, with the string fields as levels and codes.
+
+    Args:
+        classification_trials (list): classification trials in format 0
+        confidence_trials (list): confidence trials in format 0
+
+    Returns:
+        dict: the payload in format 1
+    """
+    stimuli = sorted(set(trial['stimulus'] for trial in classification_trials + confidence_trials))
+
+    def table(trials, fields):
+        columns = {}
+        for field, kind in fields.items():
+            values = [trial[field] for trial in trials]
+            if kind == 'stimulus':
+                columns[field] = [stimuli.index(value) for value in values]
+            elif kind == 'value':
+                levels = sorted(set(values))
+                columns[field] = {'levels': levels, 'codes': [levels.index(value) for value in values]}
+            else:
+                columns[field] = values
+        return columns
+
+    return {'stimuli': stimuli, 'classification': table(classification_trials, CLASSIFICATION_FIELDS),
+            'confidence': table(confidence_trials, CONFIDENCE_FIELDS)}
+
+
+STRATEGIES = {'strategy_free': {'trials': [{'response': {'Q0': 'none'}}]},
+              'strategy_radio': {'trials': [{'response': {'focus': 'shape'}}]}}
+
+
+class GamePostTests(TestCase):
+    """Posts to the game views, as the game page sends them in format 0."""
+    def setUp(self):
+        subject = Subject.objects.create(external_ID='test', external_source='test', gender='NA',
+                                         education='NA')
+        self.session = Session.objects.create(subject=subject, start_time=timezone.now(), end_time=timezone.now())
+        Stimulus.objects.create(name='A_d1_1', use='task', image='images/A_d1_1.png')
+        client_session = self.client.session
+        client_session['session_ID'] = self.session.id
+        client_session.save()
+
+    def postJSON(self, view, payload):
+        return self.client.post(reverse(view), json.dumps(payload), content_type='application/json',
+                                HTTP_X_TRIAL_FORMAT='0')
+
+    def postChunk(self, sequence, key=None, trial_numbers=None):
+        if trial_numbers is None:
+            trial_numbers = [sequence]
+        return self.postJSON('drone_recon:gamechunk', {
+            'sequence': sequence, 'idempotency_key': key or f'key-{sequence}',
+            'classification_trials': [classificationTrial(i) for i in trial_numbers], 'confidence_trials': []})
+
+    def postSeal(self, n_chunks):
+        return self.postJSON('drone_recon:gameseal', dict(STRATEGIES, n_chunks=n_chunks))
+
+    def postSubmission(self, trial_numbers):
+        return self.postJSON('drone_recon:game', dict(
+            STRATEGIES, classification_trials=[classificationTrial(i) for i in trial_numbers], confidence_trials=[]))
+
+    def testChunkSentAgainWithSameKeyIsNotSavedTwice(self):
+        self.assertFalse(self.postChunk(0).json()['duplicate'])
+        response = self.postChunk(0)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['duplicate'])
+        self.assertEqual(Trial.objects.filter(session=self.session).count(), 1)
+
+    def testChunkSentAgainWithAnotherKeyIsRefused(self):
+        self.postChunk(0)
+        self.assertEqual(self.postChunk(0, key='other-key').status_code, 400)
+        self.assertEqual(Trial.objects.filter(session=self.session).count(), 1)
+
+    def testSealListsMissingChunks(self):
+        self.postChunk(0)
+        self.postChunk(2)
+        response = self.postSeal(3)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['missing'], [1])
+        self.session.refresh_from_db()
+        self.assertFalse(self.session.session_completed)
+
+    def testChunkAfterSealIsRefused(self):
+        self.postChunk(0)
+        self.postChunk(1)
+        self.assertEqual(self.postSeal(2).status_code, 200)
+        self.assertEqual(self.postChunk(2).status_code, 400)
+        self.assertEqual(Trial.objects.filter(session=self.session).count(), 2)
+        self.assertFalse(TrialChunk.objects.filter(session=self.session, sequence=2).exists())
+
+
+    def testSubmissionAfterChunksIsRefused(self):
+        self.postChunk(0)
+        self.postSeal(1)
+        self.assertEqual(self.postSubmission([0]).status_code, 400)
+        self.assertEqual(Trial.objects.filter(session=self.session, trial_number=0).count(), 1)
+
+    def testSubmissionSentAgainIsNotSavedTwice(self):
+        self.assertFalse(self.postSubmission([0, 1]).json()['duplicate'])
+        response = self.postSubmission([0, 1])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['duplicate'])
+        self.assertEqual(Trial.objects.filter(session=self.session).count(), 2)
+
+
+class StimulusBuildTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.image_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        self.addCleanup(self.image_dir.cleanup)
+        for name in ['0-A_d1_1', '0-B_d1_2']:
+            Image.new('RGB', (64, 48), 'white').save(os.path.join(self.image_dir.name, f'{name}.png'))
+
+    def testSerialBuildMakesVariants(self):
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            buildStimulusDB(file_dir=self.image_dir.name, file_base='0-', use='task', ingestion='serial')
+        self.assertEqual(Stimulus.objects.count(), 2)
+        self.assertEqual(StimulusVariant.objects.values('stimulus').distinct().count(), 2)
+
+    def testSerialBuildClearsCachesOnce(self):
+        with override_settings(MEDIA_ROOT=self.media_root.name), \
+                mock.patch('drone_recon.signals.getSharedStore') as getSharedStore:
+            buildStimulusDB(file_dir=self.image_dir.name, file_base='0-', use='task', ingestion='serial')
+        self.assertEqual(getSharedStore.return_value.invalidate.call_count, 1)
+
+    def testDryRunComparesUnhashedStimuli(self):
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            buildStimulusDB(file_dir=self.image_dir.name, file_base='0-', use='task', ingestion='serial')
+            Stimulus.objects.update(content_hash='')
+            files = listStimulusFiles('local', file_dir=self.image_dir.name, file_base='0-')
+            report = syncStimuli(files, use='task', file_base='0-', dry_run=True)
+        self.assertEqual((report['changed'], len(report['unchanged'])), ([], 2))
+        self.assertFalse(Stimulus.objects.exclude(content_hash='').exists())
+
+
+class TrialLabelFieldTests(TestCase):
+    def setUp(self):
+        subject = Subject.objects.create(external_ID='test', external_source='test', gender='NA',
+                                         education='NA')
+        session = Session.objects.create(subject=subject, start_time=timezone.now(), end_time=timezone.now())
+        stimulus = Stimulus.objects.create(name='test', use='test', image='images/test.png')
+        Trial.objects.create(stimulus=stimulus, session=session, correct_class='friendly', response='hostile',
+                             block='train', trial_number=0)
+
+    def testSavedLabelsAreRead(self):
+        trial = Trial.objects.get(block='train')
+        self.assertEqual((trial.correct_class, trial.response, trial.block), ('friendly', 'hostile', 'train'))
+        self.assertEqual(Trial.objects.filter(block__in=['train', 'test']).count(), 1)
+
+    def testFilterOnUnknownLabelAddsNothing(self):
+        n_labels = TrialLabel.objects.count()
+        self.assertFalse(Trial.objects.filter(block='nonexistent_label_xyz').exists())
+        self.assertFalse(Trial.objects.filter(block__in=['nonexistent_label_xyz']).exists())
+        self.assertEqual(TrialLabel.objects.count(), n_labels)
+
+    def testPatternLookupsAreRejected(self):
+        for lookup in ['block__contains', 'block__icontains', 'block__startswith', 'block__iexact']:
+            with self.subTest(lookup=lookup):
+                with self.assertRaises(FieldError):
+                    Trial.objects.filter(**{lookup: 'tra'})
+
+
+class QuestionnairePostTests(TestCase):
+    # Queries of a questionnaire post, whatever the number of questions: the request's session, the Session,
+    # the savepoint and its release, the items (read, add, read back), the answers, the subject, the Session,
+    # and the Session of the token page
+    N_QUERIES = 11
+
+    def setUp(self):
+        subject = Subject.objects.create(external_ID='test', external_source='test', gender='NA',
+                                         education='NA')
+        self.session = Session.objects.create(subject=subject, start_time=timezone.now(),
+                                              end_time=timezone.now())
+        client_session = self.client.session
+        client_session['session_ID'] = self.session.id
+        client_session['webapp_use'] = 'screen'
+        client_session.save()
+
+    def postQuestionnaires(self, n_questions):
+        data = questionnaireFormSetData('questionnaireformeset_id_att_check', 'att_check',
+                                        [('Attention question 1', 5), ('Attention question 2', 5)])
+        data.update(questionnaireFormSetData('questionnaireformeset_id_test', 'test',
+                                             [(f'Question {i}', i % 5) for i in range(n_questions)]))
+        for condition in MH_HISTORY:
+            data[condition[0]] = 'False'
+            data[f'{condition[0]}-age'] = '0'
+        data['attention_checkbox'] = 'pass_attention_check'
+        return self.client.post(reverse('drone_recon:questionnaires'), data)
+
+    def testQueriesDontGrowWithQuestions(self):
+        for n_questions in [10, 70]:
+            with self.subTest(n_questions=n_questions):
+                QuestionnaireAnswer.objects.all().delete()
+                QuestionnaireItem.objects.all().delete()
+                with self.assertNumQueries(self.N_QUERIES):
+                    response = self.postQuestionnaires(n_questions)
+                self.assertEqual(response.status_code, 200)
+                # The questions, the two attention check questions and the attention checkbox
+                self.assertEqual(QuestionnaireAnswer.objects.filter(session=self.session).count(),
+                                 n_questions + 3)
+
+    def testSeenQuestionsAreNotAddedAgain(self):
+        self.postQuestionnaires(10)
+        n_items = QuestionnaireItem.objects.count()
+        self.postQuestionnaires(10)
+        self.assertEqual(QuestionnaireItem.objects.count(), n_items)
+        self.assertEqual(QuestionnaireAnswer.objects.filter(session=self.session).count(), 2 * 13)
+
+
+class GamePostSizeTests(TestCase):
+    def testLargeBodiesAreRefusedBeforeReading(self):
+        factory = RequestFactory()
+        requests = {
+            'form': factory.post('/', {'classification_trials': '{}'}, CONTENT_LENGTH=str(MAX_BODY_SIZE + 1)),
+            'json': factory.post('/', '{}', content_type='application/json', HTTP_X_TRIAL_FORMAT='0',
+                                 CONTENT_LENGTH=str(MAX_BODY_SIZE + 1)),
+        }
+        for body_type, request in requests.items():
+            with self.subTest(body_type=body_type):
+                with self.assertRaisesRegex(ValueError, 'larger than'):
+                    readGamePost(request, 'submission')
+
+
+class WireFormatTests(TestCase):
+    def setUp(self):
+        self.classification_trials = [classificationTrial(0), classificationTrial(1, '/media/images/B_d1_2.png'),
+                                      dict(classificationTrial(2), block='test', rt=712.5)]
+        self.confidence_trials = [{'stimulus': '/media/images/A_d1_1.png', 'response': 60, 'rt': 1500,
+                                   'trial_index_aligned': 0}]
+
+    def testColumnarPayloadDecodesToFormat0(self):
+        payload = dict(columnarPayload(self.classification_trials, self.confidence_trials), sequence=3)
+        self.assertEqual(decodeTrialPayload(payload, 1),
+                         {'classification_trials': self.classification_trials,
+                          'confidence_trials': self.confidence_trials, 'sequence': 3})
+
+    def testCodeOutOfRangeIsRejected(self):
+        payload = columnarPayload(self.classification_trials, self.confidence_trials)
+        payload['classification']['block']['codes'][0] = len(payload['classification']['block']['levels'])
+        with self.assertRaisesRegex(ValueError, 'out of range'):
+            decodeTrialPayload(payload, 1)
+
+    def testColumnsOfDifferentLengthsAreRejected(self):
+        payload = columnarPayload(self.classification_trials, self.confidence_trials)
+        payload['classification']['rt'].pop()
+        with self.assertRaisesRegex(ValueError, 'different lengths'):
+            decodeTrialPayload(payload, 1)
+
+    def testTruncatedGzipIsRejected(self):
+        body = gzip.compress(json.dumps(columnarPayload(self.classification_trials, self.confidence_trials)).encode())
+        with self.assertRaisesRegex(ValueError, 'truncated'):
+            readJSONStream(io.BytesIO(body[:len(body) // 2]), 'gzip')
+
+    def testGzipExpandingPastMaxSizeIsRejected(self):
+        body = gzip.compress(json.dumps({'padding': ' ' * 10000}).encode())
+        self.assertLess(len(body), 1000)
+        with self.assertRaisesRegex(ValueError, 'once decompressed'):
+            readJSONStream(io.BytesIO(body), 'gzip', max_size=1000)
+        self.assertEqual(len(readJSONStream(io.BytesIO(body), 'gzip', max_size=20000)['padding']), 10000)
+
+
+class SubmissionRecordingTests(TestCase):
+    def setUp(self):
+        subject = Subject.objects.create(external_ID='test', external_source='test', gender='NA',
+                                         education='NA')
+        self.session = Session.objects.create(subject=subject, start_time=timezone.now(), end_time=timezone.now())
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archive_dir.cleanup)
+        self.storage = FileSystemStorage(location=self.archive_dir.name)
+
+    def testRepeatedTrialsAreRejected(self):
+        trial = {'stimulus': '/media/images/A_d1_1.png', 'response': 'f', 'correct_response': 'f',
+                 'drone_type': 'friendly', 'type_selected': 'friendly', 'rt': 800, 'block': 'train',
+                 'trial_index_aligned': 3}
+        with self.assertRaisesRegex(ValueError, 'more than once'):
+            buildTrials([trial, dict(trial, rt=900)], {trial['stimulus']: 1})
+
+    def testArchiveIsOnlyStoredOnCommit(self):
+        payload = {'n_chunks': 1, 'strategy_free': {'trials': []}, 'strategy_radio': {'trials': []}}
+        with mock.patch('drone_recon.submission_archive.archiveStorage', return_value=self.storage):
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(RuntimeError):
+                    with transaction.atomic():
+                        archived = archivePayload(self.session, 'seal', payload)
+                        archived.save()
+                        raise RuntimeError('rolled back')
+            self.assertFalse(self.storage.exists(archived.archive.name))
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    archived = archivePayload(self.session, 'seal', payload)
+                    archived.save()
+            self.assertTrue(self.storage.exists(archived.archive.name))
+
+
+class TrialSpoolTests(SimpleTestCase):
+    """Runs a spool in a temporary file on a fake clock, with the recording functions mocked."""
+    def setUp(self):
+        spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spool_dir.cleanup)
+        self.spool = TrialSpool(os.path.join(spool_dir.name, 'trials.sqlite3'))
+        self.clock = self.patch('drone_recon.spool.time')
+        self.clock.time.return_value = 1000.0
+        self.patch('drone_recon.spool.validateSubmission')
+        self.recordChunk = mock.Mock()
+        patcher = mock.patch.dict('drone_recon.spool.HANDLERS', chunk=self.recordChunk)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def patch(self, target):
+        patcher = mock.patch(target)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def appendChunk(self, session_id, sequence=0):
+        body = json.dumps({'sequence': sequence, 'idempotency_key': f'{session_id}-{sequence}',
+                           'classification_trials': [classificationTrial(sequence)], 'confidence_trials': []})
+        return self.spool.append('chunk', session_id, body.encode())
+
+    def entry(self, entry_id):
+        with sqlite3.connect(self.spool.path) as connection:
+            return connection.execute('SELECT status, attempts, next_attempt FROM spool WHERE id = ?',
+                                      (entry_id,)).fetchone()
+
+    def testLaterEntriesOfASessionWaitForEarlierOnes(self):
+        first, second, other = self.appendChunk(1, 0), self.appendChunk(1, 1), self.appendChunk(2, 0)
+        self.assertEqual([entry[0] for entry in self.spool.claim()], [first, other])
+        self.assertEqual(self.spool.claim(), [])
+        self.spool.complete(first)
+        self.assertEqual([entry[0] for entry in self.spool.claim()], [second])
+
+    def testValueErrorIsNotRetried(self):
+        entry_id = self.appendChunk(1)
+        self.recordChunk.side_effect = ValueError('Unknown stimulus')
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(processSpool(self.spool), (0, 1))
+        self.assertEqual(self.entry(entry_id)[:2], ('failed', 1))
+        self.clock.time.return_value += MAX_RETRY_DELAY
+        self.assertEqual(processSpool(self.spool), (0, 0))
+        self.assertEqual(self.recordChunk.call_count, 1)
+
+    def testOtherErrorsAreRetriedWithGrowingDelay(self):
+        entry_id = self.appendChunk(1)
+        self.recordChunk.side_effect = RuntimeError('Database unavailable')
+        for attempt in range(1, MAX_ATTEMPTS):
+            with self.assertLogs(level='ERROR'):
+                self.assertEqual(processSpool(self.spool), (0, 1))
+            status, attempts, next_attempt = self.entry(entry_id)
+            delay = min(RETRY_DELAY * 2 ** (attempt - 1), MAX_RETRY_DELAY)
+            self.assertEqual((status, attempts, next_attempt), ('pending', attempt, self.clock.time() + delay))
+            # Not due before the delay has passed
+            self.assertEqual(processSpool(self.spool), (0, 0))
+            self.clock.time.return_value += delay
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(processSpool(self.spool), (0, 1))
+        self.assertEqual(self.entry(entry_id)[:2], ('failed', MAX_ATTEMPTS))
+        self.assertEqual(self.recordChunk.call_count, MAX_ATTEMPTS)
+
+    def testSealWaitsForMissingChunks(self):
+        sealGameSubmission = self.patch('drone_recon.spool.sealGameSubmission')
+        sealGameSubmission.return_value = [1]
+        body = json.dumps(dict(STRATEGIES, n_chunks=2)).encode()
+        entry_id = self.spool.append('seal', 1, body)
+        self.assertEqual(processSpool(self.spool), (0, 1))
+        self.assertEqual(self.entry(entry_id)[:2], ('pending', 1))
+        sealGameSubmission.return_value = []
+        self.clock.time.return_value += RETRY_DELAY
+        self.assertEqual(processSpool(self.spool), (1, 0))
+        self.assertIsNone(self.entry(entry_id))
+
+    def testExpiredLeaseIsClaimedAgain(self):
+        entry_id = self.appendChunk(1)
+        self.assertEqual(len(self.spool.claim()), 1)
+        self.clock.time.return_value += LEASE_SECONDS
+        self.assertEqual(self.spool.claim(), [])
+        self.clock.time.return_value += 1
+        self.assertEqual([entry[0] for entry in self.spool.claim()], [entry_id])
@@ -0,0 +1,182 @@
+'''
+Trials of a session packed into typed arrays in a single SessionTrialBlock row, kept alongside the Trial
+rows, so analyses and exports can read a session's trials with one row fetch and without ORM objects.
+
+Each column of Trial is stored as a packed little-endian array, ordered by trial number, with the types in
+BLOCK_COLUMNS. The string columns (correct_class, response and block) are stored as codes into a list of
+levels kept with the block. Missing values are MISSING for integers and NaN for the confidence.
+
+With TRIAL_BLOCKS on, the block of a session is rewritten from its Trial rows in the same transaction as
+every submission, chunk or reprocessing that changes them (see drone_recon.submissions), with one query
+for the rows. The buildtrialblocks management command writes the blocks of sessions recorded before.
+
+trialBlockArrays returns the trials of one or many sessions as NumPy arrays.
+
+'''
+
+from collections import namedtuple
+
+import numpy as np
+
+from drone_recon.models import Trial, SessionTrialBlock
+from drone_recon.trial_records import RECORD_FIELDS
+
+
+MISSING = -1
+# Column -> type of its packed array, in the order of trial_records.RECORD_FIELDS
+BLOCK_COLUMNS = {
+    'stimulus_id': '<i4',
+    'correct': 'i1',
+    'correct_class': '<i2',
+    'response': '<i2',
+    'confidence': '<f4',
+    'rt_classification': '<i4',
+    'rt_confidence': '<i4',
+    'feedback_given': 'i1',
+    'block': '<i2',
+    'trial_number': '<i4',
+}
+CODED_COLUMNS = ['correct_class', 'response', 'block']
+assert tuple(BLOCK_COLUMNS) == RECORD_FIELDS
+
+# Arrays returned by trialBlockArrays, one row per trial. correct is 1, 0 or MISSING, the coded columns
+# are strings.
+TrialArrays = namedtuple('TrialArrays', ['session_id'] + list(BLOCK_COLUMNS))
+
+
+def packTrialRows(rows):
+    """Packs trial rows into the fields of a SessionTrialBlock.
+
+    Args:
+        rows (list): RECORD_FIELDS tuples of the trials, e.g. from Trial values_list or TrialRecord.asRow
+
+    Returns:
+        dict: n_trials, levels and the packed columns
+    """
+    columns = dict(zip(BLOCK_COLUMNS, zip(*rows))) if len(rows) > 0 else {column: () for column in BLOCK_COLUMNS}
+    fields = {'n_trials': len(rows), 'levels': {}}
+    for column, dtype in BLOCK_COLUMNS.items():
+        values = columns[column]
+        if column in CODED_COLUMNS:
+            levels = list(dict.fromkeys(values))
+            codes = {level: code for code, level in enumerate(levels)}
+            fields['levels'][column] = levels
+            array = np.array([codes[value] for value in values], dtype=dtype)
+        elif column == 'confidence':
+            array = np.array([np.nan if value is None else value for value in values], dtype=dtype)
+        else:
+            array = np.array([MISSING if value is None else value for value in values], dtype=dtype)
+        fields[column] = array.tobytes()
+    return fields
+
+
+def unpackTrialBlock(session_id, n_trials, levels, packed):
+    """Unpacks the columns of a SessionTrialBlock.
+
+    Args:
+        session_id (int): id of the session
+        n_trials (int): number of trials
+        levels (dict): levels of the coded columns
+        packed (dict): column -> packed bytes
+
+    Returns:
+        TrialArrays: the trials
+    """
+    arrays = {'session_id': np.full(n_trials, session_id, dtype=np.int64)}
+    for column, dtype in BLOCK_COLUMNS.items():
+        # BinaryField values read from the DB may be memoryviews
+        array = np.frombuffer(bytes(packed[column]), dtype=dtype)
+        if column in CODED_COLUMNS:
+            array = np.asarray(levels[column] or [''], dtype=str)[array]
+        arrays[column] = array
+    arrays['feedback_given'] = arrays['feedback_given'].astype(bool)
+    return TrialArrays(**arrays)
+
+
+def sessionTrialRows(session_ids):
+    """Reads the Trial rows of sessions as tuples, ordered by trial number. Costs one query.
+
+    Args:
+        session_ids (list): ids of the sessions
+
+    Returns:
+        dict: session id -> list of RECORD_FIELDS tuples
+    """
+    rows = {}
+    trials = Trial.objects.filter(session_id__in=list(session_ids)).order_by('session_id', 'trial_number', 'id')\
+        .values_list('session_id', *RECORD_FIELDS)
+    for row in trials:
+        rows.setdefault(row[0], []).append(row[1:])
+    return rows
+
+
+def writeTrialBlock(session_id):
+    """Rewrites the block of a session from its Trial rows.
+
+    Args:
+        session_id (int): id of the session
+
+    Returns:
+        int: number of trials in the block
+    """
+    fields = packTrialRows(sessionTrialRows([session_id]).get(session_id, []))
+    SessionTrialBlock.objects.update_or_create(session_id=session_id, defaults=fields)
+    return fields['n_trials']
+
+
+def buildTrialBlocks(session_ids=None):
+    """Writes the blocks of sessions from their Trial rows.
+
+    Args:
+        session_ids (list, optional): ids of the sessions. Defaults to every session with trials.
+
+    Returns:
+        int: number of sessions
+    """
+    if session_ids is None:
+        session_ids = Trial.objects.order_by().values_list('session_id', flat=True).distinct()
+    n_sessions = 0
+    for session_id in session_ids:
+        writeTrialBlock(session_id)
+        n_sessions += 1
+    return n_sessions
+
+
+def trialBlockArrays(session_ids, fallback=True, chunk_size=500):
+    """Gets the trials of sessions as NumPy arrays, from their blocks. Costs one query per chunk_size
+    sessions, plus one for the sessions without a block.
+
+    Args:
+        session_ids (list or int): ids of the sessions, or the id of one session
+        fallback (bool, optional): read the Trial rows of sessions that have no block. Defaults to True.
+        chunk_size (int, optional): sessions per query. Defaults to 500.
+
+    Raises:
+        ValueError: sessions have no block and fallback is False
+
+    Returns:
+        TrialArrays: the trials of every session, in the order of session_ids
+    """
+    if np.ndim(session_ids) == 0:
+        session_ids = [session_ids]
+    session_ids = [int(session_id) for session_id in session_ids]
+    unique_ids = list(dict.fromkeys(session_ids))
+    blocks = {}
+    for start in range(0, len(unique_ids), chunk_size):
+        rows = SessionTrialBlock.objects.filter(session_id__in=unique_ids[start:start + chunk_size])\
+            .values_list('session_id', 'n_trials', 'levels', *BLOCK_COLUMNS)
+        for session_id, n_trials, levels, *packed in rows:
+            blocks[session_id] = unpackTrialBlock(session_id, n_trials, levels, dict(zip(BLOCK_COLUMNS, packed)))
+    missing = [session_id for session_id in unique_ids if session_id not in blocks]
+    if len(missing) > 0:
+        if not fallback:
+            raise ValueError(f'{len(missing)} sessions have no trial block: ids {missing}')
+        rows = sessionTrialRows(missing)
+        for session_id in missing:
+            fields = packTrialRows(rows.get(session_id, []))
+            blocks[session_id] = unpackTrialBlock(session_id, fields['n_trials'], fields['levels'], fields)
+    parts = [blocks[session_id] for session_id in session_ids]
+    if len(parts) == 1:
+        return parts[0]
+    return TrialArrays(*[np.concatenate([part[i] for part in parts]) if len(parts) > 0 else np.array([])
+                         for i in range(len(TrialArrays._fields))])
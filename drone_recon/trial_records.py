@@ -0,0 +1,122 @@
+'''
+Lightweight trial record used where many trials are handled at once: building the trials of a post,
+merging the confidence ratings, reprocessing archives and packing trial blocks. A TrialRecord holds the
+fields of a Trial without its session, in __slots__, so it costs a fraction of a model instance.
+
+Records are made from the jsPsych data of a classification trial (fromPayload), which is where the
+derived fields (correct and feedback_given) are computed, or from values_list rows of RECORD_FIELDS
+(fromRow). toTrial makes the Trial for bulk_create.
+
+'''
+
+from drone_recon.models import Trial
+
+
+# Trial fields a record holds, in the order of its rows
+RECORD_FIELDS = ('stimulus_id', 'correct', 'correct_class', 'response', 'confidence', 'rt_classification',
+                 'rt_confidence', 'feedback_given', 'block', 'trial_number')
+
+
+class TrialRecord:
+    """Fields of one trial, without its session.
+
+    Args:
+        stimulus_id (int): id of the stimulus
+        correct (bool): whether the classification was correct, or None
+        correct_class (str): drone type of the stimulus
+        response (str): drone type selected
+        confidence (float): confidence rating, or None
+        rt_classification (int): classification RT in ms, or None
+        rt_confidence (int): confidence RT in ms, or None
+        feedback_given (bool): whether feedback followed the trial
+        block (str): block label
+        trial_number (int): trial_index_aligned of the trial
+    """
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, stimulus_id, correct, correct_class, response, confidence, rt_classification,
+                 rt_confidence, feedback_given, block, trial_number):
+        self.stimulus_id = stimulus_id
+        self.correct = correct
+        self.correct_class = correct_class
+        self.response = response
+        self.confidence = confidence
+        self.rt_classification = rt_classification
+        self.rt_confidence = rt_confidence
+        self.feedback_given = feedback_given
+        self.block = block
+        self.trial_number = trial_number
+
+    @classmethod
+    def fromPayload(cls, trial, stimulus_id):
+        """Makes the record of a classification trial posted by the game page, without its confidence.
+
+        Args:
+            trial (dict): jsPsych data of the classification trial
+            stimulus_id (int): id of its stimulus
+
+        Returns:
+            TrialRecord: the record
+        """
+        return cls(stimulus_id=stimulus_id,
+                   correct=(trial['response'] == trial['correct_response']),
+                   correct_class=trial['drone_type'],
+                   response=trial['type_selected'],
+                   confidence=None,
+                   rt_classification=int(trial['rt']),
+                   rt_confidence=None,
+                   feedback_given=('train' in trial['block']),
+                   block=trial['block'],
+                   trial_number=int(trial['trial_index_aligned']))
+
+    @classmethod
+    def fromRow(cls, row):
+        """Makes a record from a values_list row of RECORD_FIELDS.
+
+        Args:
+            row (tuple): the row
+
+        Returns:
+            TrialRecord: the record
+        """
+        return cls(*row)
+
+    @property
+    def key(self):
+        """(stimulus id, trial number), which the confidence trials are matched on."""
+        return self.stimulus_id, self.trial_number
+
+    def setConfidence(self, trial):
+        """Adds the confidence rating of the trial.
+
+        Args:
+            trial (dict): jsPsych data of the confidence trial
+        """
+        self.confidence = int(trial['response'])
+        self.rt_confidence = int(trial['rt'])
+
+    def asRow(self):
+        """Gets the fields in the order of RECORD_FIELDS.
+
+        Returns:
+            tuple: the row
+        """
+        return tuple(getattr(self, field) for field in RECORD_FIELDS)
+
+    def toTrial(self, session):
+        """Makes the unsaved Trial of the record, e.g. for bulk_create.
+
+        Args:
+            session (Session): session of the trial
+
+        Returns:
+            Trial: the trial
+        """
+        return Trial(session=session, **{field: getattr(self, field) for field in RECORD_FIELDS})
+
+    def __eq__(self, other):
+        return isinstance(other, TrialRecord) and (self.asRow() == other.asRow())
+
+    def __repr__(self):
+        return f'TrialRecord({", ".join(f"{field}={getattr(self, field)!r}" for field in RECORD_FIELDS)})'
+
@@ -9,6 +9,9 @@ app_name = 'drone_recon'
 urlpatterns = [
     path("", views.index, name="index"),
     path('game', views.game, name='game'),
+    path('game/config', views.gameConfig, name='gameconfig'),
+    path('game/chunk', views.gameChunk, name='gamechunk'),
+    path('game/seal', views.gameSeal, name='gameseal'),
     path('welcome', views.welcome, name='welcome'),
     path('alreadycompleted', views.alreadyCompleted, name='alreadycompleted'),
     path('attentionfailure', views.alreadyCompleted, name='attentionfailure'),
@@ -16,4 +19,5 @@ urlpatterns = [
     path("questionnaires", views.questionnaires, name="questionnaires"),
     path('token', views.token, name='token'),
     path('fishy', views.fishy, name='fishy'),
+    path('health', views.health, name='health'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -10,6 +10,7 @@ import urllib
 import os, logging
 from datetime import datetime
 from user_agents import parse
+from django.db import transaction
 from django.db.models import Avg, Count
 from django.http import HttpResponseRedirect, HttpResponse, HttpRequest, JsonResponse
 from django.shortcuts import get_object_or_404, render
@@ -19,14 +20,22 @@ from django.views.decorators.csrf import csrf_exempt
 from django.forms import modelformset_factory
 from django import forms
 from django.views.decorators.cache import never_cache
-from drone_recon.models import Subject, Session, Trial, QuestionnaireQ, Stimulus, Strategy
+from django.views.decorators.http import condition, require_POST
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.safestring import mark_safe
+from drone_recon.models import Subject, Session, QuestionnaireQ, QuestionnaireAnswer
 from drone_recon.global_variables import *
-from drone_recon.functions import getStimulusURLs, tutorialParameters, confidenceParameters, \
-    taskParameters, getPaymentToken, createWelcomeMessage, getProlificPaymentTokens
-from drone_recon.forms import processSubstanceForm, processMentalHealthHistoryForm, RegistrationForm,\
-    timezoneModelForm, makeSubstancesRadioForm, sleepModelForm, makeMentalHealthHistoryRadioAgeForm,\
-    makeQuestionnaireFormSet, attentionCheckList, checkAttention, CombinedFormSet, makeConditionalFormSet,\
-    makeMentalHealthConditionalDict, makeSubstancesConditionalDict, fixSubstanceConditionalForm
+from drone_recon.image_variants import acceptedImageFormats, parseImageFormats
+from drone_recon.singleflight import singleFlightStats
+from drone_recon.submissions import recordGameSubmission, recordTrialChunk, sealGameSubmission
+from drone_recon.wire_format import requestTrialFormat, readJSONBody, decodeTrialPayload, checkBodySize
+from drone_recon.submission_schema import validateSubmission
+from drone_recon.spool import getTrialSpool, wakeSpoolWorker
+from drone_recon.functions import getGameConfig, getPaymentToken, createWelcomeMessage, getProlificPaymentTokens
+from drone_recon.forms import processSubstanceForm, RegistrationForm, timezoneModelForm, makeSubstancesRadioForm,\
+    sleepModelForm, makeMentalHealthHistoryRadioAgeForm, attentionCheckList, checkAttention,\
+    makeSubstancesConditionalDict, fixSubstanceConditionalForm, getQuestionnaireFragment, readCompactAnswers,\
+    mentalHealthHistoryList
 from drone_recon.global_variables import *
 
 import logging
@@ -87,10 +96,14 @@ def health(request):
         request (request): Django request object
 
     Returns:
-        HttpResponse() or error
+        JsonResponse with the single-flight build statistics of this worker, see singleflight.py, and the
+            trial spool counts if it is on, or error
     """
     try:
-        return HttpResponse()
+        statistics = {'single_flight': singleFlightStats()}
+        if TRIAL_SPOOL:
+            statistics['trial_spool'] = getTrialSpool().statistics()
+        return JsonResponse(statistics)
     except Exception as e:
         logger.error('Error in %s', 'consentformProlific', exc_info=e)
         
@@ -361,93 +374,214 @@ def game(request):
     """
     if request.method == 'POST':
         print('Data posted')
-        # Get the data from the POST request
-        classification_data = json.loads(request.POST.get('classification_trials', ''))
-        confidence_data = json.loads(request.POST.get('confidence_trials', ''))
-        strategy_free_data = json.loads(request.POST.get('strategy_free', ''))
-        strategy_radio_data = json.loads(request.POST.get('strategy_radio', ''))
-        # Process and save data from the POST request
-        session = Session.objects.filter(id=request.session['session_ID'])[0]
-        ## First go through the classification trials
-        for trial in classification_data['trials']:
-            image = 'images/' + trial['stimulus'].split('/')[-1]
-            logging.info(f"trial stimulus: {image}")
-            stimulus = Stimulus.objects.filter(image=image)
-            if len(stimulus) == 0:
-                raise ValueError(f"Trial stimulus {image} not found during recording in DB")
-            trial_db = Trial(stimulus_id=stimulus[0].id, 
-                          session = session,
-                          correct=(trial['response'] == trial['correct_response']),
-                          correct_class = trial['drone_type'],
-                          response = trial['type_selected'],
-                          rt_classification = int(trial['rt']),
-                          block=trial['block'], 
-                          feedback_given = ('train' in trial['block']),
-                          trial_number = int(trial['trial_index_aligned']))
-            trial_db.save()
-        ## Add the confidence ratings and confidence RT
-        for trial in confidence_data['trials']:
-            image = 'images/' + trial['stimulus'].split('/')[-1]
-            logging.info(f"trial stimulus: {image}")
-            stimulus = Stimulus.objects.filter(image=image)
-            if len(stimulus) == 0:
-                raise ValueError(f"Trial stimulus {image} not found during recording in DB")
-            trial_db = Trial.objects.filter(stimulus_id=stimulus[0].id, 
-                          session = session,
-                          trial_number = trial['trial_index_aligned'])
-            if len(trial_db) == 0:
-                raise ValueError('When syncing confidence rating, trial not found in DB.')
-            
-            trial_db[0].confidence = int(trial['response'])
-            trial_db[0].rt_confidence = int(trial['rt'])
-            trial_db[0].save()
-        # Include strategy reports
-        if len(strategy_free_data['trials']) > 0:
-            strategy_db = Strategy(session=session,
-                                   prompt='free_response',
-                                   response=strategy_free_data['trials'][0]['response']['Q0'])
-            strategy_db.save()
-        if len(strategy_radio_data['trials']) > 0:
-            for prompt in strategy_radio_data['trials'][0]['response'].keys():
-                strategy_db = Strategy(session=session,
-                                    prompt=prompt,
-                                    response=strategy_radio_data['trials'][0]['response'][prompt])
-                strategy_db.save()
-        # Update the session to reflect that the task is complete
-        session.session_completed = True
-        session.save()
+        # Get the data from the POST request, either form fields or a JSON body in one of the wire formats,
+        # and check all of it before anything is saved
+        try:
+            payload = readGamePost(request, 'submission')
+        except ValueError as e:
+            return invalidPostResponse('game', e)
+        if TRIAL_SPOOL:
+            if 'X-Trial-Format' in request.headers:
+                return spoolTrialPost(request, 'submission')
+            return spoolTrialPost(request, 'submission', json.dumps(payload).encode())
+        # Save the trials, strategy reports and completed session in one transaction. A submission posted
+        # again is answered the same way, without saving it twice.
+        try:
+            _, created = recordGameSubmission(request.session['session_ID'],
+                                              {'trials': payload['classification_trials']},
+                                              {'trials': payload['confidence_trials']}, payload['strategy_free'],
+                                              payload['strategy_radio'])
+        except ValueError as e:
+            return invalidPostResponse('game', e)
         return JsonResponse({
                 'success': True,
+                'duplicate': not created,
             })
     else:
         print('Request for game page received')
-        # Pull the stimulus URLs from the DB (used in preloading)
-        stim_schematic_urls = getStimulusURLs(use='schematic')
-        stim_feedback_urls = getStimulusURLs(use='feedback')
-        # Get the parameters
-        confidence_labels, confidence_keys = confidenceParameters(version=CONFIDENCE_VERSION)
-        tutorial_types, tutorial_types_keys, tutorial_train_stimuli, tutorial_test_stimuli = \
-            tutorialParameters(version=TUTORIAL_VERSION)
-        drone_types, drone_types_keys, train_stimuli, test_stimuli = \
-            taskParameters(version=TASK_VERSION,initial_test=INITIAL_TEST)
-        # Provide payment token
-        return render(request, 'drone_recon/game.html',{
-            'confidence_labels': confidence_labels,
-            'confidence_keys': confidence_keys,
-            'tutorial_types': tutorial_types,
-            'tutorial_types_keys': tutorial_types_keys,
-            'tutorial_train_stimuli': tutorial_train_stimuli,
-            'tutorial_test_stimuli': tutorial_test_stimuli,
-            'drone_types': drone_types,
-            'drone_types_keys': drone_types_keys,
-            'train_stimuli': train_stimuli,
-            'test_stimuli': test_stimuli,
-            'stim_schematic_urls': stim_schematic_urls,
-            'stim_feedback_urls': stim_feedback_urls,
-            'require_fullscreen': REQUIRE_FULLSCREEN,
-            'initial_test': INITIAL_TEST
+        # The page is a shell that fetches its parameters from gameConfig. The images are the smallest
+        # variants in the formats the browser accepts, which it passes on to gameConfig.
+        response = render(request, 'drone_recon/game.html',{
+            'image_formats': acceptedImageFormats(request.META.get('HTTP_ACCEPT', '')),
         })
-        
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+def readGamePost(request, kind):
+    """Reads a post of the game page and checks it against its schema, see submission_schema.py. A body
+    larger than MAX_BODY_SIZE is refused before it is read.
+
+    Args:
+        request (HttpRequest): the post. A one-shot submission may be form fields, the others are a JSON body
+            in the wire format given by the X-Trial-Format header (see wire_format.py).
+        kind (str): 'submission', 'chunk' or 'seal'
+
+    Raises:
+        ValueError: the body can't be decoded, or SubmissionInvalid, with the errors, if it doesn't follow
+            the schema
+
+    Returns:
+        dict: the post, in wire format 0
+    """
+    if (kind == 'submission') and ('X-Trial-Format' not in request.headers):
+        checkBodySize(request)
+        fields = {key: json.loads(request.POST.get(key, ''))
+                  for key in ['classification_trials', 'confidence_trials', 'strategy_free', 'strategy_radio']}
+        validateSubmission('submission_form', fields)
+        payload = dict(fields, classification_trials=fields['classification_trials']['trials'],
+                       confidence_trials=fields['confidence_trials']['trials'])
+    else:
+        payload = decodeTrialPayload(readJSONBody(request), requestTrialFormat(request))
+    validateSubmission(kind, payload)
+    return payload
+
+
+def invalidPostResponse(view, e):
+    """Answers a game post that can't be recorded, so the page doesn't send it again.
+
+    Args:
+        view (str): name of the view, for the log
+        e (ValueError): the error, with the schema errors if it is a SubmissionInvalid
+
+    Returns:
+        JsonResponse: a 400 with the error, and the list of schema errors
+    """
+    logger.error('Error in %s: %s', view, e)
+    return JsonResponse({'success': False, 'error': str(e), 'errors': getattr(e, 'errors', [])}, status=400)
+
+
+def spoolTrialPost(request, kind, body=None):
+    """Appends a game post to the trial spool, to be recorded by the spool worker. See spool.py.
+
+    Args:
+        request (HttpRequest): the post
+        kind (str): 'submission', 'chunk' or 'seal'
+        body (bytes, optional): format 0 JSON to spool instead of the request body. Defaults to None.
+
+    Raises:
+        ValueError: the request names an unknown wire format
+
+    Returns:
+        JsonResponse: success, as soon as the post is on disk
+    """
+    if body is None:
+        trial_format, content_encoding = requestTrialFormat(request), request.headers.get('Content-Encoding', '')
+        body = request.body
+    else:
+        trial_format, content_encoding = 0, ''
+    getTrialSpool().append(kind, request.session['session_ID'], body, trial_format=trial_format,
+                           content_encoding=content_encoding)
+    if TRIAL_SPOOL_WORKER:
+        wakeSpoolWorker()
+    return JsonResponse({
+            'success': True,
+            'spooled': True,
+        })
+
+
+@require_POST
+def gameChunk(request):
+    """Saves a chunk of trials the game page uploads during the task. See submissions.recordTrialChunk.
+
+    Args:
+        request (HttpRequest): POST with a JSON body holding sequence, idempotency_key and the trials, in
+            the wire format given by its X-Trial-Format header (see wire_format.py). It may be gzipped.
+
+    Returns:
+        JsonResponse: the sequence number and trial count of the chunk, and whether it had been received
+            before. A 400 if the chunk doesn't follow its schema or can't be saved, in which case sending it
+            again won't help.
+    """
+    try:
+        chunk = readGamePost(request, 'chunk')
+        if TRIAL_SPOOL:
+            return spoolTrialPost(request, 'chunk')
+        n_trials, created = recordTrialChunk(request.session['session_ID'], int(chunk['sequence']),
+                                             str(chunk['idempotency_key']), chunk['classification_trials'],
+                                             chunk['confidence_trials'])
+    except ValueError as e:
+        return invalidPostResponse('gameChunk', e)
+    return JsonResponse({
+            'success': True,
+            'sequence': chunk['sequence'],
+            'n_trials': n_trials,
+            'duplicate': not created,
+        })
+
+
+@require_POST
+def gameSeal(request):
+    """Completes a session whose trials were uploaded in chunks, with the strategy reports. See
+    submissions.sealGameSubmission.
+
+    Args:
+        request (HttpRequest): POST with a JSON body holding n_chunks, strategy_free and strategy_radio
+
+    Returns:
+        JsonResponse: success, or a 409 listing the chunks that were not received, for the page to send again.
+            When spooled, chunks that never arrive can't be asked for again. A 400 if the seal doesn't follow
+            its schema.
+    """
+    try:
+        seal = readGamePost(request, 'seal')
+    except ValueError as e:
+        return invalidPostResponse('gameSeal', e)
+    if TRIAL_SPOOL:
+        return spoolTrialPost(request, 'seal')
+    missing = sealGameSubmission(request.session['session_ID'], int(seal['n_chunks']), seal['strategy_free'],
+                                 seal['strategy_radio'])
+    if len(missing) > 0:
+        return JsonResponse({'success': False, 'missing': missing}, status=409)
+    return JsonResponse({
+            'success': True,
+        })
+
+
+def gameConfigFormats(request):
+    """Gets the image formats for the game configuration, from the query string set by the game page, or
+    from the Accept header if there is none.
+
+    Args:
+        request (HttpRequest): request for the game configuration
+
+    Returns:
+        tuple: image formats, see image_variants.acceptedImageFormats
+    """
+    if 'formats' in request.GET:
+        return parseImageFormats(request.GET['formats'])
+    return acceptedImageFormats(request.META.get('HTTP_ACCEPT', ''))
+
+
+def gameConfigETag(request):
+    """ETag of the game configuration, so a browser that already has it gets a 304.
+
+    Args:
+        request (HttpRequest): request for the game configuration
+
+    Returns:
+        str: the ETag
+    """
+    return getGameConfig(gameConfigFormats(request))[1]
+
+
+@condition(etag_func=gameConfigETag)
+def gameConfig(request):
+    """Serves the game configuration: drone types and keys, confidence labels, the tutorial, train and
+    test stimuli, and the schematic and feedback URLs. See functions.buildGameConfig.
+
+    Args:
+        request (HttpRequest): GET request from the game page
+
+    Returns:
+        HttpResponse: the JSON configuration. Browsers revalidate it with its ETag on every visit.
+    """
+    body, _ = getGameConfig(gameConfigFormats(request))
+    response = HttpResponse(body, content_type='application/json')
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
 
 def questionnaires(request):
     """Launches the questionnaires, and processes responses when they are returned
@@ -460,35 +594,40 @@ def questionnaires(request):
     """
     logger.info('In questionnaires function')
     if request.method == "POST":
-        # Process the formsets
         formset_data = request.POST.copy()
-        formset_prefixes = [formset_data_key.split('-')[0] for formset_data_key in formset_data.keys() if
-            ('questionnaireformeset_id' in formset_data_key) and (formset_data_key.split('-')[0] != 'initial')]
-        formset_prefixes = np.unique(formset_prefixes)
-        formset_list = []
-        formset_att_check,formset_att_check_bool = [], False
-        for formset_prefix in formset_prefixes:
-            for i in range(int(formset_data[f'{formset_prefix}-TOTAL_FORMS'])):
-                if formset_data[f'{formset_prefix}-{i}-questionnaire_name'] == 'att_check':
-                    formset_att_check_bool = True
-                form_prefix_answer = f'{formset_prefix}-{i}-answer'
-                if form_prefix_answer not in formset_data.keys():
-                    formset_data[form_prefix_answer] = 0
-            formset_f = modelformset_factory(QuestionnaireQ, exclude=('session',))
-            formset = formset_f(formset_data,prefix=formset_prefix)
-            if not formset.is_valid():
-                raise ValueError(f'Invalid formset for {formset_prefix}')
-            else:
-                formset_list.append(formset)
-            if formset_att_check_bool:
-                formset_att_check = formset
-                formset_att_check_bool = False    
+        if formset_data.get('questionnaire_format') == 'compact':
+            # Only the answers were posted. The questions are taken from the questionnaire catalog.
+            answers = readCompactAnswers(request.POST)
+            questions = list(answers)
+        else:
+            # Process the formsets
+            formset_prefixes = [formset_data_key.split('-')[0] for formset_data_key in formset_data.keys() if
+                ('questionnaireformeset_id' in formset_data_key) and (formset_data_key.split('-')[0] != 'initial')]
+            formset_prefixes = np.unique(formset_prefixes)
+            formset_list = []
+            formset_att_check,formset_att_check_bool = [], False
+            for formset_prefix in formset_prefixes:
+                for i in range(int(formset_data[f'{formset_prefix}-TOTAL_FORMS'])):
+                    if formset_data[f'{formset_prefix}-{i}-questionnaire_name'] == 'att_check':
+                        formset_att_check_bool = True
+                    form_prefix_answer = f'{formset_prefix}-{i}-answer'
+                    if form_prefix_answer not in formset_data.keys():
+                        formset_data[form_prefix_answer] = 0
+                formset_f = modelformset_factory(QuestionnaireQ, exclude=('session',))
+                formset = formset_f(formset_data,prefix=formset_prefix)
+                if not formset.is_valid():
+                    raise ValueError(f'Invalid formset for {formset_prefix}')
+                else:
+                    formset_list.append(formset)
+                if formset_att_check_bool:
+                    formset_att_check = formset
+                    formset_att_check_bool = False    
+            questions = [question for formset in formset_list for question in formset.save(commit=False)]
+            answers = formset_att_check.cleaned_data if formset_att_check else []
         # Set the MH diagnosis age to 0 if it's not there
         for condition in MH_HISTORY:
             if f'{condition[0]}-age' not in formset_data.keys():
                 formset_data[f'{condition[0]}-age'] = 0
-        formset_f = modelformset_factory(QuestionnaireQ, exclude=('session',))
-        formset = formset_f(formset_data)
         # Get the other forms
         form_mh = makeMentalHealthHistoryRadioAgeForm(formset_data, mh_history=MH_HISTORY)
         form_att_check = attentionCheckList(request.POST)
@@ -496,70 +635,47 @@ def questionnaires(request):
         session = Session.objects.filter(id=request.session['session_ID'])[0]
         session.end_time = datetime.now()
         if all([form_mh.is_valid(),form_att_check.is_valid()]):
-            # Process the MH history form
-            processMentalHealthHistoryForm(session, form_mh, mh_history=MH_HISTORY)
-            # Process the questions from the formset
-            for formset in formset_list:
-                questions = formset.save(commit=False)
-                for question in questions:
-                    question.session = session
-                    question.save()
-            # Check that they were paying attention and take proper course
+            if request.session['webapp_use'] not in ['screen', 'task', 'both']:
+                raise ValueError(f"{request.session['webapp_use']} is invalid for WEBAPP_USE")
+            # Check that they were paying attention
             if ATTENTION_CHECK:
-                pass_attention_check = checkAttention(formset_att_check,form_att_check,max_n_failures=MAX_N_ATTENTION_FAILURES)
-                # Save the checkbox answer
-                question = QuestionnaireQ(session=session,questionnaire_name='att_check_list',subscale='NA',
+                pass_attention_check = checkAttention(answers,form_att_check,max_n_failures=MAX_N_ATTENTION_FAILURES)
+                # Save the checkbox answer with the others
+                questions.append(QuestionnaireQ(questionnaire_name='att_check_list',subscale='NA',
                     possible_answers={'Fail':0,'Pass':1},question=form_att_check.label,questionnaire_question_number=0,
                     answer=(('pass_attention_check' in form_att_check.cleaned_data["attention_checkbox"]) and \
-                        ('fail_attention_check' not in form_att_check.cleaned_data["attention_checkbox"])))
-                question.save()
+                        ('fail_attention_check' not in form_att_check.cleaned_data["attention_checkbox"]))))
             else:
                 pass_attention_check = True
+            session.passed_attention_check = pass_attention_check
+            session.questionnaire_completed = session.questionnaire_completed or pass_attention_check
+            session.session_completed = session.session_completed or \
+                (pass_attention_check and (request.session['webapp_use'] == 'screen'))
+            # Save the answers, the MH history and the session in one transaction, with a constant number of
+            # queries. The answers refer to the questions in the questionnaire item catalog.
+            with transaction.atomic():
+                QuestionnaireAnswer.objects.bulk_create(QuestionnaireAnswer.fromQuestions(session, questions),
+                                                        batch_size=500)
+                Subject.objects.filter(id=session.subject_id).update(
+                    psych_history=mentalHealthHistoryList(form_mh, mh_history=MH_HISTORY))
+                session.save(update_fields=['end_time', 'passed_attention_check', 'questionnaire_completed',
+                                            'session_completed'])
+            # Take proper course
             if not pass_attention_check:
-                session.passed_attention_check = False
-                session.save()
                 return attentionfailure(request)
-            else:
-                request.method = 'GET'
-                session.passed_attention_check = True
-                session.questionnaire_completed = True
-                session.save()
-                if request.session['webapp_use'] == 'screen':
-                    session.session_completed = True
-                    session.save()
-                    return token(request)
-                elif (request.session['webapp_use'] == 'task') or (request.session['webapp_use'] == 'both'):
-                    return game(request)
-                else:
-                    raise ValueError(f"{request.session['webapp_use']} is invalid for WEBAPP_USE")
+            request.method = 'GET'
+            if request.session['webapp_use'] == 'screen':
+                return token(request)
+            return game(request)
         else:
             raise ValueError('Problem with the questionnaire formset processing.')
 
     else:
-        # Make the conditional formsets
-        formset_conditional_list, conditional_questions_formset_dict = [], {}
-        for questionnaire in QUESTIONNAIRES_CONDITIONAL.keys():
-            formset_conditional_tmp, conditional_questions_tmp = makeConditionalFormSet(
-                {questionnaire: QUESTIONNAIRES_CONDITIONAL[questionnaire]},\
-                conditional_questions=CONDITIONAL_QUESTIONS[questionnaire])
-            formset_conditional_list.append(formset_conditional_tmp)
-            for key in conditional_questions_tmp:
-                conditional_questions_formset_dict[key] = conditional_questions_tmp[key]
-        # Make the conditional dict for the mental health form and merge it with the other dictionary
-        conditional_questions_dict = makeMentalHealthConditionalDict(MH_HISTORY)
-        if len(conditional_questions_formset_dict) > 0:
-            conditional_questions_dict = {**conditional_questions_dict, **conditional_questions_formset_dict}
-        # Make the regular formsets and combine with the conditional
-        formset_regular = makeQuestionnaireFormSet(QUESTIONNAIRES)
-        formsets_combined = CombinedFormSet(formsets=formset_conditional_list + [formset_regular])
-        # MAKE THE STANDARD FORMS
-        form_mh = makeMentalHealthHistoryRadioAgeForm(mh_history=MH_HISTORY)
-        form_att_check = attentionCheckList()
+        # The forms are the same for everyone, so they are rendered once and only the CSRF token is added
+        fragment = getQuestionnaireFragment()
         return render(request, "drone_recon/questionnaires.html", {
-            "formsets_combined": formsets_combined,
-            'form_mh': form_mh,
-            'form_att_check': form_att_check,
-            'conditional_questions': conditional_questions_dict
+            'questionnaire_html': mark_safe(fragment['html']),
+            'conditional_questions': fragment['conditional_questions']
         })
 
 
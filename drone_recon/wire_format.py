@@ -0,0 +1,230 @@
+'''
+Wire formats of the trials the game page uploads.
+
+Format 0 is the jsPsych data as it is: lists of trial objects under classification_trials and
+confidence_trials, each repeating the stimulus URL and the string fields.
+
+Format 1 is columnar. The stimulus URLs are listed once, under 'stimuli', and the trials refer to them by
+index. The classification and confidence trials are each a table of columns, one array per field. A column
+is either a plain array of values, or {'levels': [...], 'codes': [...]} for repeated strings like the block
+or the drone type. The page gzips the body when the browser has CompressionStream, and says so with
+Content-Encoding: gzip. For example:
+
+    {"stimuli": ["/media/images/A_d1_1.png", ...],
+     "classification": {"stimulus": [0, 5, ...], "rt": [812.4, ...], "trial_index_aligned": [0, 1, ...],
+                        "block": {"levels": ["train", "test"], "codes": [0, 0, ...]}, ...},
+     "confidence": {"stimulus": [...], "response": [...], "rt": [...], "trial_index_aligned": [...]}}
+
+The page sends the format it uses in the X-Trial-Format header, 0 if there is none. The server offers
+TRIAL_FORMAT in the game configuration. Whatever the format, decodeTrialPayload returns the trials as
+format 0 lists, so the recording in drone_recon.submissions doesn't depend on it. Other fields of the
+payload, like the chunk sequence number, are passed through.
+
+'''
+
+import io
+import json
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+
+TRIAL_FORMATS = (0, 1)
+# Largest body accepted, before and after decompression, so a small gzip body can't expand without bound.
+# It is the size Django reads a body up to, DATA_UPLOAD_MAX_MEMORY_SIZE, 2.5 MB by default. The game page
+# uploads its trials in chunks (see TRIAL_CHUNK_SIZE), which stay well below that.
+MAX_BODY_SIZE = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+READ_SIZE = 64 * 1024
+
+# Fields of each trial table. 'stimulus' is an index into the stimuli list, 'int' and 'float' are numbers,
+# 'value' is anything JSON holds, usually strings sent as levels and codes.
+CLASSIFICATION_FIELDS = {'stimulus': 'stimulus', 'response': 'value', 'correct_response': 'value',
+                         'drone_type': 'value', 'type_selected': 'value', 'rt': 'float', 'block': 'value',
+                         'trial_index_aligned': 'int'}
+CONFIDENCE_FIELDS = {'stimulus': 'stimulus', 'response': 'value', 'rt': 'float', 'trial_index_aligned': 'int'}
+
+
+def requestTrialFormat(request):
+    """Gets the wire format of a trial upload from its X-Trial-Format header.
+
+    Args:
+        request (HttpRequest): the upload
+
+    Raises:
+        ValueError: the format isn't one of TRIAL_FORMATS
+
+    Returns:
+        int: the format
+    """
+    trial_format = request.headers.get('X-Trial-Format', '0')
+    if trial_format not in [str(known) for known in TRIAL_FORMATS]:
+        raise ValueError(f'Unknown trial format {trial_format}')
+    return int(trial_format)
+
+
+def checkBodySize(request, max_size=MAX_BODY_SIZE):
+    """Refuses a request whose Content-Length is larger than max_size, before its body is read.
+
+    Args:
+        request (HttpRequest): the request
+        max_size (int, optional): largest body accepted, in bytes. Defaults to MAX_BODY_SIZE.
+
+    Raises:
+        ValueError: the body is too large, or the Content-Length is not a number
+    """
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise ValueError('Invalid Content-Length')
+    if content_length > max_size:
+        raise ValueError(f'Request body is larger than {max_size} bytes')
+
+
+def readJSONBody(request, max_size=MAX_BODY_SIZE):
+    """Reads the JSON body of a request. A gzip body is decompressed as it is read. A body larger than
+    max_size is refused from its Content-Length, without being read. request.body stays available.
+
+    Args:
+        request (HttpRequest): the request
+        max_size (int, optional): largest size accepted, in bytes, before and after decompression. Defaults
+            to MAX_BODY_SIZE.
+
+    Raises:
+        ValueError: the body is not valid gzip or JSON, or is larger than max_size
+
+    Returns:
+        the decoded JSON
+    """
+    checkBodySize(request, max_size=max_size)
+    return readJSONStream(io.BytesIO(request.body), request.headers.get('Content-Encoding', ''), max_size=max_size)
+
+
+def readJSONStream(stream, content_encoding='', max_size=MAX_BODY_SIZE):
+    """Reads JSON from a file-like object, decompressing it as it is read if it is gzipped.
+
+    Args:
+        stream: object with a read(size) method, e.g. an HttpRequest
+        content_encoding (str, optional): 'gzip', or '' for plain JSON. Defaults to ''.
+        max_size (int, optional): largest decompressed size accepted, in bytes. Defaults to MAX_BODY_SIZE.
+
+    Raises:
+        ValueError: the body is not valid gzip or JSON, or is larger than max_size
+
+    Returns:
+        the decoded JSON
+    """
+    if content_encoding.strip().lower() != 'gzip':
+        return json.loads(stream.read())
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts, size = [], 0
+    try:
+        while not decompressor.eof:
+            block = stream.read(READ_SIZE)
+            if len(block) == 0:
+                break
+            part = decompressor.decompress(block, max_size + 1 - size)
+            size += len(part)
+            if (size > max_size) or (len(decompressor.unconsumed_tail) > 0):
+                raise ValueError(f'Request body is larger than {max_size} bytes once decompressed')
+            parts.append(part)
+    except zlib.error as e:
+        raise ValueError(f'Request body is not valid gzip: {e}')
+    if not decompressor.eof:
+        raise ValueError('Request body is truncated gzip')
+    return json.loads(b''.join(parts))
+
+
+def decodeColumn(column, kind, n_stimuli):
+    """Decodes one column of a trial table.
+
+    Args:
+        column: plain array of values, or dict of 'levels' and 'codes'
+        kind (str): 'stimulus', 'int', 'float' or 'value', see CLASSIFICATION_FIELDS
+        n_stimuli (int): length of the stimuli list
+
+    Raises:
+        ValueError: a code or stimulus index is out of range, or a number isn't finite
+
+    Returns:
+        np.ndarray: the values
+    """
+    if isinstance(column, dict):
+        levels = np.empty(len(column['levels']), dtype=object)
+        levels[:] = column['levels']
+        codes = np.asarray(column['codes'], dtype=np.int64).reshape(-1)
+        if (len(codes) > 0) and ((codes.min() < 0) or (codes.max() >= len(levels))):
+            raise ValueError('Column code out of range of its levels')
+        values = levels[codes]
+    elif kind == 'value':
+        values = np.empty(len(column), dtype=object)
+        values[:] = column
+    else:
+        values = np.asarray(column)
+    if kind == 'value':
+        return values
+    values = values.astype(np.float64)
+    if not np.all(np.isfinite(values)):
+        raise ValueError('Numeric column has missing or non-finite values')
+    if kind == 'float':
+        return values
+    values = values.astype(np.int64)
+    if (kind == 'stimulus') and (len(values) > 0) and ((values.min() < 0) or (values.max() >= n_stimuli)):
+        raise ValueError('Stimulus index out of range of the stimuli list')
+    return values
+
+
+def decodeTrialTable(table, fields, stimuli):
+    """Decodes a table of columns into a list of trial dicts, as jsPsych would have sent them.
+
+    Args:
+        table (dict): field -> column
+        fields (dict): field -> kind, e.g. CLASSIFICATION_FIELDS
+        stimuli (list): stimulus URLs the stimulus column refers to
+
+    Raises:
+        ValueError: a field is missing, the columns have different lengths, or a column can't be decoded
+
+    Returns:
+        list: one dict per trial
+    """
+    stimuli = np.asarray(stimuli, dtype=object)
+    columns = {}
+    for field, kind in fields.items():
+        if field not in table:
+            raise ValueError(f'Trial table has no {field} column')
+        columns[field] = decodeColumn(table[field], kind, len(stimuli))
+        if kind == 'stimulus':
+            columns[field] = stimuli[columns[field]]
+    lengths = set(len(column) for column in columns.values())
+    if len(lengths) > 1:
+        raise ValueError(f'Trial table columns have different lengths: {sorted(lengths)}')
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*[column.tolist() for column in columns.values()])]
+
+
+def decodeTrialPayload(payload, trial_format):
+    """Decodes an uploaded payload to format 0, with classification_trials and confidence_trials lists.
+
+    Args:
+        payload (dict): the decoded JSON body
+        trial_format (int): its format, see requestTrialFormat
+
+    Raises:
+        ValueError: the payload doesn't follow the format
+
+    Returns:
+        dict: the payload in format 0
+    """
+    if trial_format == 0:
+        return payload
+    if trial_format != 1:
+        raise ValueError(f'Unknown trial format {trial_format}')
+    decoded = {key: value for key, value in payload.items() if key not in ('stimuli', 'classification', 'confidence')}
+    try:
+        decoded['classification_trials'] = decodeTrialTable(payload['classification'], CLASSIFICATION_FIELDS,
+                                                            payload['stimuli'])
+        decoded['confidence_trials'] = decodeTrialTable(payload['confidence'], CONFIDENCE_FIELDS, payload['stimuli'])
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'Payload does not follow trial format 1: {e!r}')
+    return decoded
@@ -69,4 +69,178 @@ function blockFeedbackMessage(block){
         <p>Press any key to continue.</p>`;
 
     return message
-}
\ No newline at end of file
+}
+
+/* Stimulus bundle. See drone_recon/stimulus_bundle.py */
+var stimulus_bundle_urls = {};
+
+function loadStimulusBundle(bundle, done) {
+    // Fetches the bundle in one request and slices it into object URLs. Calls done(true) when every image is
+    // available through bundledURL, or done(false) if the bundle couldn't be loaded.
+    fetch(bundle.url)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Stimulus bundle request failed with status ' + response.status);
+            }
+            return response.arrayBuffer();
+        })
+        .then(buffer => {
+            if (buffer.byteLength != bundle.size) {
+                throw new Error('Stimulus bundle has ' + buffer.byteLength + ' bytes, expected ' + bundle.size);
+            }
+            for (let i = 0; i < bundle.entries.length; i++) {
+                var [url, offset, length, type] = bundle.entries[i];
+                var blob = new Blob([buffer.slice(offset, offset + length)], {type: type});
+                stimulus_bundle_urls[url] = URL.createObjectURL(blob);
+            }
+            done(true);
+        })
+        .catch(error => {
+            console.log(error);
+            stimulus_bundle_urls = {};
+            done(false);
+        });
+}
+
+function bundledURL(url) {
+    // The object URL of an image from the bundle, or the original URL if it isn't bundled
+    return stimulus_bundle_urls[url] || url;
+}
+
+function bundledHTML(html) {
+    // Swaps the image URLs in an HTML string for their object URLs from the bundle
+    for (const [url, object_url] of Object.entries(stimulus_bundle_urls)) {
+        html = html.split(url).join(object_url);
+    }
+    return html;
+}
+
+/* Trial upload in chunks during the task. See drone_recon/submissions.py */
+var trial_upload = {chunks: [], last_trial_index: -1, pending: Promise.resolve(), format: 0};
+
+/* Fields sent for each kind of trial. See drone_recon/wire_format.py */
+var classification_fields = ['stimulus', 'response', 'correct_response', 'drone_type', 'type_selected', 'rt',
+    'block', 'trial_index_aligned'];
+var confidence_fields = ['stimulus', 'response', 'rt', 'trial_index_aligned'];
+
+function encodeColumns(trials, fields, stimulus_index) {
+    // Turns a list of trials into one array per field. Stimuli are indexes into the stimuli list, and columns
+    // that aren't all numbers are sent as levels and codes.
+    var table = {};
+    for (const field of fields) {
+        var values = trials.map(trial => trial[field]);
+        if (field == 'stimulus') {
+            table[field] = values.map(url => stimulus_index.has(url) ? stimulus_index.get(url) :
+                stimulus_index.set(url, stimulus_index.size).get(url));
+        } else if (values.every(value => typeof value === 'number')) {
+            table[field] = values;
+        } else {
+            var levels = new Map();
+            var codes = values.map(value => levels.has(value) ? levels.get(value) : levels.set(value, levels.size).get(value));
+            table[field] = {levels: Array.from(levels.keys()), codes: codes};
+        }
+    }
+    return table;
+}
+
+function encodeTrialRequest(payload, classification_trials, confidence_trials) {
+    // Resolves to the body and headers of a trial upload, in trial_upload.format. Format 1 is gzipped
+    // when the browser can.
+    var headers = {'X-Trial-Format': String(trial_upload.format)};
+    if (trial_upload.format == 0) {
+        payload.classification_trials = classification_trials;
+        payload.confidence_trials = confidence_trials;
+        return Promise.resolve({body: JSON.stringify(payload), headers: headers});
+    }
+    var stimulus_index = new Map();
+    payload.classification = encodeColumns(classification_trials, classification_fields, stimulus_index);
+    payload.confidence = encodeColumns(confidence_trials, confidence_fields, stimulus_index);
+    payload.stimuli = Array.from(stimulus_index.keys());
+    var body = JSON.stringify(payload);
+    if (typeof CompressionStream === 'undefined') {
+        return Promise.resolve({body: body, headers: headers});
+    }
+    headers['Content-Encoding'] = 'gzip';
+    var stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+    return new Response(stream).arrayBuffer().then(buffer => ({body: buffer, headers: headers}));
+}
+
+function postJSON(url, request, csrftoken, attempts = 4) {
+    // Posts a request made by encodeTrialRequest, or a plain {body, headers}, and resolves to {status, body}.
+    // Network errors and server errors are retried with a growing delay, other responses are returned as they are.
+    return fetch(url, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: Object.assign({'Content-Type': 'application/json', 'X-CSRFToken': csrftoken}, request.headers),
+            body: request.body
+        })
+        .then(response => {
+            if (response.status >= 500) {
+                throw new Error(url + ' failed with status ' + response.status);
+            }
+            return response.json().then(json => ({status: response.status, body: json}));
+        })
+        .catch(error => {
+            if (attempts <= 1) {
+                throw error;
+            }
+            console.log(error);
+            return new Promise(resolve => setTimeout(resolve, 1000 * 2 ** (4 - attempts)))
+                .then(() => postJSON(url, request, csrftoken, attempts - 1));
+        });
+}
+
+function sendTrialChunk(chunkurl, chunk, csrftoken) {
+    // Queues a chunk behind the ones already sent. A chunk that can't be sent doesn't hold up the next ones,
+    // the seal reports it as missing.
+    trial_upload.pending = trial_upload.pending
+        .then(() => chunk.request)
+        .then(request => postJSON(chunkurl, request, csrftoken))
+        .then(result => {
+            chunk.sent = (result.status == 200);
+            if (!chunk.sent) {
+                console.log('Chunk ' + chunk.sequence + ' was refused: ' + result.body.error);
+            }
+        })
+        .catch(error => console.log(error));
+    return trial_upload.pending;
+}
+
+function uploadTrialChunk(chunkurl, csrftoken) {
+    // Sends the classification and confidence trials recorded since the last chunk
+    var data = jsPsych.data.get().filterCustom(trial => trial.trial_index > trial_upload.last_trial_index);
+    var classification_trials = data.filter({task: 'classification'}).values();
+    var confidence_trials = data.filter({task: 'confidence'}).values();
+    if (classification_trials.length + confidence_trials.length == 0) {
+        return trial_upload.pending;
+    }
+    trial_upload.last_trial_index = data.last(1).values()[0].trial_index;
+    var chunk = {sequence: trial_upload.chunks.length, sent: false};
+    chunk.request = encodeTrialRequest({
+        sequence: chunk.sequence,
+        idempotency_key: chunk.sequence + '-' + Date.now().toString(36) + '-' + Math.random().toString(36).slice(2)
+    }, classification_trials, confidence_trials);
+    trial_upload.chunks.push(chunk);
+    return sendTrialChunk(chunkurl, chunk, csrftoken);
+}
+
+function sealTrialUpload(sealurl, chunkurl, csrftoken, strategy_free, strategy_radio, resends = 2) {
+    // Sends the trials not uploaded yet, then completes the session with the strategy reports. Chunks the
+    // server didn't receive are sent again. Resolves once the session is sealed.
+    return uploadTrialChunk(chunkurl, csrftoken)
+        .then(() => postJSON(sealurl, {body: JSON.stringify({
+            n_chunks: trial_upload.chunks.length,
+            strategy_free: strategy_free,
+            strategy_radio: strategy_radio
+        }), headers: {}}, csrftoken))
+        .then(result => {
+            if (result.status == 200) {
+                return;
+            }
+            if ((result.status != 409) || (resends <= 0)) {
+                throw new Error('Sealing the session failed with status ' + result.status);
+            }
+            result.body.missing.forEach(sequence => sendTrialChunk(chunkurl, trial_upload.chunks[sequence], csrftoken));
+            return sealTrialUpload(sealurl, chunkurl, csrftoken, strategy_free, strategy_radio, resends - 1);
+        });
+}